@@ -0,0 +1,295 @@
+"""
+Benchmarks of compress_netcfd, compute_all, numba_calculate_metrics and extract_by_rivid on synthetic data.
+
+Each stage runs in a new process, so that its peak memory and the JIT compilation time of its Numba functions are
+measured from a clean state. The throughput is reported in rivid-days per second (the number of streams times the
+number of start dates that the stage processed), leaving out the JIT compilation time, which is reported separately.
+The results can be saved as the baseline of the size of the data, and later runs are compared with it (the exit code is
+1 if a stage regressed). The baselines are only comparable on the same kind of machine, so the comparison is skipped
+if the platform or the number of CPUs differ from the ones recorded with the baseline (see --ignore_machine):
+
+    python -m benchmarks.run_benchmarks --rivids 2000 --dates 30 --save_baseline
+    python -m benchmarks.run_benchmarks --rivids 2000 --dates 30
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+STAGES = ["compress", "validate", "kernel", "extract"]
+
+# Number of rivids extracted by the extract benchmark
+EXTRACT_RIVIDS = 10
+
+
+def run_stage(stage, data_dir, num_rivids, num_dates, memory_gb):
+    """Runs one stage (in a new process, see benchmark_stage) and returns its measurements."""
+    import numpy as np
+    from numba.core import event
+    from global_forecast_validation.profiling import compile_seconds, reset_peak_rss, current_rss_bytes, peak_rss_bytes
+
+    if stage == "compress":
+        from global_forecast_validation.compress_netcdf import compress_netcfd
+
+        out_folder = os.path.join(data_dir, "compressed_raw")
+        shutil.rmtree(out_folder, ignore_errors=True)
+        os.makedirs(out_folder)
+
+        def work():
+            compress_netcfd(os.path.join(data_dir, "raw"), out_folder, "Qout_synthetic", max_workers=1)
+
+        rivid_days = num_rivids
+
+    elif stage == "validate":
+        from global_forecast_validation.validate_forecasts import compute_all
+
+        def work():
+            compute_all(os.path.join(data_dir, "archive"), os.path.join(data_dir, "results.csv"), memory_gb)
+
+        rivid_days = num_rivids * num_dates
+
+    elif stage == "kernel":
+        from global_forecast_validation.validate_forecasts import numba_calculate_metrics
+
+        rng = np.random.RandomState(0)
+        forecasts = rng.gamma(2., 10., size=(num_dates, num_rivids, 15, 51)).astype(np.float32)
+        initialization = rng.gamma(2., 10., size=(num_dates, num_rivids)).astype(np.float32)
+        rivids = np.arange(num_rivids)
+
+        def work():
+            numba_calculate_metrics(forecasts, initialization, num_dates, num_rivids, 15, rivids)
+
+        rivid_days = num_rivids * num_dates
+
+    elif stage == "extract":
+        from global_forecast_validation.extract_data import extract_by_rivids
+
+        out_path = os.path.join(data_dir, "extracted")
+        shutil.rmtree(out_path, ignore_errors=True)
+        os.makedirs(out_path)
+        rivids = np.linspace(1, num_rivids, EXTRACT_RIVIDS).astype(int).tolist()
+
+        def work():
+            extract_by_rivids(rivids, os.path.join(data_dir, "archive"), out_path)
+
+        rivid_days = len(rivids) * num_dates
+
+    else:
+        raise ValueError("Unknown stage '{}', the stages are {}.".format(stage, ", ".join(STAGES)))
+
+    reset_peak_rss()
+    baseline_rss = current_rss_bytes()
+
+    with event.install_recorder("numba:compile") as recorder:
+        start = time.perf_counter()
+        work()
+        seconds = time.perf_counter() - start
+
+    peak_rss = peak_rss_bytes()
+    jit_compile_s = compile_seconds(recorder.buffer)
+
+    return {
+        "seconds": seconds,
+        "rivid_days_per_s": rivid_days / (seconds - jit_compile_s),
+        "peak_memory_mb": None if peak_rss is None or baseline_rss is None else (peak_rss - baseline_rss) / 1e6,
+        "max_rss_mb": None if peak_rss is None else peak_rss / 1e6,
+        "jit_compile_s": jit_compile_s,
+    }
+
+
+def benchmark_stage(stage, data_dir, num_rivids, num_dates, memory_gb):
+    """Runs a stage in a new interpreter so that the measurements of the stages do not affect each other."""
+    # The start method can only be given to the pool from Python 3.7, Python 3.6 forks the process of the stage
+    pool_options = {"mp_context": get_context("spawn")} if sys.version_info >= (3, 7) else {}
+    with ProcessPoolExecutor(max_workers=1, **pool_options) as executor:
+        return executor.submit(run_stage, stage, data_dir, num_rivids, num_dates, memory_gb).result()
+
+
+def generate_data(data_dir, num_rivids, num_dates):
+    """Writes the synthetic RAPID ensembles and the compressed archive used by the benchmarks if they do not exist."""
+    from benchmarks.synthetic import write_rapid_ensembles, write_compressed_archive
+
+    raw_dir = os.path.join(data_dir, "raw")
+    if not os.path.exists(os.path.join(raw_dir, "Qout_synthetic_52.nc")):
+        write_rapid_ensembles(raw_dir, "Qout_synthetic", "2019-01-01", num_rivids)
+
+    archive_dir = os.path.join(data_dir, "archive")
+    if not os.path.exists(archive_dir) or len(os.listdir(archive_dir)) != num_dates:
+        shutil.rmtree(archive_dir, ignore_errors=True)
+        write_compressed_archive(archive_dir, num_rivids, num_dates)
+
+
+def machine_info():
+    """The platform and the number of CPUs of this machine, stored with the baselines."""
+    return {
+        "system": platform.system(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+    }
+
+
+def machine_differences(baseline_machine, machine):
+    """
+    Lists the differences between the machine of a baseline and this machine that make their results incomparable:
+    the operating system, the architecture and the number of CPUs. A baseline without the information of its machine
+    is never comparable.
+    """
+    if not baseline_machine:
+        return ["the machine of the baseline was not recorded"]
+
+    return [
+        "{} is {} here, {} for the baseline".format(key, machine[key], baseline_machine.get(key))
+        for key in ("system", "machine", "cpu_count") if baseline_machine.get(key) != machine[key]
+    ]
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Compares the results of the stages with their baseline. Returns the list of regressions, a throughput that is
+    lower or a peak memory that is higher than the baseline by more than the tolerance (a fraction).
+    """
+    regressions = []
+
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        base = baseline[stage]
+
+        if result["rivid_days_per_s"] < base["rivid_days_per_s"] * (1 - tolerance):
+            regressions.append("{}: {:.0f} rivid-days/s, the baseline is {:.0f}".format(
+                stage, result["rivid_days_per_s"], base["rivid_days_per_s"]
+            ))
+
+        if result["peak_memory_mb"] is not None and base.get("peak_memory_mb") is not None:
+            # Allowing a few MB of noise for the small stages
+            if result["peak_memory_mb"] > base["peak_memory_mb"] * (1 + tolerance) + 5:
+                regressions.append("{}: {:.1f} MB of peak memory, the baseline is {:.1f} MB".format(
+                    stage, result["peak_memory_mb"], base["peak_memory_mb"]
+                ))
+
+    return regressions
+
+
+def format_results(results, baseline):
+    lines = ["{:<10}{:>10}{:>18}{:>12}{:>14}{:>10}".format(
+        "stage", "seconds", "rivid-days/s", "peak MB", "JIT compile s", "vs base"
+    )]
+
+    for stage, result in results.items():
+        if stage in baseline:
+            ratio = "{:.2f}x".format(result["rivid_days_per_s"] / baseline[stage]["rivid_days_per_s"])
+        else:
+            ratio = "-"
+        peak = "-" if result["peak_memory_mb"] is None else "{:.1f}".format(result["peak_memory_mb"])
+
+        lines.append("{:<10}{:>10.3f}{:>18.0f}{:>12}{:>14.3f}{:>10}".format(
+            stage, result["seconds"], result["rivid_days_per_s"], peak, result["jit_compile_s"], ratio
+        ))
+
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the compress, validate and extract stages.")
+    parser.add_argument('--rivids', type=int, default=2000, help='(Optional) The number of streams, 2000 by default.')
+    parser.add_argument('--dates', type=int, default=30,
+                        help='(Optional) The number of start dates of the archive, 30 by default.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES,
+                        help='(Optional) The stages to benchmark, all of them by default.')
+    parser.add_argument('--data_dir', type=str,
+                        help='(Optional) A directory to keep the synthetic data in between runs. By default a '
+                             'temporary directory is used and removed afterwards.')
+    parser.add_argument('--memory', type=float, default=2.,
+                        help='(Optional) The memory (in GB) given to compute_all, 2 by default.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='(Optional) Run each stage this many times and keep the fastest run.')
+    parser.add_argument('--save_baseline', action='store_true',
+                        help='(Optional) Save the results as the baseline of this size of data.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='(Optional) The fraction by which a stage can be slower (or use more memory) than the '
+                             'baseline before it is reported as a regression, 0.2 by default.')
+    parser.add_argument('--output', type=str, help='(Optional) Also write the results to this JSON file.')
+    parser.add_argument('--ignore_machine', action='store_true',
+                        help='(Optional) Compare with the baseline even if it was measured on a different platform or '
+                             'number of CPUs.')
+    args = parser.parse_args(argv)
+
+    size_key = "{}x{}".format(args.rivids, args.dates)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="gfv_benchmarks_")
+
+    try:
+        generate_data(data_dir, args.rivids, args.dates)
+
+        results = {}
+        for stage in args.stages:
+            runs = [
+                benchmark_stage(stage, data_dir, args.rivids, args.dates, args.memory) for _ in range(args.repeat)
+            ]
+            results[stage] = max(runs, key=lambda run: run["rivid_days_per_s"])
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    baselines = {}
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH, "r") as f:
+            baselines = json.load(f)
+    baseline = baselines.get(size_key, {}).get("stages", {})
+
+    print(format_results(results, baseline))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"size": size_key, "stages": results}, f, indent=2)
+
+    machine = machine_info()
+
+    if args.save_baseline:
+        # The stages of another machine are not kept with the ones of this machine
+        if size_key in baselines and machine_differences(baselines[size_key].get("machine_info"), machine):
+            baselines[size_key] = {"stages": {}}
+        baselines[size_key]["machine"] = "{} {}, {} CPUs, Python {}".format(
+            machine["system"], machine["machine"], machine["cpu_count"], machine["python"]
+        )
+        baselines[size_key]["machine_info"] = machine
+        baselines[size_key]["stages"].update(results)
+
+        with open(BASELINES_PATH, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Saved the baseline of {} rivids x {} dates to {}".format(args.rivids, args.dates, BASELINES_PATH))
+        return 0
+
+    if not baseline:
+        print("There is no baseline for {} rivids x {} dates, use --save_baseline to create one.".format(
+            args.rivids, args.dates
+        ))
+        return 0
+
+    print("Baseline measured on {}".format(baselines[size_key].get("machine", "an unknown machine")))
+
+    differences = machine_differences(baselines[size_key].get("machine_info"), machine)
+    if differences and not args.ignore_machine:
+        print("Warning: Not comparing with the baseline, it was measured on another machine ({}). Use --save_baseline "
+              "to create a baseline on this machine or --ignore_machine to compare anyway.".format(
+                  "; ".join(differences)
+              ))
+        return 0
+
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("Regression: " + regression)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
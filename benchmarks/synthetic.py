@@ -0,0 +1,148 @@
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Hours of the time steps of the RAPID forecasts: 3 hourly then 6 hourly for the 15 day ensembles (members 1-51),
+# hourly, 3 hourly then 6 hourly for the 10 day high resolution forecast (member 52)
+ENSEMBLE_HOURS = np.concatenate([np.arange(0, 144, 3), np.arange(144, 361, 6)])
+HIGH_RES_HOURS = np.concatenate([np.arange(0, 90), np.arange(90, 144, 3), np.arange(144, 241, 6)])
+
+
+def synthetic_flows(num_rivids, num_days, seed=0):
+    """
+    Creates the daily "true" flows (day x rivid) of a synthetic stream network, a log-normal base flow for each rivid
+    with a persistent (AR(1)) daily anomaly so that the forecasts and the persistence benchmark have some skill.
+    """
+    rng = np.random.RandomState(seed)
+    base_flow = rng.lognormal(3., 1.5, size=num_rivids)
+
+    anomaly = np.empty((num_days, num_rivids))
+    anomaly[0] = rng.normal(0., 0.5, size=num_rivids)
+    for day in range(1, num_days):
+        anomaly[day] = 0.9 * anomaly[day - 1] + rng.normal(0., 0.2, size=num_rivids)
+
+    return (base_flow * np.exp(anomaly)).astype(np.float32)
+
+
+def forecast_flows(true_flows, start_index, hours, num_members, rng):
+    """
+    Creates forecasts (rivid x time step x member) of the true flows from a start day at the given hours, with an error
+    that grows with the lead time.
+    """
+    days = hours / 24.
+    lower_day = np.minimum(np.floor(days).astype(int), true_flows.shape[0] - start_index - 2)
+    weight = (days - lower_day)[:, np.newaxis]
+    truth = (1 - weight) * true_flows[start_index + lower_day] + weight * true_flows[start_index + lower_day + 1]
+
+    spread = 0.05 + 0.03 * days[:, np.newaxis, np.newaxis]
+    noise = rng.normal(0., 1., size=(hours.size, true_flows.shape[1], num_members)) * spread
+
+    return np.transpose(truth[:, :, np.newaxis] * np.exp(noise), (1, 0, 2)).astype(np.float32)
+
+
+def write_rapid_ensembles(folder_path, file_name, start_date, num_rivids, seed=0):
+    """
+    Writes the 52 forecast files of one start date in the format of RAPIDpy (e.g. Qout_synthetic_1.nc to
+    Qout_synthetic_52.nc), that can be compressed with compress_netcfd.
+
+    Parameters
+    ----------
+
+    folder_path: str
+        The directory to write the files to. It is created if it does not exist.
+
+    file_name: str
+        The name of the region, e.g. "Qout_synthetic".
+
+    start_date: str
+        The start date of the forecasts formatted as YYYY-MM-DD.
+
+    num_rivids: int
+        The number of streams in the network.
+
+    seed: int
+        The seed of the random flows.
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    rng = np.random.RandomState(seed + 1)
+    true_flows = synthetic_flows(num_rivids, 17, seed)
+    start = pd.Timestamp(start_date)
+
+    ensembles = forecast_flows(true_flows, 0, ENSEMBLE_HOURS, 51, rng)
+    high_res = forecast_flows(true_flows, 0, HIGH_RES_HOURS, 1, rng)
+
+    # The flows are the same for all of the members at the start of the forecast
+    ensembles[:, 0, :] = true_flows[0][:, np.newaxis]
+    high_res[:, 0, :] = true_flows[0][:, np.newaxis]
+
+    for member in range(1, 53):
+        hours = ENSEMBLE_HOURS if member <= 51 else HIGH_RES_HOURS
+        flows = ensembles[:, :, member - 1] if member <= 51 else high_res[:, :, 0]
+
+        ds = xr.Dataset(
+            {"Qout": (["rivid", "time"], flows, {"long_name": "Discharge", "units": "m^3/s"})},
+            coords={
+                "time": start + pd.to_timedelta(hours, unit="h"),
+                "rivid": np.arange(1, num_rivids + 1, dtype=np.int32),
+                "lat": ("rivid", np.linspace(-50., 10., num_rivids)),
+                "lon": ("rivid", np.linspace(-90., -35., num_rivids)),
+                "z": ("rivid", np.zeros(num_rivids)),
+            },
+        )
+        encoding = {"time": {"units": "seconds since 1970-01-01", "dtype": "int32"}, "Qout": {"_FillValue": np.nan}}
+        ds.to_netcdf(
+            os.path.join(folder_path, "{}_{}.nc".format(file_name, member)), format="NETCDF3_64BIT", encoding=encoding
+        )
+
+
+def write_compressed_archive(work_dir, num_rivids, num_dates, start_date="2019-01-01", seed=0):
+    """
+    Writes a directory of compressed daily forecast files (YYYYMMDD.nc) in the format of compress_netcfd, for
+    consecutive start dates, that can be validated with compute_all and read with extract_by_rivid.
+
+    Parameters
+    ----------
+
+    work_dir: str
+        The directory to write the files to. It is created if it does not exist.
+
+    num_rivids: int
+        The number of streams in the network.
+
+    num_dates: int
+        The number of consecutive start dates.
+
+    start_date: str
+        The first start date formatted as YYYY-MM-DD.
+
+    seed: int
+        The seed of the random flows.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    rng = np.random.RandomState(seed + 1)
+    true_flows = synthetic_flows(num_rivids, num_dates + 17, seed)
+    rivids = np.arange(1, num_rivids + 1, dtype=np.int32)
+
+    for date_index, start in enumerate(pd.date_range(start_date, periods=num_dates)):
+        ensembles = forecast_flows(true_flows, date_index, np.arange(24, 361, 24), 51, rng)
+        high_res = forecast_flows(true_flows, date_index, np.arange(24, 241, 24), 1, rng)[:, :, 0]
+
+        ds = xr.Dataset(
+            {
+                "Qout": (["rivid", "date", "ensemble_number"], ensembles),
+                "Qout_high_res": (["rivid", "date_high_res"], high_res),
+            },
+            coords={
+                "rivid": rivids,
+                "date": pd.date_range(start + pd.DateOffset(1), periods=15),
+                "date_high_res": pd.date_range(start + pd.DateOffset(1), periods=10),
+                "ensemble_number": np.arange(1, 52, dtype=np.uint8),
+                "initialization_values": ("rivid", true_flows[date_index]),
+                "lat": ("rivid", np.linspace(-50., 10., num_rivids)),
+                "lon": ("rivid", np.linspace(-90., -35., num_rivids)),
+                "z": ("rivid", np.zeros(num_rivids)),
+                "start_date": start,
+            },
+        )
+        ds.to_netcdf(os.path.join(work_dir, "{}.nc".format(start.strftime("%Y%m%d"))), format="NETCDF4")
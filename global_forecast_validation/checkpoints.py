@@ -0,0 +1,99 @@
+import json
+import os
+import re
+import numpy as np
+
+MANIFEST_NAME = "manifest.json"
+CHUNK_PATTERN = re.compile(r"chunk-(\d{8})-(\d{8})\.npz")
+
+
+def open_checkpoint(checkpoint_dir, manifest):
+    """
+    Opens the checkpoint of a run of compute_all, creating it if it does not exist. The manifest describes the run
+    (the forecast files or start dates, the rivids, the shard...), and an existing checkpoint can only be resumed by a
+    run with the same manifest.
+
+    Parameters
+    ----------
+
+    checkpoint_dir: str
+        The directory of the checkpoint.
+
+    manifest: dict
+        The description of the run, which must be serializable as JSON.
+
+    Returns
+    -------
+    list of tuple
+        The start index, end index and path of the completed chunks of rivids, in order, that follow each other from
+        the first rivid. The run can be resumed from the end index of the last one.
+    """
+    manifest_path = os.path.join(checkpoint_dir, MANIFEST_NAME)
+    # Comparing the manifest as it is stored, e.g. with lists instead of tuples
+    manifest = json.loads(json.dumps(manifest))
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            stored_manifest = json.load(f)
+
+        if stored_manifest != manifest:
+            changed = sorted(key for key in set(manifest) | set(stored_manifest)
+                             if manifest.get(key) != stored_manifest.get(key))
+            raise ValueError("The checkpoint in {} belongs to a different run (the {} changed). Remove it to start "
+                             "again.".format(checkpoint_dir, ", ".join(changed)))
+    else:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        write_atomically(manifest_path, lambda f: f.write(json.dumps(manifest, indent=2).encode()))
+
+    chunks = {}
+    for file_name in os.listdir(checkpoint_dir):
+        match = CHUNK_PATTERN.fullmatch(file_name)
+        if match is not None:
+            chunks[int(match.group(1))] = (int(match.group(2)), os.path.join(checkpoint_dir, file_name))
+
+    # Only the chunks that follow each other from the first rivid are kept, the chunks are completed in order
+    completed_chunks = []
+    start_chunk = 0
+    while start_chunk in chunks:
+        end_chunk, path = chunks[start_chunk]
+        completed_chunks.append((start_chunk, end_chunk, path))
+        start_chunk = end_chunk
+
+    return completed_chunks
+
+
+def save_chunk(checkpoint_dir, start_chunk, end_chunk, results_array, high_res_results_array=None):
+    """Saves the results of a chunk of rivids (see numba_calculate_metrics) to the checkpoint."""
+    arrays = {"results": results_array}
+    if high_res_results_array is not None:
+        arrays["high_res_results"] = high_res_results_array
+
+    path = os.path.join(checkpoint_dir, "chunk-{:08d}-{:08d}.npz".format(start_chunk, end_chunk))
+    write_atomically(path, lambda f: np.savez(f, **arrays))
+
+
+def load_chunk(path):
+    """Loads the results and the high resolution results (or None) of a chunk saved with save_chunk."""
+    with np.load(path) as arrays:
+        results_array = arrays["results"]
+        high_res_results_array = arrays["high_res_results"] if "high_res_results" in arrays else None
+
+    return results_array, high_res_results_array
+
+
+def remove_checkpoint(checkpoint_dir):
+    """Removes the files of a checkpoint, and its directory if it is then empty."""
+    for file_name in os.listdir(checkpoint_dir):
+        if file_name == MANIFEST_NAME or CHUNK_PATTERN.fullmatch(file_name):
+            os.remove(os.path.join(checkpoint_dir, file_name))
+
+    if not os.listdir(checkpoint_dir):
+        os.rmdir(checkpoint_dir)
+
+
+def write_atomically(path, write):
+    """Writes a file through a temporary file, so that an interrupted write does not leave a partial file at path."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
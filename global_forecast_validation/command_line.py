@@ -1,15 +1,45 @@
 import argparse
-from global_forecast_validation.compress_netcdf import compress_netcfd
-from global_forecast_validation.validate_forecasts import compute_all
-from global_forecast_validation.extract_data import extract_by_rivid
+import os
+import sys
+from contextlib import ExitStack
+from global_forecast_validation.shards import parse_shard, merge_shards
+from global_forecast_validation.profiling import profiling, stage
+
+# The modules of the commands (and xarray, dask and numba) are imported by the command that uses them, so that a
+# command does not pay for importing the libraries of the others
 
 
 def compress_netcdf_cli(args):
+    from global_forecast_validation.compress_netcdf import compress_netcfd, compress_netcfd_batch
+
     folder_path = args.folder_path
     out_folder = args.out_folder
     file_name = args.file_name
+    sort_ensembles = args.sort_ensembles
+    store_permutation = args.store_permutation
+    max_workers = args.max_workers
+    rivid_block_size = args.rivid_block_size
+    compression = args.compression
+    complevel = args.complevel
+    shuffle = not args.no_shuffle
+    chunks = args.chunks
+    pack = args.pack
+
+    # Either the name of a preset or a list of dim=size pairs
+    if chunks is not None and "=" in chunks:
+        chunks = {dim.strip(): int(size) for dim, size in (pair.split("=") for pair in chunks.split(","))}
 
-    compress_netcfd(folder_path, out_folder, file_name)
+    if args.batch:
+        compress_netcfd_batch(
+            folder_path, out_folder, file_name, args.processes, args.overwrite, sort_ensembles=sort_ensembles,
+            store_permutation=store_permutation, max_workers=max_workers or 1, rivid_block_size=rivid_block_size,
+            compression=compression, complevel=complevel, shuffle=shuffle, chunks=chunks, pack=pack
+        )
+    else:
+        compress_netcfd(
+            folder_path, out_folder, file_name, sort_ensembles, store_permutation, max_workers or 8, rivid_block_size,
+            compression, complevel, shuffle, chunks, pack
+        )
 
 
 def validate_cli(args):
@@ -18,16 +48,85 @@ def validate_cli(args):
     memory_to_allocate_gb = args.memory
     starting_date = args.start_date
     ending_date = args.end_date
+    output_format = args.output_format
+    state_path = args.state
+    scheduler = args.scheduler
+    rivid_chunk_size = args.rivid_chunk_size
+    shard = args.shard
+    high_res = args.high_res
+    checkpoint_dir = args.checkpoint
+    precision = args.precision
+
+    compute_all_only = shard is not None or high_res or checkpoint_dir is not None or precision != "float64"
+    if compute_all_only and (state_path is not None or scheduler is not None):
+        raise RuntimeError("A shard, a checkpoint, the high resolution forecast or the float32 precision cannot be "
+                           "used with an incremental validation or a dask scheduler.")
+
+    if state_path is not None:
+        if starting_date or ending_date:
+            raise RuntimeError("The starting and ending dates cannot be used with an incremental validation.")
+        if scheduler is not None:
+            raise RuntimeError("A dask scheduler cannot be used with an incremental validation.")
+        from global_forecast_validation.incremental_validation import update_validation
+        update_validation(work_dir, state_path, memory_to_allocate_gb, out_path, output_format)
+    elif scheduler is not None:
+        from global_forecast_validation.dask_validation import compute_all_dask
+        compute_all_dask(work_dir, out_path, scheduler, rivid_chunk_size, starting_date, ending_date, output_format)
+    else:
+        from global_forecast_validation.validate_forecasts import compute_all
+        compute_all(
+            work_dir, out_path, memory_to_allocate_gb, starting_date, ending_date, output_format, shard, high_res,
+            checkpoint_dir, precision
+        )
 
-    compute_all(work_dir, out_path, memory_to_allocate_gb, starting_date, ending_date)
+
+def merge_cli(args):
+    out_path = args.out_path
+    output_format = args.output_format
+    remove = args.remove
+
+    with stage("merge_shards"):
+        paths = merge_shards(out_path, output_format)
+    print("Merged {} shards into {}".format(len(paths), out_path))
+
+    if remove:
+        for path in paths:
+            os.remove(path)
 
 
 def extract_cli(args):
+    from global_forecast_validation.extract_data import extract_by_rivid, extract_by_rivids
+
     folder_path = args.folder_path
     outpath = args.outpath
-    rivid = 192451
+    rivids = args.rivids
+    rivid_file = args.rivid_file
+    max_workers = args.max_workers
+    output_format = args.output_format
 
-    extract_by_rivid(rivid, folder_path, outpath)
+    if rivid_file is not None:
+        with open(rivid_file) as f:
+            rivids = rivids + [int(rivid) for rivid in f.read().replace(",", " ").split()]
+
+    if not rivids:
+        raise ValueError("At least one rivid must be given, either as an argument or in the rivid file.")
+
+    if len(rivids) == 1 and rivid_file is None:
+        extract_by_rivid(rivids[0], folder_path, outpath, max_workers, output_format)
+    else:
+        extract_by_rivids(rivids, folder_path, outpath, max_workers, output_format)
+
+
+def archive_cli(args):
+    from global_forecast_validation.zarr_archive import append_to_zarr_archive
+
+    files = args.files
+    store_path = args.store_path
+
+    for file in sorted(files):
+        with stage("append_to_archive", bytes_read=os.path.getsize(file)):
+            append_to_zarr_archive(file, store_path)
+        print("Appended {} to {}".format(file, store_path))
 
 
 def main():
@@ -36,14 +135,23 @@ def main():
     subparsers = parser.add_subparsers(title='Commands', dest='require at least one argument')
     subparsers.required = True
 
+    # Options of all of the commands
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument(
+        '--profile', type=str, metavar='REPORT_PATH',
+        help='(Optional) Write a JSON report to this path with the wall time, the bytes read, the rivid-days '
+             'processed and the memory of each stage (and each chunk of rivids) of the command.'
+    )
+
     # Setup compress command
     compress_parser = subparsers.add_parser(
-        'compress',
+        'compress', parents=[common_parser],
         help='Takes 52 separate NetCDF forecast files and combines them into one compact NetCDF file with only daily '
              'values '
     )
     compress_parser.add_argument(
-        'folder_path', help='The path to the directory containing the forecast files', type=str
+        'folder_path', help='The path to the directory containing the forecast files (or the directories of forecast '
+                            'files of each date when using --batch)', type=str
     )
     compress_parser.add_argument(
         'out_folder', help='The path to the directory that you want the more compact NetCDF file in.', type=str
@@ -52,11 +160,83 @@ def main():
         'file_name', help='The name of the region. For example, if the files followed the pattern of '
                           '"Qout_africa_continental_1.nc, this argument would be "Qout_africa_continental"', type=str
     )
+    compress_parser.add_argument(
+        '-s', '--sort_ensembles', action='store_true',
+        help='(Optional) Store the ensemble members sorted in ascending order so that the validation does not have to '
+             'sort them every time it is run.'
+    )
+    compress_parser.add_argument(
+        '-p', '--store_permutation', action='store_true',
+        help='(Optional) When sorting the ensembles, also store the original ensemble number of each member so that '
+             'the member identity can be recovered.'
+    )
+    compress_parser.add_argument(
+        '-w', '--max_workers', type=int,
+        help='(Optional) The maximum number of worker processes used to read the forecast files at the same time. '
+             'Defaults to 8 (1 with --batch).'
+    )
+    compress_parser.add_argument(
+        '-b', '--rivid_block_size', type=int,
+        help='(Optional) Read and write the forecasts in blocks of this many rivids so that the memory used is bounded '
+             'by the block size instead of the size of the stream network.'
+    )
+    compress_parser.add_argument(
+        '--batch', action='store_true',
+        help='(Optional) Compress every directory of forecast files in folder_path (one directory per forecast date) '
+             'in parallel. Dates that already have a valid compressed file in out_folder are skipped.'
+    )
+    compress_parser.add_argument(
+        '-n', '--processes', type=int,
+        help='(Optional) The number of processes used with --batch. Defaults to the number of CPUs.'
+    )
+    compress_parser.add_argument(
+        '-o', '--overwrite', action='store_true',
+        help='(Optional) With --batch, compress the dates again even if a valid compressed file already exists.'
+    )
+    compress_parser.add_argument(
+        '-c', '--compression', choices=['zlib', 'zstd'],
+        help='(Optional) Compress the forecast variables with zlib or zstd. By default they are not compressed.'
+    )
+    compress_parser.add_argument(
+        '-l', '--complevel', type=int, default=4, help='(Optional) The compression level. Defaults to 4.'
+    )
+    compress_parser.add_argument(
+        '--no_shuffle', action='store_true', help='(Optional) Do not apply the shuffle filter before compressing.'
+    )
+    compress_parser.add_argument(
+        '--chunks', type=str,
+        help='(Optional) The chunk shape of the forecast variables on disk. Either "validate" (suited to the validate '
+             'command), "extract" (suited to the extract command) or the chunk sizes along the dimensions formatted as '
+             '"rivid=1024,date=15,ensemble_number=51".'
+    )
+    compress_parser.add_argument(
+        '--pack', choices=['linear', 'log'],
+        help='(Optional) Store the flows (lossily) as 16 bit integers, either scaled linearly or as log(1 + flow) so '
+             'that low flows keep their relative precision. The maximum error that this introduces is printed. The '
+             'log packing is not part of the CF conventions, other tools than this package read the log values.'
+    )
     compress_parser.set_defaults(func=compress_netcdf_cli)
 
+    # Setup archive command
+    archive_parser = subparsers.add_parser(
+        'archive', parents=[common_parser],
+        help='Appends NetCDF files created with the compress command to a single Zarr archive that the validate and '
+             'extract commands can read in place of a directory of NetCDF files'
+    )
+    archive_parser.add_argument(
+        'files', nargs='+', type=str,
+        help='The NetCDF files created with the compress command (formatted as YYYYMMDD.nc). They are appended in the '
+             'order of their start dates, which must come after the last start date in the archive.'
+    )
+    archive_parser.add_argument(
+        'store_path', type=str,
+        help='The path to the Zarr archive (e.g. South_Asia.zarr). It is created if it does not exist yet.'
+    )
+    archive_parser.set_defaults(func=archive_cli)
+
     # Setup validate command
     validate_parser = subparsers.add_parser(
-        'validate',
+        'validate', parents=[common_parser],
         help='Takes a directory of NetCDf files created with the compress command and performs forecasts validation '
              'with them. The results of the analysis are stored in a csv. WARNING: The netcdf files must be consecutive'
              ' daily values, else the results will be wrong.'
@@ -64,7 +244,8 @@ def main():
     validate_parser.add_argument(
         'work_dir', type=str,
         help='The directory that contains all of the forecast files that were created with the compress_netcdf '
-             'function. Make sure that this directory only contains the compressed forecast files.'
+             'function (or a Zarr archive created with the archive command). Make sure that this directory only '
+             'contains the compressed forecast files.'
     )
     validate_parser.add_argument(
         "out_path", type=str, help="The path where the resulting CSV of results should be stored. Include the file "
@@ -73,10 +254,9 @@ def main():
                                    "of the file (ie Skill_Scores.csv)."
     )
     validate_parser.add_argument(
-        "memory", type=float, help="Indicates the memory that you would like to be allocated on the computer when "
-                                   "running the program. It is highly recommended to be conservative in this number "
-                                   "as slightly more memory may be consumed (maybe up to half a gig in very large "
-                                   "regions)."
+        "memory", type=float, help="Indicates the memory (in GB) that you would like to be allocated on the computer "
+                                   "when running the program. The chunk size is planned from the data types and the "
+                                   "number of dates and corrected with the memory measured on the first chunks."
     )
     validate_parser.add_argument(
         '-sd', '--start_date', type=str, help='(Optional) The starting date of the analysis formatted as YYYY-MM-DD '
@@ -86,28 +266,112 @@ def main():
         '-ed', '--end_date', type=str, help='(Optional) The ending date of the analysis formatted as YYYY-MM-DD (i.e. '
                                             'January 2, 2019 would be 2019-01-02).'
     )
+    validate_parser.add_argument(
+        '--output_format', choices=['csv', 'parquet'], default='csv',
+        help='(Optional) Write the results as CSV (default) or as a Parquet file.'
+    )
+    validate_parser.add_argument(
+        '--state', type=str,
+        help='(Optional) The path to a NetCDF file with the running statistics of the validation. If it exists, only '
+             'the forecasts verified by the start dates that were added to work_dir since the last run are read and '
+             'merged into the statistics. Otherwise it is created from all of the forecasts in work_dir.'
+    )
+    validate_parser.add_argument(
+        '--scheduler', type=str,
+        help='(Optional) Validate the chunks of rivids as blocks of a dask array on a dask scheduler instead of in '
+             'this process. Either "threads", "processes", "synchronous", "distributed" (a LocalCluster on this '
+             'machine) or the address of the scheduler of a dask.distributed cluster (e.g. tcp://10.0.0.1:8786). The '
+             'memory is then set with --rivid_chunk_size.'
+    )
+    validate_parser.add_argument(
+        '--rivid_chunk_size', type=int, default=1000,
+        help='(Optional) The number of rivids in each block when a scheduler is given, 1000 by default.'
+    )
+    validate_parser.add_argument(
+        '--shard', type=parse_shard,
+        help='(Optional) Only validate one of N balanced slices of the rivids, given as i/N with i from 0 to N - 1 '
+             '(e.g. 3/16 for the fourth of sixteen array jobs). The results are written to out_path with the shard in '
+             'the file name (e.g. Skill_Scores.shard-0003-of-0016.csv) and are combined with the merge command.'
+    )
+    validate_parser.add_argument(
+        '--high_res', action='store_true',
+        help='(Optional) Also validate the high resolution forecast in the same pass. Its MAE, MSE, RMSE and Pearson R '
+             'and their persistence skill scores are added as HRES_ columns (empty for forecast days 11 to 15).'
+    )
+    validate_parser.add_argument(
+        '--checkpoint', type=str,
+        help='(Optional) A directory where the results of each chunk of rivids are saved as they are completed. If the '
+             'run is interrupted, running the same command again only computes the remaining chunks. The directory '
+             'is removed when the run finishes.'
+    )
+    validate_parser.add_argument(
+        '--precision', choices=['float64', 'float32'], default='float64',
+        help='(Optional) The floating point precision of the validation, float64 by default. float32 reads the '
+             'flows in half the memory, so about twice as many rivids fit in each chunk, with compensated sums that '
+             'keep the metrics within about five significant digits of float64.'
+    )
     validate_parser.set_defaults(func=validate_cli)
 
+    # Setup merge command
+    merge_parser = subparsers.add_parser(
+        'merge', parents=[common_parser],
+        help='Merges the results of the shards of the validate command into a single file, in the same order as the '
+             'results of a validation without shards.'
+    )
+    merge_parser.add_argument(
+        'out_path', type=str,
+        help='The out_path that was given to the validate command of each shard (e.g. Skill_Scores.csv). The shard '
+             'files must be in the same directory.'
+    )
+    merge_parser.add_argument(
+        '--output_format', choices=['csv', 'parquet'], default='csv',
+        help='(Optional) The format of the shard files, CSV (default) or Parquet.'
+    )
+    merge_parser.add_argument(
+        '--remove', action='store_true',
+        help='(Optional) Delete the shard files once they are merged.'
+    )
+    merge_parser.set_defaults(func=merge_cli)
+
     # Setup extract command
     extract_parser = subparsers.add_parser(
-        'extract',
+        'extract', parents=[common_parser],
         help='Extracts data from a folder with NetCDF forecast files (generated with the compress_netcdf function) '
              'into CSV files in the given path'
     )
     extract_parser.add_argument(
-        'rivid', type=int,
-        help='The rivid (COMID) of the desired stream to extract data for.'
+        'rivids', type=int, nargs='*',
+        help='The rivid (COMID) of the desired stream to extract data for. If more than one rivid is given (or a rivid '
+             'file), the CSV files of each stream are written to a directory named after its rivid in outpath, and '
+             'each forecast file is only read once.'
     )
     extract_parser.add_argument(
         'folder_path', type=str,
-        help='The path to the folder containing the forecast NetCDF files.'
+        help='The path to the folder containing the forecast NetCDF files (or a Zarr archive created with the archive '
+             'command).'
     )
     extract_parser.add_argument(
         'outpath', type=str,
         help='The path to the directory that you would like to write the CSV files to.'
     )
+    extract_parser.add_argument(
+        '-f', '--rivid_file', type=str,
+        help='(Optional) A text file with the rivids to extract data for, separated by whitespace, commas or new lines.'
+    )
+    extract_parser.add_argument(
+        '-w', '--max_workers', type=int, default=1,
+        help='(Optional) The number of worker processes used to read the forecast files at the same time. Defaults '
+             'to 1, which is usually fastest unless the files are on a slow or network file system.'
+    )
+    extract_parser.add_argument(
+        '--output_format', choices=['csv', 'parquet'], default='csv',
+        help='(Optional) Write CSV files (default) or a single Parquet dataset in long format (rivid, start_date, '
+             'lead_day, lead_hour, member, flow) partitioned by the lead time to outpath.'
+    )
     extract_parser.set_defaults(func=extract_cli)
 
     args = parser.parse_args()
 
-    args.func(args)
+    # An empty ExitStack does nothing (contextlib.nullcontext needs Python 3.7)
+    with profiling(args.profile, sys.argv[1:]) if args.profile else ExitStack():
+        args.func(args)
@@ -1,10 +1,33 @@
 import xarray as xr
+import dask
+import dask.array as da
+from dask import delayed
 from pandas import to_datetime, date_range, DateOffset
 import numpy as np
+import glob
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from global_forecast_validation.profiling import stage
 
+# Chunk shapes of the forecast variables suited to the two ways that the compressed files are read: compute_all reads
+# large blocks of rivids with all of the dates and ensembles, while extract_by_rivid reads a single rivid.
+CHUNK_PRESETS = {
+    "validate": {"rivid": 1024, "date": 15, "ensemble_number": 51},
+    "extract": {"rivid": 16, "date": 15, "ensemble_number": 51},
+}
 
-def compress_netcfd(folder_path, out_folder, file_name):
+# The flows are packed into [-PACKING_INT16_MAX, PACKING_INT16_MAX], the lowest int16 value is kept for missing values
+PACKING_INT16_MAX = 32767
+PACKING_FILL_VALUE = -32768
+
+# The largest flow (m^3/s) that can be stored with the log packing, larger flows are clipped
+LOG_PACKING_MAX_FLOW = 1e7
+
+
+def compress_netcfd(folder_path, out_folder, file_name, sort_ensembles=False, store_permutation=False,
+                    max_workers=8, rivid_block_size=None, compression=None, complevel=4, shuffle=True, chunks=None,
+                    pack=None):
     """
     Takes the 52 individual ensembles generated by RAPIDpy and combines them into one compact NetCDF file, saving disk
     space in the process by eliminating the forecasts that aren't daily (the forecasts at 3 hour, 6 hour, etc).
@@ -21,6 +44,58 @@ def compress_netcfd(folder_path, out_folder, file_name):
     file_name: str
         The name of the region. For example, if the files followed the pattern of "Qout_africa_continental_1.nc,
         this argument would be "Qout_africa_continental"
+
+    sort_ensembles: bool
+        If True, the ensemble members are stored sorted in ascending order along the ensemble_number dimension for
+        each rivid and date. The file is then flagged with the "ensembles_sorted" attribute so that the validation
+        does not have to sort the members again every time it is run. Defaults to False.
+
+    store_permutation: bool
+        Only used if sort_ensembles is True. If True, an "ensemble_permutation" variable is also stored which contains
+        the original ensemble number of each of the sorted members so that the member identity can be recovered.
+        Defaults to False.
+
+    max_workers: int
+        The maximum number of worker processes used to read the forecast files at the same time. Only the daily time
+        steps are read from each of the files. If set to 1, the files are read one after another in this process.
+        Defaults to 8.
+
+    rivid_block_size: int
+        If given, the forecasts are read and written to the compressed file in blocks of this many rivids, so that the
+        peak memory is bounded by the block size instead of the size of the stream network. Recommended for continental
+        and global networks. The resulting file is identical. By default the whole network is read at once.
+
+    compression: str
+        The compression used for the forecast variables, either "zlib" or "zstd". zstd requires a netCDF-C library
+        built with zstd support and a version of xarray (2024 or later) that passes the compression on to netCDF4. By
+        default the variables are not compressed.
+
+    complevel: int
+        The compression level (1-9 for zlib, 1-22 for zstd). Defaults to 4.
+
+    shuffle: bool
+        If True (default), the shuffle filter is applied before compressing.
+
+    chunks: str or dict
+        The chunk shape of the forecast variables on disk. Either a dictionary with the chunk size along the "rivid",
+        "date" and "ensemble_number" dimensions (dimensions that are left out are not split) or the name of a preset:
+        "validate" for files that are mostly read by compute_all or "extract" for files that are mostly read by
+        extract_by_rivid. When used with rivid_block_size, the block size should be a multiple of the rivid chunk size.
+        By default the netCDF library chooses the layout.
+
+    pack: str
+        If given, Qout, Qout_high_res and the initialization values are stored (lossily) as 16 bit integers with CF
+        scale_factor and add_offset attributes, which halves the size of the file. Either "linear", which spreads the
+        flows evenly over the whole int16 range between the smallest and largest flow in the file, or "log", which
+        packs log(1 + flow) so that the error stays below about 0.0125% of (1 + flow) and low flows keep their
+        precision (flows above 1e7 m^3/s are clipped). The maximum reconstruction error that the packing introduced is
+        printed. Only "log" can be used with rivid_block_size. By default the flows are stored as 32 bit floats.
+
+        .. warning::
+            The log packing is not part of the CF conventions. The scale factor and offset are decoded automatically
+            when the files are opened with xarray (or netCDF4), but the values are then still log(1 + flow), which
+            is only flagged by the "transform" attribute ("log1p") of the variables. The functions of this package
+            undo it (see unpack_flows), other readers must apply numpy.expm1 themselves.
     """
 
     # Based on 15 day forecast
@@ -30,73 +105,479 @@ def compress_netcfd(folder_path, out_folder, file_name):
     # Excluding the first day because we already have initialization from the normal forecasts
     high_res_forecast_day_indices = np.array([24, 48, 72, 92, 100, 108, 112, 116, 120, 124])
 
-    # Getting the number of rivids and start date
+    # Getting the number of rivids, start date and the initialization values
     tmp_file = os.path.join(folder_path, "{}_{}.nc".format(file_name, 1))
     tmp_dataset = xr.open_dataset(tmp_file)
 
     start_datetime = to_datetime(tmp_dataset["time"].values[0])
     num_of_rivids = tmp_dataset['rivid'].size
 
+    initialization = tmp_dataset["Qout"].isel(time=forecast_day_indices[0]).values.astype(np.float32)
+    rivids = tmp_dataset['rivid'].data
+    lat = tmp_dataset['lat'].data
+    lon = tmp_dataset['lon'].data
+    z = tmp_dataset['z'].data
+
     tmp_dataset.close()
 
     dates = date_range(start_datetime + DateOffset(1), periods=15)
     high_res_dates = date_range(start_datetime + DateOffset(1), periods=10)
 
+    if pack == "linear" and rivid_block_size is not None:
+        raise ValueError("The linear packing needs all of the flows at once, use pack='log' with rivid_block_size.")
+
+    start_date_string = start_datetime.strftime("%Y%m%d")
+
+    # The file is written under a temporary name and only renamed once it is complete, so that a run that is killed
+    # while writing does not leave a truncated YYYYMMDD.nc behind that compress_netcfd_batch would skip
+    out_file = os.path.join(out_folder, '{}.nc'.format(start_date_string))
+    tmp_out_file = "{}.{}.tmp".format(out_file, os.getpid())
+
+    # The netCDF library is not thread safe, so the files are read concurrently in separate processes. The pool is shut
+    # down even if reading a file fails, so that compress_netcfd_batch does not leak its workers.
+    executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+
+    try:
+        if rivid_block_size is None:
+            block = read_rivid_block(
+                folder_path, file_name, 0, num_of_rivids, forecast_day_indices[1:], high_res_forecast_day_indices,
+                sort_ensembles, executor
+            )
+            ensembles, high_res_forecast_data, permutation = block
+
+        else:
+            # Each block of rivids is only read when it is written to the file, so only one block is held in memory
+            list_of_ensemble_blocks = []
+            list_of_high_res_blocks = []
+            list_of_permutation_blocks = []
+
+            for start_rivid in range(0, num_of_rivids, rivid_block_size):
+                end_rivid = min(start_rivid + rivid_block_size, num_of_rivids)
+                block_size = end_rivid - start_rivid
+
+                block = delayed(read_rivid_block, pure=False, nout=3)(
+                    folder_path, file_name, start_rivid, end_rivid, forecast_day_indices[1:],
+                    high_res_forecast_day_indices, sort_ensembles, executor
+                )
+
+                list_of_ensemble_blocks.append(da.from_delayed(block[0], (block_size, 15, 51), np.float32))
+                list_of_high_res_blocks.append(da.from_delayed(block[1], (block_size, 10), np.float32))
+                list_of_permutation_blocks.append(da.from_delayed(block[2], (block_size, 15, 51), np.uint8))
+
+            ensembles = da.concatenate(list_of_ensemble_blocks)
+            high_res_forecast_data = da.concatenate(list_of_high_res_blocks)
+            permutation = da.concatenate(list_of_permutation_blocks)
+
+        flows = {"Qout": ensembles, "Qout_high_res": high_res_forecast_data, "initialization_values": initialization}
+        flow_attributes = {name: {} for name in flows}
+        packing_encoding = {}
+        packing_errors = {}
+
+        if pack is not None:
+            for name, values in flows.items():
+                flows[name], flow_attributes[name], packing_encoding[name] = pack_flows(values, pack)
+                packing_errors[name] = packing_error(
+                    values, flows[name], pack, packing_encoding[name]["scale_factor"],
+                    packing_encoding[name]["add_offset"]
+                )
+
+        data_variables = {
+            "Qout": (['rivid', 'date', 'ensemble_number'], flows["Qout"], flow_attributes["Qout"]),
+            "Qout_high_res": (['rivid', 'date_high_res'], flows["Qout_high_res"], flow_attributes["Qout_high_res"])
+        }
+        attributes = {}
+
+        if sort_ensembles:
+            attributes["ensembles_sorted"] = 1
+
+            if store_permutation:
+                data_variables["ensemble_permutation"] = (['rivid', 'date', 'ensemble_number'], permutation)
+
+        coords = {
+            'rivid': rivids,
+            'date': dates,
+            'date_high_res': high_res_dates,
+            'ensemble_number': np.arange(1, 52, dtype=np.uint8),
+            'initialization_values': (
+                'rivid', flows["initialization_values"], flow_attributes["initialization_values"]
+            ),
+            'lat': ('rivid', lat),
+            'lon': ('rivid', lon),
+            'z': ('rivid', z),
+            'start_date': start_datetime
+        }
+
+        xarray_dataset = xr.Dataset(data_variables, coords, attributes)
+
+        encoding = forecast_encoding(xarray_dataset, compression, complevel, shuffle, chunks)
+        for name, variable_encoding in packing_encoding.items():
+            encoding.setdefault(name, {}).update(variable_encoding)
+
+        # The blocks are computed one after another so that the memory is bounded by the block size, the packing
+        # errors are computed in the same pass
+        with dask.config.set(scheduler="synchronous"):
+            write = xarray_dataset.to_netcdf(path=tmp_out_file, format='NETCDF4', encoding=encoding, compute=False)
+            # Includes reading the blocks of rivids when rivid_block_size is given
+            with stage("write_file", rivid_days=num_of_rivids):
+                _, packing_errors = dask.compute(write, packing_errors)
+        os.replace(tmp_out_file, out_file)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if os.path.exists(tmp_out_file):
+            os.remove(tmp_out_file)
+
+    for name, error in packing_errors.items():
+        print("Maximum reconstruction error from packing {}: {:.6g} m^3/s".format(name, error))
+
+
+def pack_flows(flows, pack):
+    """
+    Prepares flows to be stored as 16 bit integers with a CF scale_factor and add_offset.
+
+    Parameters
+    ----------
+
+    flows: ndarray or dask array
+        The flows to pack.
+
+    pack: str
+        Either "linear" or "log" (see compress_netcfd).
+
+    Returns
+    -------
+    tuple
+        The flows to write (log(1 + flow) for the log packing), the attributes of the variable and its encoding.
+    """
+    # The range of the flows is mapped to the whole range of the integers, [-PACKING_INT16_MAX, PACKING_INT16_MAX]
+    if pack == "linear":
+        min_flow, max_flow = float(np.nanmin(flows)), float(np.nanmax(flows))
+        attributes = {}
+    elif pack == "log":
+        flows = np.log1p(np.clip(flows, 0, LOG_PACKING_MAX_FLOW))
+        min_flow, max_flow = 0., float(np.log1p(LOG_PACKING_MAX_FLOW))
+        attributes = {
+            "transform": "log1p",
+            "comment": "The values are log(1 + flow), the flows (m^3/s) are numpy.expm1 of the values (see "
+                       "global_forecast_validation.compress_netcdf.unpack_flows)",
+        }
+    else:
+        raise ValueError("The packing must be either 'linear' or 'log'.")
+
+    if not np.isfinite(min_flow):  # Only missing values
+        min_flow, max_flow = 0., 0.
+    scale_factor = (max_flow - min_flow) / (2 * PACKING_INT16_MAX) or 1.
+    add_offset = (max_flow + min_flow) / 2
+
+    encoding = {
+        "dtype": "int16", "scale_factor": np.float32(scale_factor), "add_offset": np.float32(add_offset),
+        "_FillValue": np.int16(PACKING_FILL_VALUE)
+    }
+
+    return flows, attributes, encoding
+
+
+def packing_error(flows, packed_flows, pack, scale_factor, add_offset=0.):
+    """Computes the maximum absolute difference between the flows and the flows after they are packed and decoded."""
+    packed_integers = np.clip(
+        np.round((packed_flows - add_offset) / scale_factor), -PACKING_INT16_MAX, PACKING_INT16_MAX
+    )
+    decoded_flows = packed_integers * scale_factor + add_offset
+    if pack == "log":
+        decoded_flows = np.expm1(decoded_flows)
+
+    return np.nanmax(np.abs(decoded_flows - flows))
+
+
+def unpack_flows(data_array):
+    """
+    Returns the flows in a DataArray opened from a compressed forecast file, undoing the log packing if it was used
+    (see the pack option of compress_netcfd). The scale factor and offset of the packing are decoded by xarray itself,
+    but not the log transform, so the flows of the files must always be read through this function.
+
+    Parameters
+    ----------
+
+    data_array: xarray.DataArray
+        One of Qout, Qout_high_res or initialization_values.
+
+    Returns
+    -------
+    ndarray or dask array
+        The flows (m^3/s).
+    """
+    flows = data_array.data
+    if data_array.attrs.get("transform") == "log1p":
+        flows = np.expm1(flows)
+
+    return flows
+
+
+def forecast_encoding(dataset, compression=None, complevel=4, shuffle=True, chunks=None):
+    """
+    Creates the NetCDF encoding of the forecast variables (Qout, Qout_high_res and ensemble_permutation) in a dataset.
+
+    Parameters
+    ----------
+
+    dataset: xarray.Dataset
+        The dataset to be written.
+
+    compression: str
+        Either "zlib", "zstd" or None for no compression.
+
+    complevel: int
+        The compression level.
+
+    shuffle: bool
+        Whether the shuffle filter is applied before compressing.
+
+    chunks: str or dict
+        The chunk sizes along each dimension or the name of one of the CHUNK_PRESETS.
+
+    Returns
+    -------
+    dict
+        The encoding of each of the forecast variables.
+    """
+    if isinstance(chunks, str):
+        try:
+            chunks = CHUNK_PRESETS[chunks]
+        except KeyError:
+            raise ValueError("The chunk preset must be one of {}.".format(", ".join(CHUNK_PRESETS)))
+
+    encoding = {}
+    for name in ["Qout", "Qout_high_res", "ensemble_permutation"]:
+        if name not in dataset:
+            continue
+
+        variable_encoding = {}
+
+        if compression == "zlib":
+            variable_encoding.update(zlib=True, complevel=complevel, shuffle=shuffle)
+        elif compression is not None:
+            variable_encoding.update(compression=compression, complevel=complevel, shuffle=shuffle)
+
+        if chunks is not None:
+            variable_encoding["chunksizes"] = tuple(
+                # The high res dates are chunked like the dates of the ensembles
+                min(chunks.get("date" if dim == "date_high_res" else dim, size), size)
+                for dim, size in zip(dataset[name].dims, dataset[name].shape)
+            )
+
+        encoding[name] = variable_encoding
+
+    return encoding
+
+
+def compress_netcfd_batch(root_folder, out_folder, file_name, processes=None, overwrite=False, **kwargs):
+    """
+    Compresses the forecasts of many forecast dates in parallel. The root folder must contain one folder per forecast
+    date with the 52 ensemble forecast files generated by RAPIDpy. Each of the folders is compressed with
+    compress_netcfd in a pool of processes, and the forecast dates that already have a valid compressed file in the
+    output folder are skipped. The compressed files only get their final name once they are completely written, so a
+    batch that was interrupted can be run again to compress the remaining dates.
+
+    Parameters
+    ----------
+
+    root_folder: str
+        The path to the folder containing one folder of 52 ensemble forecast files per forecast date.
+
+    out_folder: str
+        The path to the folder that you want the compact NetCDF files in.
+
+    file_name: str
+        The name of the region. For example, if the files followed the pattern of "Qout_africa_continental_1.nc,
+        this argument would be "Qout_africa_continental"
+
+    processes: int
+        The number of processes used to compress the forecast dates. Defaults to the number of CPUs.
+
+    overwrite: bool
+        If True, the forecast dates are compressed again even if a valid compressed file already exists. Defaults to
+        False.
+
+    kwargs:
+        Any other keyword arguments are passed on to compress_netcfd. Because the dates are already compressed in
+        parallel, max_workers defaults to 1 here.
+
+    Returns
+    -------
+    dict
+        A dictionary with the forecast date strings (YYYYMMDD) as keys and the time taken to compress them in seconds
+        as values (None for the dates that were skipped).
+    """
+    folders = sorted(
+        os.path.join(root_folder, i) for i in os.listdir(root_folder)
+        if os.path.isfile(os.path.join(root_folder, i, "{}_1.nc".format(file_name)))
+    )
+
+    kwargs.setdefault("max_workers", 1)
+
+    timings = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {}
+
+        for folder in folders:
+            start_date_string = read_start_date(folder, file_name).strftime("%Y%m%d")
+            out_file = os.path.join(out_folder, "{}.nc".format(start_date_string))
+
+            if not overwrite and is_valid_compressed_file(out_file):
+                print("{}: Skipped, already compressed".format(start_date_string))
+                timings[start_date_string] = None
+                continue
+
+            # The temporary files of an earlier run of the date that was killed while writing
+            for stale_file in glob.glob(glob.escape(out_file) + ".*.tmp"):
+                os.remove(stale_file)
+
+            futures[executor.submit(timed_compress_netcfd, folder, out_folder, file_name, **kwargs)] = \
+                start_date_string
+
+        for future in as_completed(futures):
+            start_date_string = futures[future]
+
+            try:
+                timings[start_date_string] = future.result()
+                print("{}: Compressed in {:.2f} s".format(start_date_string, timings[start_date_string]))
+            except Exception as e:
+                print("{}: Failed ({})".format(start_date_string, e))
+
+    return timings
+
+
+def timed_compress_netcfd(folder_path, out_folder, file_name, **kwargs):
+    """Runs compress_netcfd and returns the time that it took in seconds."""
+    start = time.time()
+    compress_netcfd(folder_path, out_folder, file_name, **kwargs)
+    return time.time() - start
+
+
+def read_start_date(folder_path, file_name):
+    """Reads the start date of the forecast from the first ensemble file in the folder."""
+    with xr.open_dataset(os.path.join(folder_path, "{}_1.nc".format(file_name))) as ds:
+        return to_datetime(ds["time"].values[0])
+
+
+def is_valid_compressed_file(file):
+    """Checks that a file exists and can be read as a file created with compress_netcfd."""
+    if not os.path.isfile(file):
+        return False
+
+    try:
+        with xr.open_dataset(file) as ds:
+            return (
+                ds["Qout"].dims == ('rivid', 'date', 'ensemble_number') and ds["Qout"].shape[1:] == (15, 51)
+                and ds["Qout_high_res"].dims == ('rivid', 'date_high_res') and ds["Qout_high_res"].shape[1] == 10
+                and ds["initialization_values"].size == ds["rivid"].size
+            )
+    except Exception:
+        return False
+
+
+def read_rivid_block(folder_path, file_name, start_rivid, end_rivid, forecast_day_indices,
+                     high_res_forecast_day_indices, sort_ensembles=False, executor=None):
+    """
+    Reads the daily forecasts for a block of rivids from the 51 ensemble files and the high res file.
+
+    Parameters
+    ----------
+
+    folder_path: str
+        The path to the folder containing the 52 ensemble forecast files in NetCDF format
+
+    file_name: str
+        The name of the region (see compress_netcfd).
+
+    start_rivid: int
+        The index of the first rivid in the block.
+
+    end_rivid: int
+        The index after the last rivid in the block.
+
+    forecast_day_indices: 1D ndarray
+        The time indices of the 15 daily forecasts in the ensemble files.
+
+    high_res_forecast_day_indices: 1D ndarray
+        The time indices of the 10 daily forecasts in the high res file.
+
+    sort_ensembles: bool
+        If True, the ensemble members are sorted in ascending order.
+
+    executor: concurrent.futures.Executor
+        The pool of processes used to read the files concurrently. If None, the files are read one after another.
+
+    Returns
+    -------
+    tuple of ndarrays
+        The ensembles (rivid x 15 x 51), the high res forecasts (rivid x 10) and the original ensemble numbers of the
+        members (rivid x 15 x 51, only if sort_ensembles is True, else None).
+    """
+    num_of_rivids = end_rivid - start_rivid
+    rivid_slice = slice(start_rivid, end_rivid)
+
     # Ensemble Dimensions
     #  1) Rivid
     #  2) Number of forecast days (i.e. 15 in a 15 day forecast)
     #  3) Number of ensembles
     ensembles = np.zeros((num_of_rivids, 15, 51), dtype=np.float32)
-    initialization = np.zeros((num_of_rivids,), dtype=np.float32)
-
-    for forecast_number in range(1, 52):
-        file = os.path.join(folder_path, "{}_{}.nc".format(file_name, forecast_number))
+    high_res_forecast_data = np.zeros((num_of_rivids, 10), dtype=np.float32)
 
-        tmp_dataset = xr.open_dataset(file)
-        streamflow = tmp_dataset['Qout'].data
-        streamflow = streamflow[:, forecast_day_indices]
+    # The 51 ensembles and the high res forecast, each is written into its slice of the preallocated arrays
+    reads = [
+        (os.path.join(folder_path, "{}_{}.nc".format(file_name, forecast_number)), forecast_day_indices,
+         ensembles[:, :, forecast_number - 1])
+        for forecast_number in range(1, 52)
+    ]
+    reads.append((os.path.join(folder_path, "{}_52.nc".format(file_name)), high_res_forecast_day_indices,
+                  high_res_forecast_data))
 
-        if forecast_number == 1:
-            initialization[:] = streamflow[:, 0]
-            rivids = tmp_dataset['rivid'].data
-            lat = tmp_dataset['lat'].data
-            lon = tmp_dataset['lon'].data
-            z = tmp_dataset['z'].data
+    with stage("read_rivid_block", start_rivid, ensembles.nbytes + high_res_forecast_data.nbytes, num_of_rivids):
+        if executor is None:
+            for file, time_indices, out in reads:
+                out[...] = read_time_indices(file, time_indices, rivid_slice)
+        else:
+            futures = {
+                executor.submit(read_time_indices, file, time_indices, rivid_slice): out
+                for file, time_indices, out in reads
+            }
+            for future in as_completed(futures):
+                futures[future][...] = future.result()  # Raises any exception that happened in the worker
 
-        ensembles[:, :, forecast_number - 1] = streamflow[:, 1:]
+    permutation = None
+    if sort_ensembles:
+        with stage("sort_ensembles", start_rivid, rivid_days=num_of_rivids):
+            permutation = np.argsort(ensembles, axis=2, kind="stable")
+            ensembles = np.take_along_axis(ensembles, permutation, axis=2)
+            permutation = (permutation + 1).astype(np.uint8)
 
-        tmp_dataset.close()
+    return ensembles, high_res_forecast_data, permutation
 
-    # High Res Forecast
-    file = os.path.join(folder_path, "{}_52.nc".format(file_name))
 
-    tmp_dataset = xr.open_dataset(file)
+def read_time_indices(file, time_indices, rivid_slice=slice(None)):
+    """
+    Reads only the given time steps of the Qout variable in a RAPID output file.
 
-    high_res_forecast_data = tmp_dataset["Qout"].data
-    high_res_forecast_data = high_res_forecast_data[:, high_res_forecast_day_indices]
+    Parameters
+    ----------
 
-    tmp_dataset.close()
+    file: str
+        The path to the RAPID output file in NetCDF format.
 
-    data_variables = {
-        "Qout": (['rivid', 'date', 'ensemble_number'], ensembles),
-        "Qout_high_res": (['rivid', 'date_high_res'], high_res_forecast_data)
-    }
+    time_indices: 1D ndarray
+        The indices along the time dimension that should be read.
 
-    coords = {
-        'rivid': rivids,
-        'date': dates,
-        'date_high_res': high_res_dates,
-        'ensemble_number': np.arange(1, 52, dtype=np.uint8),
-        'initialization_values': ('rivid', initialization),
-        'lat': ('rivid', lat),
-        'lon': ('rivid', lon),
-        'z': ('rivid', z),
-        'start_date': start_datetime
-    }
+    rivid_slice: slice
+        The slice of rivids to read, all of the rivids are read by default.
 
-    xarray_dataset = xr.Dataset(data_variables, coords)
-    start_date_string = start_datetime.strftime("%Y%m%d")
-    xarray_dataset.to_netcdf(path=os.path.join(out_folder, '{}.nc'.format(start_date_string)), format='NETCDF4')
+    Returns
+    -------
+    2D ndarray
+        The flows with the dimensions rivid x time_indices.
+    """
+    with xr.open_dataset(file) as ds:
+        return ds["Qout"].isel(rivid=rivid_slice, time=time_indices).transpose("rivid", "time").values
 
 
 if __name__ == "__main__":
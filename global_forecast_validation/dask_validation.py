@@ -0,0 +1,199 @@
+import xarray as xr
+import numba as nb
+import numpy as np
+import threading
+import dask
+import dask.array as da
+from contextlib import contextmanager
+from global_forecast_validation.compress_netcdf import unpack_flows
+from global_forecast_validation.validate_forecasts import forecast_files, numba_calculate_metrics, results_frame, \
+    results_writer
+from global_forecast_validation.zarr_archive import is_zarr_archive, open_zarr_archive
+from global_forecast_validation.profiling import stage
+
+# Only one kernel runs at a time in each process, the kernel is already parallel and the workqueue threading layer of
+# Numba does not support launching parallel kernels from several threads at once
+KERNEL_LOCK = threading.Lock()
+
+
+def compute_all_dask(work_dir, out_path, scheduler="threads", rivid_chunk_size=1000, starting_date=None,
+                     ending_date=None, output_format="csv"):
+    """
+    Computes the same forecast metrics as compute_all, but as a blockwise dask operation over the stacked forecasts
+    and initialization values, with one block for each chunk of rivids. The blocks are read and validated by the
+    workers of the given dask scheduler, so that the validation can use several processes or several machines. The
+    results are written to the output file in the order of the rivids as the blocks are completed.
+
+    Parameters
+    ----------
+
+    work_dir: str
+        The directory that contains all of the forecast files that were created with the compress_netcdf function (or
+        a Zarr archive created with append_to_zarr_archive). The start dates must be consecutive daily values.
+
+    out_path: str
+        The path where the resulting CSV (or Parquet file) of results should be stored.
+
+    scheduler: str
+        The dask scheduler to use. Either "threads" (default), "processes" or "synchronous" for the schedulers of dask,
+        "distributed" to start a dask.distributed LocalCluster on this machine, or the address of the scheduler of an
+        existing dask.distributed cluster (e.g. "tcp://10.0.0.1:8786"), in which case the workers must be able to read
+        work_dir at the same path. The Numba kernel is itself parallel, so to avoid running more threads than there are
+        cores, each worker process runs one kernel at a time with as many threads as it has cores: with "threads" one
+        kernel uses all of the cores, with "processes" each process uses its share of the cores and with a
+        dask.distributed cluster each worker uses as many threads as it has dask threads (see dask_scheduler).
+
+    rivid_chunk_size: int
+        The number of rivids in each block. The memory used by each worker is about the size of the forecasts of one
+        block (3 kB per rivid and start date with 32 bit forecasts) times the number of blocks that it works on at the
+        same time.
+
+    starting_date: str
+        The starting date of the analysis formatted as YYYY-MM-DD (i.e. January 2, 2019 would be 2019-01-02).
+
+    ending_date: str
+        The ending date of the analysis formatted as YYYY-MM-DD (i.e. January 2, 2019 would be 2019-01-02).
+
+    output_format: str
+        Either "csv" (default) or "parquet".
+    """
+    big_dask_q_array, big_dask_init_array, rivids, presorted = open_forecast_arrays(
+        work_dir, starting_date, ending_date, rivid_chunk_size
+    )
+    rivid_array = da.from_array(rivids, chunks=(big_dask_q_array.chunks[1],))
+
+    with dask_scheduler(scheduler) as compute_kwargs, results_writer(out_path, output_format) as write_results:
+        # Forecast day x metric for each rivid, the start dates and ensemble members of each block are contracted
+        results = da.blockwise(
+            metrics_block, "rdk",
+            big_dask_q_array, "trdm",
+            big_dask_init_array, "tr",
+            rivid_array, "r",
+            presorted=presorted,
+            num_threads=compute_kwargs.pop("kernel_threads"),
+            new_axes={"k": 15},
+            concatenate=True,
+            dtype=np.float32,
+        )
+
+        # Computing a few blocks at a time so that the results do not have to be held in memory all at once
+        blocks = results.to_delayed().ravel()
+        block_starts = np.cumsum((0,) + big_dask_q_array.chunks[1])
+        batch_size = max(1, 2 * compute_kwargs.pop("num_workers"))
+
+        for start_block in range(0, blocks.size, batch_size):
+            end_block = min(start_block + batch_size, blocks.size)
+            rivid_days = (block_starts[end_block] - block_starts[start_block]) * big_dask_q_array.shape[0]
+
+            # Reading and computing the blocks on the workers of the scheduler
+            with stage("compute_blocks", block_starts[start_block], rivid_days=rivid_days):
+                block_results = dask.compute(*blocks[start_block:end_block], **compute_kwargs)
+
+            for block, block_result in enumerate(block_results, start_block):
+                rivids_chunk = rivids[block_starts[block]:block_starts[block + 1]]
+                with stage("write_results", block_starts[block]):
+                    write_results(results_frame(np.transpose(block_result, (1, 0, 2)), rivids_chunk))
+
+    print("Finished")
+
+
+def metrics_block(forecast_block, init_block, rivid_block, presorted=False, num_threads=None):
+    """
+    Computes the metrics of a block of rivids (rivid x forecast day x metric) with numba_calculate_metrics, using
+    num_threads threads (by default the number of threads of Numba, i.e. the number of cores).
+    """
+    forecast_block = np.ascontiguousarray(forecast_block)
+    init_block = np.ascontiguousarray(init_block)
+
+    with KERNEL_LOCK:
+        # The number of threads of Numba is set for the thread that launches the kernel
+        if num_threads is not None:
+            nb.set_num_threads(max(1, min(num_threads, nb.config.NUMBA_NUM_THREADS)))
+
+        results_array = numba_calculate_metrics(
+            forecast_block, init_block, forecast_block.shape[0], forecast_block.shape[1], forecast_block.shape[2],
+            rivid_block, presorted
+        )
+
+    return np.transpose(results_array, (1, 0, 2))
+
+
+def open_forecast_arrays(work_dir, starting_date=None, ending_date=None, rivid_chunk_size=1000):
+    """
+    Opens the forecasts (start date x rivid x forecast day x ensemble) and the initialization values (start date x
+    rivid) of a directory of compressed forecast files or of a Zarr archive as dask arrays chunked along the rivids.
+
+    Returns
+    -------
+    tuple
+        The forecasts, the initialization values, the rivids and whether the ensembles are stored sorted.
+    """
+    if is_zarr_archive(work_dir):
+        archive = open_zarr_archive(work_dir, starting_date, ending_date)
+
+        if np.any(np.diff(archive["start_date"].values) != np.timedelta64(1, "D")):
+            raise ValueError("The start dates in the archive must be consecutive daily values.")
+
+        big_dask_q_array = unpack_flows(archive["Qout"]).rechunk({0: -1, 1: rivid_chunk_size, 2: -1, 3: -1})
+        big_dask_init_array = unpack_flows(archive["initialization_values"]).rechunk({0: -1, 1: rivid_chunk_size})
+        presorted = bool(archive.attrs.get("ensembles_sorted", 0))
+        rivids = archive["rivid"].values
+
+        return big_dask_q_array, big_dask_init_array, rivids, presorted
+
+    list_of_dask_q_arrays = []
+    list_of_dask_init_arrays = []
+    presorted = True  # True if the ensembles are stored sorted in all of the files (see compress_netcdf)
+
+    for file in forecast_files(work_dir, starting_date, ending_date):
+        ds = xr.open_dataset(file, chunks={"rivid": rivid_chunk_size})
+        presorted = presorted and bool(ds.attrs.get("ensembles_sorted", 0))
+
+        list_of_dask_q_arrays.append(unpack_flows(ds["Qout"]))
+        list_of_dask_init_arrays.append(unpack_flows(ds["initialization_values"]))
+        rivids = ds["rivid"].values
+
+        ds.close()
+
+    big_dask_q_array = da.stack(list_of_dask_q_arrays)
+    big_dask_init_array = da.stack(list_of_dask_init_arrays)
+
+    return big_dask_q_array, big_dask_init_array, rivids, presorted
+
+
+@contextmanager
+def dask_scheduler(scheduler):
+    """
+    Yields the keyword arguments of dask.compute for the given scheduler (see compute_all_dask), the number of workers
+    ("num_workers") and the number of threads of the Numba kernel in each worker process ("kernel_threads", None for
+    all of the cores), starting and closing a dask.distributed client if needed.
+
+    The kernels of a process run one at a time (see KERNEL_LOCK), so a process can give all of its cores to the kernel:
+    all of the cores of the machine with the threads and synchronous schedulers, its share of them with the processes
+    scheduler and, in a dask.distributed cluster, as many as the worker has dask threads (a LocalCluster splits the
+    cores of the machine between the threads of its workers).
+    """
+    if scheduler in ("threads", "processes", "synchronous"):
+        num_workers = 1 if scheduler == "synchronous" else dask.system.CPU_COUNT
+        kernel_threads = max(1, dask.system.CPU_COUNT // num_workers) if scheduler == "processes" else None
+        yield {"scheduler": scheduler, "num_workers": num_workers, "kernel_threads": kernel_threads}
+        return
+
+    from dask.distributed import Client, LocalCluster
+
+    if scheduler == "distributed":
+        cluster = LocalCluster()
+        client = Client(cluster)
+    else:
+        cluster = None
+        client = Client(scheduler)
+
+    try:
+        worker_threads = client.nthreads().values()
+        num_workers = max(1, sum(worker_threads))
+        kernel_threads = max(1, min(worker_threads, default=1))
+        yield {"scheduler": client.get, "num_workers": num_workers, "kernel_threads": kernel_threads}
+    finally:
+        client.close()
+        if cluster is not None:
+            cluster.close()
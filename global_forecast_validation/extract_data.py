@@ -1,11 +1,19 @@
 import xarray as xr
-import dask.array as da
+import netCDF4
 import pandas as pd
 import numpy as np
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import get_context
+from global_forecast_validation.compress_netcdf import unpack_flows
+from global_forecast_validation.parquet_output import write_forecasts_parquet
+from global_forecast_validation.zarr_archive import is_zarr_archive, open_zarr_archive
+from global_forecast_validation.profiling import stage
 
 
-def extract_by_rivid(rivid, folder_path, outpath):
+def extract_by_rivid(rivid, folder_path, outpath, max_workers=1, output_format="csv"):
     """
     Extracts data from a folder with NetCDF forecast files (generated with the compress_netcdf function) into CSV files
     in the given path. The CSV files are named 1_Day_Forecasts, 2_Day_Forecasts, etc. The initialization values (water
@@ -18,61 +26,232 @@ def extract_by_rivid(rivid, folder_path, outpath):
         The rivid (COMID) of the desired stream to extract data for.
 
     folder_path: str
-        The path to the folder containing the forecast NetCDF files (NetCDF files MUST be formatted as YYYYMMDD.nc).
+        The path to the folder containing the forecast NetCDF files (NetCDF files MUST be formatted as YYYYMMDD.nc), or
+        to a Zarr archive created with append_to_zarr_archive.
 
     outpath: str
         The path to the directory that you would like to write the CSV files to.
+
+    max_workers: int
+        The maximum number of worker processes used to read the forecast files at the same time. Only the values of
+        the requested stream are read from each file, so by default (1) the files are read one after the other, which
+        is usually fastest unless the files are on a slow or network file system. Not used with a Zarr archive.
+
+    output_format: str
+        Either "csv" (default) for the CSV files described above, or "parquet" to write a single Parquet dataset to
+        outpath in long format (see write_forecasts_parquet), partitioned by the lead time.
+
+    Notes
+    -----
+    If the files were compressed with sorted ensembles and the permutation was stored (see the sort_ensembles and
+    store_permutation options of compress_netcfd), the ensemble members are written in their original order.
     """
+    check_output_format(output_format)
 
-    files = sorted([os.path.join(folder_path, i) for i in os.listdir(folder_path)])
-    ensemble_columns = ["Ensemble_{}".format(i) for i in range(51)]
+    with stage("read_rivids") as counters:
+        dates_pandas, init_data, q_data, q_high_res_data = read_rivids(folder_path, [rivid], max_workers)
+        counters["bytes_read"] = init_data.nbytes + q_data.nbytes + q_high_res_data.nbytes
+        counters["rivid_days"] = init_data.size
+
+    with stage("write_" + output_format, rivid_days=init_data.size):
+        if output_format == "parquet":
+            write_rivids_parquet(outpath, dates_pandas, [rivid], init_data, q_data, q_high_res_data)
+        else:
+            write_rivid_csvs(outpath, dates_pandas, init_data[:, 0], q_data[:, 0], q_high_res_data[:, 0])
+
+
+def extract_by_rivids(rivids, folder_path, outpath, max_workers=1, output_format="csv"):
+    """
+    Extracts the data of many streams at once from a folder with NetCDF forecast files (generated with the
+    compress_netcdf function). Each forecast file is only read once, no matter how many streams are requested. The CSV
+    files of each stream are the same as the ones created by extract_by_rivid and are written to a directory named
+    after the rivid in the given path (e.g. outpath/192451/1_Day_Forecasts.csv).
+
+    Parameters
+    ----------
+
+    rivids: list of int
+        The rivids (COMIDs) of the desired streams to extract data for.
+
+    folder_path: str
+        The path to the folder containing the forecast NetCDF files (NetCDF files MUST be formatted as YYYYMMDD.nc), or
+        to a Zarr archive created with append_to_zarr_archive.
+
+    outpath: str
+        The path to the directory that you would like to write the directories of CSV files to.
+
+    max_workers: int
+        The maximum number of worker processes used to read the forecast files at the same time. Only the values of
+        the requested streams are read from each file, so by default (1) the files are read one after the other, which
+        is usually fastest unless the files are on a slow or network file system. Not used with a Zarr archive.
+
+    output_format: str
+        Either "csv" (default) for the CSV files described above, or "parquet" to write a single Parquet dataset to
+        outpath in long format (see write_forecasts_parquet), partitioned by the lead time. All of the streams are
+        written to the same dataset.
+
+    Notes
+    -----
+    The flows of all of the requested streams are held in memory before they are written, which takes about 3.3 kB
+    per stream and start date (816 single precision values).
+    """
+    check_output_format(output_format)
+
+    rivids = list(dict.fromkeys(int(rivid) for rivid in rivids))  # Removing duplicates, keeping the order
+
+    with stage("read_rivids") as counters:
+        dates_pandas, init_data, q_data, q_high_res_data = read_rivids(folder_path, rivids, max_workers)
+        counters["bytes_read"] = init_data.nbytes + q_data.nbytes + q_high_res_data.nbytes
+        counters["rivid_days"] = init_data.size
+
+    if output_format == "parquet":
+        with stage("write_parquet", rivid_days=init_data.size):
+            write_rivids_parquet(outpath, dates_pandas, rivids, init_data, q_data, q_high_res_data)
+        return
+
+    for i, rivid in enumerate(rivids):
+        rivid_outpath = os.path.join(outpath, str(rivid))
+        if not os.path.exists(rivid_outpath):
+            os.mkdir(rivid_outpath)
+
+        with stage("write_csv", rivid_days=init_data.shape[0]):
+            write_rivid_csvs(rivid_outpath, dates_pandas, init_data[:, i], q_data[:, i], q_high_res_data[:, i])
+
+
+def read_rivids(folder_path, rivids, max_workers=1):
+    """
+    Reads the initialization values, the ensemble forecasts and the high resolution forecasts of the given rivids from
+    every start date in a folder of compressed forecast files (or a Zarr archive), reading each file once.
+
+    Parameters
+    ----------
+
+    folder_path: str
+        The path to the folder containing the forecast NetCDF files, or to a Zarr archive.
+
+    rivids: list of int
+        The rivids to read.
 
-    # Generate start date time series
-    dates_list = sorted([i[:-3] for i in os.listdir(folder_path)])
-    dates_pandas = pd.to_datetime(dates_list)
+    max_workers: int
+        The maximum number of worker processes used to read the forecast files at the same time. Defaults to 1.
+
+    Returns
+    -------
+    tuple
+        The start dates (pandas.DatetimeIndex) and the initialization values (start date x rivid), ensemble forecasts
+        (start date x rivid x forecast day x ensemble) and high resolution forecasts (start date x rivid x forecast
+        day) of the rivids in the given order. The ensembles are in their original order if the permutation was stored
+        with sorted ensembles.
+    """
+    if is_zarr_archive(folder_path):
+        archive = open_zarr_archive(folder_path)
 
-    # Get rivids as an array
-    ds = xr.open_dataset(files[0])
-    rivids = ds["rivid"].data
-    ds.close()
+        # Generate start date time series
+        dates_pandas = pd.to_datetime(archive["start_date"].values)
 
-    # Try to find the index of the rivid
-    try:
-        rivid_index = np.where(rivids == rivid)[0][0]
-    except Exception as e:
-        raise ValueError("The given rivid does not exist in this stream network.")
+        rivid_indices = find_rivid_indices(archive["rivid"].values, rivids)
 
-    # Creating dask dataframes for the data
-    list_of_dask_q_arrays = []
-    list_of_dask_init_arrays = []
-    list_of_dask_q_high_res_arrays = []
+        # Reading the chunks of the archive in ascending order, then putting the rivids back in the requested order
+        read_order = np.argsort(rivid_indices)
+        points = archive.isel(rivid=rivid_indices[read_order])
+        restore_order = np.argsort(read_order)
 
-    for file in files:
-        ds = xr.open_dataset(file, chunks={"rivid": 5000})  # arbitrary chunk value
+        init_data = np.asarray(unpack_flows(points["initialization_values"]))[:, restore_order]
+        q_data = np.asarray(unpack_flows(points["Qout"]))[:, restore_order]
+        q_high_res_data = np.asarray(unpack_flows(points["Qout_high_res"]))[:, restore_order]
 
-        tmp_dask_q_array = ds["Qout"].data
-        list_of_dask_q_arrays.append(tmp_dask_q_array)
+        permutation = None
+        if "ensemble_permutation" in archive:
+            permutation = points["ensemble_permutation"].values[:, restore_order]
 
-        tmp_dask_init_array = ds["initialization_values"].data
-        list_of_dask_init_arrays.append(tmp_dask_init_array)
+    else:
+        # Leaving out the temporary files of compress_netcfd
+        file_names = sorted(i for i in os.listdir(folder_path) if i.endswith(".nc"))
+        files = [os.path.join(folder_path, i) for i in file_names]
 
-        tmp_dask_q_high_res_array = ds["Qout_high_res"].data
-        list_of_dask_q_high_res_arrays.append(tmp_dask_q_high_res_array)
+        # Generate start date time series
+        dates_list = [i[:-3] for i in file_names]
+        dates_pandas = pd.to_datetime(dates_list)
 
+        # Get rivids as an array
+        ds = xr.open_dataset(files[0])
+        rivid_indices = find_rivid_indices(ds["rivid"].data, rivids)
         ds.close()
 
-    big_dask_q_array = da.stack(list_of_dask_q_arrays)
-    big_dask_init_array = da.stack(list_of_dask_init_arrays)
-    big_dask_q_high_res_array = da.stack(list_of_dask_q_high_res_arrays)
+        read_order = np.argsort(rivid_indices)
+        restore_order = np.argsort(read_order)
+
+        # Reading the hyperslab of the rivids from each file, in worker processes if requested (the NetCDF library is
+        # not thread safe). The workers are started from a fork server so that they do not inherit the threads of dask
+        # (the start method can only be given to the pool from Python 3.7, Python 3.6 forks them).
+        if max_workers > 1:
+            pool_options = {"mp_context": get_context("forkserver")} if sys.version_info >= (3, 7) else {}
+            with ProcessPoolExecutor(max_workers=max_workers, **pool_options) as executor:
+                points = list(executor.map(
+                    read_points, files, repeat(rivid_indices[read_order]),
+                    chunksize=max(1, len(files) // (4 * max_workers))
+                ))
+        else:
+            points = [read_points(file, rivid_indices[read_order]) for file in files]
+
+        init_list = [init[restore_order] for init, _, _, _ in points]
+        q_list = [q[restore_order] for _, q, _, _ in points]
+        q_high_res_list = [q_high_res[restore_order] for _, _, q_high_res, _ in points]
+        permutation_list = [permutation[restore_order] for _, _, _, permutation in points if permutation is not None]
+
+        init_data = np.stack(init_list)
+        q_data = np.stack(q_list)
+        q_high_res_data = np.stack(q_high_res_list)
+
+        permutation = None
+        if len(permutation_list) == len(files):
+            permutation = np.stack(permutation_list)
+
+    # Restoring the original order of the members if the files are stored with sorted ensembles
+    if permutation is not None:
+        sorted_q_data = q_data
+        q_data = np.empty_like(sorted_q_data)
+        np.put_along_axis(q_data, permutation.astype(np.intp) - 1, sorted_q_data, axis=3)
+
+    return dates_pandas, init_data, q_data, q_high_res_data
+
+
+def read_points(file, rivid_indices):
+    """
+    Reads the initialization values, ensemble forecasts, high resolution forecasts and ensemble permutation (None if
+    it was not stored) of the rivids at the given indices (in ascending order) from a compressed forecast file. Only
+    the hyperslabs of the rivids are read, directly with the netCDF4 library.
+    """
+    with netCDF4.Dataset(file) as ds:
+        init = read_point_flows(ds["initialization_values"], rivid_indices)
+        q = read_point_flows(ds["Qout"], rivid_indices)
+        q_high_res = read_point_flows(ds["Qout_high_res"], rivid_indices)
+
+        permutation = None
+        if "ensemble_permutation" in ds.variables:
+            permutation = np.asarray(ds["ensemble_permutation"][rivid_indices])
+
+    return init, q, q_high_res, permutation
+
+
+def read_point_flows(variable, rivid_indices):
+    """Reads the flows of the given rivids from a netCDF4 variable, undoing the packing with unpack_flows."""
+    flows = np.ma.filled(variable[rivid_indices].astype(np.float32), np.nan)
+    attributes = {name: variable.getncattr(name) for name in variable.ncattrs()}
+
+    return unpack_flows(xr.DataArray(flows, attrs=attributes))
+
+
+def write_rivid_csvs(outpath, dates_pandas, init_data, q_data, q_high_res_data):
+    """Writes the initialization values, forecasts and high resolution forecasts of one stream to CSV files."""
+    ensemble_columns = ["Ensemble_{}".format(i) for i in range(51)]
 
     # Extracting the initialization flows
-    init_data = np.asarray(big_dask_init_array[:, rivid_index])
     init_df = pd.DataFrame(init_data, columns=["Initialization (m^3/s)"], index=dates_pandas)
     file_name = os.path.join(outpath, "Initialization_Values.csv")
     init_df.to_csv(file_name, index_label="Date")
 
     # Extracting the Flow Data
-    q_data = np.asarray(big_dask_q_array[:, rivid_index, :, :])
     for i in range(15):
 
         q_data_tmp = q_data[:, i, :]
@@ -85,7 +264,6 @@ def extract_by_rivid(rivid, folder_path, outpath):
         temp_df.to_csv(os.path.join(outpath, file_name), index_label="Date")
 
     # Extracting the high resolution flow data
-    q_high_res_data = np.asarray(big_dask_q_high_res_array[:, rivid_index, :])
     for i in range(10):
 
         q_high_res_data_tmp = q_high_res_data[:, i]
@@ -99,6 +277,34 @@ def extract_by_rivid(rivid, folder_path, outpath):
         temp_df.to_csv(os.path.join(outpath, file_name), index_label="Date")
 
 
+def write_rivids_parquet(outpath, dates_pandas, rivids, init_data, q_data, q_high_res_data):
+    """Writes the initialization values, forecasts and high resolution forecasts of streams to a Parquet dataset."""
+    write_forecasts_parquet(
+        outpath, dates_pandas, rivids, init_data, q_data, [(i + 1, 0) for i in range(q_data.shape[2])],
+        q_high_res_data, [(i + 1, 0) for i in range(q_high_res_data.shape[2])]
+    )
+
+
+def check_output_format(output_format):
+    """Raises a ValueError if the output format is not one of the supported formats."""
+    if output_format not in ("csv", "parquet"):
+        raise ValueError("The output format must be either 'csv' or 'parquet', not '{}'.".format(output_format))
+
+
+def find_rivid_indices(network_rivids, rivids):
+    """
+    Finds the indices of the given rivids in the rivids of the stream network with a hash index of the network, so
+    that looking up many rivids does not scan the network once per rivid.
+    """
+    rivid_index = {rivid: index for index, rivid in enumerate(network_rivids.tolist())}
+
+    missing = [rivid for rivid in rivids if rivid not in rivid_index]
+    if missing:
+        raise ValueError("The given rivids do not exist in this stream network: {}".format(missing))
+
+    return np.array([rivid_index[rivid] for rivid in rivids], dtype=np.intp)
+
+
 if __name__ == "__main__":
     path_to_files = r'/Users/wade/Documents/South_Asia2017'
     output_path = "/Users/wade/Downloads/62028_Files"
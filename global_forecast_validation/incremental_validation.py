@@ -0,0 +1,187 @@
+import xarray as xr
+import pandas as pd
+import numpy as np
+import os
+import dask.array as da
+from global_forecast_validation.compress_netcdf import unpack_flows
+from global_forecast_validation.validate_forecasts import STATISTICS, plan_chunk_size, numba_calculate_statistics, \
+    numba_metrics_from_statistics, merge_statistics, results_frame, results_writer, read_chunk
+from global_forecast_validation.zarr_archive import is_zarr_archive, open_zarr_archive
+from global_forecast_validation.profiling import stage
+
+
+def update_validation(work_dir, state_path, memory_to_allocate_gb, out_path=None, output_format="csv"):
+    """
+    Validates the forecasts incrementally. The sufficient statistics of the metrics of compute_all (sums of the CRPS
+    and of the errors, and the means and co-moments of the Pearson correlation) are stored for each stream and forecast
+    day in a NetCDF file. The first time, the statistics are computed from all of the forecasts in work_dir. After
+    that, only the forecasts of the start dates that can be verified with the initialization values of the new start
+    dates in work_dir are read, and their statistics are merged into the stored ones, so that a daily update only reads
+    the 16 latest files instead of the whole archive. The results are the same as the ones of compute_all on all of
+    the start dates.
+
+    Parameters
+    ----------
+
+    work_dir: str
+        The directory that contains the forecast files that were created with the compress_netcdf function (or a Zarr
+        archive created with append_to_zarr_archive). The start dates must be consecutive daily values.
+
+    state_path: str
+        The path to the NetCDF file with the statistics (e.g. Validation_State.nc). It is created if it does not exist.
+
+    memory_to_allocate_gb: float
+        The memory that you would like to be allocated on the computer when reading the forecasts (see compute_all).
+
+    out_path: str
+        If given, the metrics derived from the updated statistics are written to this file, with the same columns as
+        the results of compute_all.
+
+    output_format: str
+        Either "csv" (default) or "parquet", the format of the file in out_path.
+
+    Returns
+    -------
+    pandas.DatetimeIndex
+        The start dates that were added to the statistics.
+    """
+    memory_to_allocate_bytes = memory_to_allocate_gb * 1e9
+    all_dates = list_start_dates(work_dir)
+
+    if os.path.exists(state_path):
+        with xr.open_dataset(state_path) as state_ds:
+            state_ds.load()
+        first_date = pd.Timestamp(state_ds.attrs["first_start_date"])
+        last_date = pd.Timestamp(state_ds.attrs["last_start_date"])
+        statistics_array = np.stack([state_ds[statistic].values for statistic in STATISTICS], axis=-1)
+        state_rivids = state_ds["rivid"].values
+    else:
+        first_date = all_dates[0]
+        last_date = None
+        statistics_array = None
+        state_rivids = None
+
+    new_dates = all_dates if last_date is None else all_dates[all_dates > last_date]
+
+    if new_dates.size == 0:
+        print("No new start dates to add to the statistics")
+    else:
+        # The new start dates verify the forecasts of up to 15 days before them
+        window_start = max(first_date, new_dates[0] - pd.DateOffset(days=15))
+        window_dates = pd.date_range(window_start, new_dates[-1])
+        first_obs_index = window_dates.get_loc(new_dates[0])
+
+        if not window_dates.isin(all_dates).all():
+            raise ValueError("The start dates in {} must be consecutive daily values.".format(work_dir))
+
+        new_statistics_array, rivids = compute_window_statistics(
+            work_dir, window_dates, first_obs_index, memory_to_allocate_bytes
+        )
+
+        if statistics_array is None:
+            statistics_array = new_statistics_array
+        else:
+            if not np.array_equal(state_rivids, rivids):
+                raise ValueError("The rivids in {} do not match the rivids in {}.".format(work_dir, state_path))
+            merge_statistics(statistics_array, new_statistics_array)
+
+        last_date = new_dates[-1]
+        with stage("write_state"):
+            write_state(state_path, statistics_array, rivids, first_date, last_date)
+
+    if out_path is not None:
+        rivids = state_rivids if new_dates.size == 0 else rivids
+        with results_writer(out_path, output_format) as write_results:
+            write_results(results_frame(numba_metrics_from_statistics(statistics_array), rivids))
+
+    return new_dates
+
+
+def compute_window_statistics(work_dir, window_dates, first_obs_index, memory_to_allocate_bytes):
+    """
+    Computes the sufficient statistics of the forecasts of a window of consecutive start dates, including only the
+    forecasts verified by the initialization values from first_obs_index on. The streams are read in chunks that fit
+    in the given memory.
+    """
+    number_of_start_dates = len(window_dates)
+
+    if is_zarr_archive(work_dir):
+        archive = open_zarr_archive(work_dir).sel(start_date=window_dates)
+        big_dask_q_array = unpack_flows(archive["Qout"])
+        big_dask_init_array = unpack_flows(archive["initialization_values"])
+        presorted = bool(archive.attrs.get("ensembles_sorted", 0))
+        rivids = archive["rivid"].values
+
+        chunk_size, _, _ = plan_chunk_size(
+            memory_to_allocate_bytes, number_of_start_dates, rivids.size, big_dask_q_array.dtype,
+            big_dask_init_array.dtype
+        )
+
+    else:
+        files = [os.path.join(work_dir, date.strftime("%Y%m%d") + ".nc") for date in window_dates]
+
+        with xr.open_dataset(files[0]) as tmp_dataset:
+            rivids = tmp_dataset["rivid"].values
+            chunk_size, _, _ = plan_chunk_size(
+                memory_to_allocate_bytes, number_of_start_dates, rivids.size, tmp_dataset["Qout"].dtype,
+                tmp_dataset["initialization_values"].dtype
+            )
+
+        list_of_dask_q_arrays = []
+        list_of_dask_init_arrays = []
+        presorted = True  # True if the ensembles are stored sorted in all of the files (see compress_netcdf)
+
+        for file in files:
+            ds = xr.open_dataset(file, chunks={"rivid": chunk_size})
+            presorted = presorted and bool(ds.attrs.get("ensembles_sorted", 0))
+            list_of_dask_q_arrays.append(unpack_flows(ds["Qout"]))
+            list_of_dask_init_arrays.append(unpack_flows(ds["initialization_values"]))
+            ds.close()
+
+        big_dask_q_array = da.stack(list_of_dask_q_arrays)
+        big_dask_init_array = da.stack(list_of_dask_init_arrays)
+
+    num_of_streams = rivids.size
+
+    statistics_chunks = []
+    for start_chunk in range(0, num_of_streams, chunk_size):
+        end_chunk = min(start_chunk + chunk_size, num_of_streams)
+
+        forecast_array, init_array, _ = read_chunk(big_dask_q_array, big_dask_init_array, start_chunk, end_chunk)
+
+        with stage("statistics_kernel", start_chunk, rivid_days=number_of_start_dates * (end_chunk - start_chunk)):
+            statistics_chunks.append(numba_calculate_statistics(
+                forecast_array, init_array, number_of_start_dates, end_chunk - start_chunk, 15, presorted,
+                first_obs_index
+            ))
+
+    return np.concatenate(statistics_chunks, axis=1), rivids
+
+
+def list_start_dates(work_dir):
+    """Lists the start dates of the forecasts in a directory of compressed forecast files or in a Zarr archive."""
+    if is_zarr_archive(work_dir):
+        with open_zarr_archive(work_dir) as archive:
+            return pd.DatetimeIndex(archive["start_date"].values)
+
+    return pd.to_datetime(sorted(i[:-3] for i in os.listdir(work_dir) if i.endswith(".nc")), format="%Y%m%d")
+
+
+def write_state(state_path, statistics_array, rivids, first_date, last_date):
+    """Writes the sufficient statistics (forecast day x stream x statistic) to a NetCDF file."""
+    state_ds = xr.Dataset(
+        {
+            statistic: (("forecast_day", "rivid"), statistics_array[:, :, i])
+            for i, statistic in enumerate(STATISTICS)
+        },
+        coords={"forecast_day": np.arange(1, statistics_array.shape[0] + 1), "rivid": rivids},
+        attrs={
+            "first_start_date": first_date.strftime("%Y-%m-%d"),
+            "last_start_date": last_date.strftime("%Y-%m-%d"),
+        },
+    )
+
+    # Writing to a temporary file first so that the state is not lost if the update is interrupted
+    tmp_path = state_path + ".tmp"
+    state_ds.to_netcdf(tmp_path)
+    os.replace(tmp_path, state_path)
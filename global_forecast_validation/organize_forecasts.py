@@ -1,9 +1,30 @@
+import csv
 import os
+import re
+import sys
+import warnings
 import pandas as pd
 import numpy as np
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import get_all_start_methods, get_context
+from global_forecast_validation.parquet_output import write_forecasts_parquet
 
+# The files written by organize_api_forecasts, the lead time files and the initialization values
+ORGANIZED_FILE_PATTERN = re.compile(
+    r"^(?:(?P<day>\d+)_Day_(?P<hour>\d+)_Hour_(?:High_Res_)?Forecast|Initialization_Values)\.csv$"
+)
 
-def organize_api_forecasts(forecast_dir_path, out_dir_path, daily=True):
+# The Parquet files added to a partition by an append (see write_forecasts_parquet)
+APPENDED_PART_PATTERN = re.compile(r"^part-(\d{10})-\d+\.parquet$")
+
+# The bytes read from the end of an organized CSV file to find its last row (a row of 51 ensembles is about 600 bytes)
+CSV_TAIL_BYTES = 8192
+
+
+def organize_api_forecasts(forecast_dir_path, out_dir_path, daily=True, output_format="csv", rivid=None,
+                           max_workers=None, append=False):
     """Organizes CSV files downloaded from the Streamflow Prediction Tool REST API.
 
     Organize the contents of a folder with forecasts that have been stored in CSV format from the Streamflow Prediction
@@ -26,81 +47,77 @@ def organize_api_forecasts(forecast_dir_path, out_dir_path, daily=True):
         frequencies will be used (i.e. three hour forecasts, 6 hour forecasts, etc). Note that setting this parameter to
         false will generate many files.
 
-    """
+    output_format: str
+        Either "csv" (default) for one CSV file per lead time, or "parquet" to write a single Parquet dataset to
+        out_dir_path in long format (see write_forecasts_parquet), partitioned by the lead time.
 
-    # Get all of the sorted files (ignore hidden files)
-    files = sorted([os.path.join(forecast_dir_path, i) for i in os.listdir(forecast_dir_path) if not i.startswith(".")])
-    num_start_dates = len(files)
+    rivid: int
+        The rivid (COMID) of the stream that the forecasts are for, stored in the rivid column of the Parquet dataset.
+        Only used with the parquet output format, and the rivid column is left empty if it is not given.
 
-    # Initialize NumPy arrays to store the data in the files
-    if daily:
-        all_forecast_array = np.zeros((15, 51, num_start_dates))
-        all_high_res_forecast_array = np.zeros((10, num_start_dates))
-        initialization_array = np.zeros((num_start_dates, ))
-    else:
-        all_forecast_array = np.zeros((84, 51, num_start_dates))
-        all_high_res_forecast_array = np.zeros((124, num_start_dates))
-        initialization_array = np.zeros((num_start_dates,))
+    max_workers: int
+        The number of worker processes used to parse the CSV files at the same time. By default (or with 1) the files
+        are parsed in this process. The workers are started with the forkserver (or spawn) method, so a script that
+        uses them must call this function under ``if __name__ == "__main__":``.
 
-    initial_dates_list = []
-    for i, file in enumerate(files):
+    append: bool
+        If True and out_dir_path already has organized forecasts, only the files whose start dates come after the last
+        organized start date are parsed (see new_api_files), and their rows are appended to the existing files (or
+        added to the partitions of the Parquet dataset), so that adding a day of forecasts does not reprocess the
+        whole history. The options must be the same as the ones of the run that organized the existing forecasts. The
+        last rows of the CSV files that an interrupted append only partly wrote are removed before appending.
 
-        file_df = pd.read_csv(file, index_col=0)
-        file_df.index = pd.to_datetime(file_df.index)
+    Returns
+    -------
+    dict
+        The files that could not be read (e.g. truncated downloads or error messages saved as CSV) with the reason
+        why. They are skipped, and their start dates are left out of the organized forecasts.
 
-        initial_dates_list.append(file_df.index[0])
-        initial_value = file_df.iloc[0, 0]  # Initialization value of forecast
-
-        if daily:
-
-            if i == 0:
-                # Creating a list of (Day, Hour) tuples (Assumes 15 day forecasts and 10 days of high resolution)
-                forecasts_day_hour_list = [(i + 1, 0) for i in range(15)]
-                high_res_forecast_day_hour_list = [(i + 1, 0) for i in range(10)]
-
-            forecasts_df = file_df.iloc[:, :-1].dropna()
-            forecast_daily_indices = np.where(forecasts_df.index.hour == 0)[0][1:]  # Remove initial value
-            forecasts_array = forecasts_df.iloc[forecast_daily_indices, :].values
-
-            high_res_forecast_series = file_df.iloc[:, -1].dropna()
-            high_res_forecast_daily_indices = np.where(high_res_forecast_series.index.hour == 0)[0][1:]
-            high_res_forecast_array = high_res_forecast_series.iloc[high_res_forecast_daily_indices].values
-
-            all_forecast_array[:, :, i] = forecasts_array
-            all_high_res_forecast_array[:, i] = high_res_forecast_array
-            initialization_array[i] = initial_value
-
-        else:
-            # Getting daily forecast values
-            forecasts_df = file_df.iloc[:, :-1].dropna()
-            forecasts_array = forecasts_df.values[1:, :]
-
-            high_res_forecast_series = file_df.iloc[:, -1].dropna()
-            high_res_forecast_array = high_res_forecast_series.values[1:]
-
-            all_forecast_array[:, :, i] = forecasts_array
-            all_high_res_forecast_array[:, i] = high_res_forecast_array
-            initialization_array[i] = initial_value
-
-            if i == 0:
-                # Creating a list of (Day, Hour) tuples
-                forecasts_day_hour_list = []
-                for date in forecasts_df.index[1:]:
-
-                    timedelta_object = date - forecasts_df.index[0]
-                    timedelta_components = list(timedelta_object.components)
-
-                    day_hour_tuple = (timedelta_components[0], timedelta_components[1])
-                    forecasts_day_hour_list.append(day_hour_tuple)
-
-                high_res_forecast_day_hour_list = []
-                for date in high_res_forecast_series.index[1:]:
+    """
+    if output_format not in ("csv", "parquet"):
+        raise ValueError("The output format must be either 'csv' or 'parquet', not '{}'.".format(output_format))
 
-                    timedelta_object = date - forecasts_df.index[0]
-                    timedelta_components = timedelta_object.components
+    # Get all of the sorted files (ignore hidden files)
+    files = sorted([os.path.join(forecast_dir_path, i) for i in os.listdir(forecast_dir_path) if not i.startswith(".")])
 
-                    day_hour_tuple = (timedelta_components[0], timedelta_components[1])
-                    high_res_forecast_day_hour_list.append(day_hour_tuple)
+    # The new files come after the last start date that was organized, if any. The rows that an interrupted append
+    # only partly wrote to the CSV files are removed first.
+    if append and output_format == "csv" and os.path.isdir(out_dir_path):
+        remove_partial_csv_rows(out_dir_path)
+    last_start_date = organized_last_start_date(out_dir_path, output_format) if append else None
+    appending = last_start_date is not None
+
+    if appending:
+        files = new_api_files(files, last_start_date)
+        if not files:
+            print("There are no forecasts after {} to organize".format(last_start_date))
+            return {}
+
+    (initial_dates_list, initialization_array, all_forecast_array, forecasts_day_hour_list,
+     all_high_res_forecast_array, high_res_forecast_day_hour_list, malformed_files) = read_api_forecasts(
+        files, daily, max_workers
+    )
+
+    if output_format == "parquet":
+        write_forecasts_parquet(
+            out_dir_path, pd.DatetimeIndex(initial_dates_list), None if rivid is None else [rivid],
+            initialization_array[:, np.newaxis], np.transpose(all_forecast_array, (2, 0, 1))[:, np.newaxis],
+            forecasts_day_hour_list, all_high_res_forecast_array.T[:, np.newaxis], high_res_forecast_day_hour_list,
+            appending
+        )
+        return malformed_files
+
+    # Appending only to the files of a run with the same lead times, before any of them is changed
+    if appending:
+        out_file_names = ["{}_Day_{}_Hour_Forecast.csv".format(day, hour) for day, hour in forecasts_day_hour_list] + [
+            "{}_Day_{}_Hour_High_Res_Forecast.csv".format(day, hour) for day, hour in high_res_forecast_day_hour_list
+        ]
+        missing_file_names = [name for name in out_file_names if not os.path.exists(os.path.join(out_dir_path, name))]
+        if missing_file_names:
+            raise ValueError("Cannot append to the organized forecasts in {}, {} and {} other files are missing (were "
+                             "they organized with another daily option?).".format(
+                                 out_dir_path, missing_file_names[0], len(missing_file_names) - 1
+                             ))
 
     # TODO: Add units to labels just in case?
     for i, (day, hour) in enumerate(forecasts_day_hour_list):
@@ -114,7 +131,7 @@ def organize_api_forecasts(forecast_dir_path, out_dir_path, daily=True):
             data, index=initial_dates_list, columns=["Ensemble {} (m^3/s)".format(i) for i in range(data.shape[1])]
         )
         out_df.index += pd.DateOffset(days=day, hours=hour)
-        out_df.to_csv(forecast_out_file_path, index_label="Datetime")
+        write_organized_csv(forecast_out_file_path, out_df, appending)
 
     for i, (day, hour) in enumerate(high_res_forecast_day_hour_list):
         data = all_high_res_forecast_array[i, :]
@@ -127,12 +144,403 @@ def organize_api_forecasts(forecast_dir_path, out_dir_path, daily=True):
             data, index=initial_dates_list, columns=["High Resolution Forecast (m^3/s)"]
         )
         out_df.index += pd.DateOffset(days=day, hours=hour)
-        out_df.to_csv(high_res_forecast_out_file_path, index_label="Datetime")
+        write_organized_csv(high_res_forecast_out_file_path, out_df, appending)
 
     # Write initialization values to csv
-    pd.DataFrame(
-        initialization_array, index=initial_dates_list, columns=["Initialization Values (m^3/s)"]
-    ).to_csv(os.path.join(out_dir_path, "Initialization_Values.csv"), index_label="Datetime")
+    write_organized_csv(
+        os.path.join(out_dir_path, "Initialization_Values.csv"),
+        pd.DataFrame(initialization_array, index=initial_dates_list, columns=["Initialization Values (m^3/s)"]),
+        appending
+    )
+
+    return malformed_files
+
+
+def write_organized_csv(path, out_df, appending=False):
+    """
+    Writes the forecasts of one lead time (or the initialization values) to a CSV file. When appending, only the rows
+    after the last row of the file are appended (without a header), so that the rows that an interrupted append
+    already wrote to the file are not written twice.
+    """
+    if not appending:
+        out_df.to_csv(path, index_label="Datetime")
+        return
+
+    last_datetime = last_csv_datetime(path)
+    if last_datetime is not None:
+        out_df = out_df[out_df.index > last_datetime]
+
+    out_df.to_csv(path, index_label="Datetime", mode="a", header=False)
+
+
+def organized_last_start_date(out_dir_path, output_format="csv"):
+    """
+    Returns the last start date of the forecasts organized in out_dir_path by organize_api_forecasts (a
+    pandas.Timestamp), or None if there are none yet. An append can be interrupted after some of the lead times were
+    written, so this is the earliest of the last start dates of the lead times (of the output files or of the
+    partitions of the Parquet dataset), from which the append is started again.
+    """
+    if output_format == "parquet":
+        return parquet_last_start_date(out_dir_path)
+
+    if not os.path.exists(os.path.join(out_dir_path, "Initialization_Values.csv")):
+        return None
+
+    last_start_dates = []
+    for file_name in os.listdir(out_dir_path):
+        match = ORGANIZED_FILE_PATTERN.match(file_name)
+        if match is None:
+            continue
+
+        last_datetime = last_csv_datetime(os.path.join(out_dir_path, file_name))
+        if last_datetime is None:
+            return None
+
+        # The rows are labelled with the start date plus the lead time of the file
+        if match.group("day") is not None:
+            last_datetime -= pd.DateOffset(days=int(match.group("day")), hours=int(match.group("hour")))
+        last_start_dates.append(last_datetime)
+
+    return min(last_start_dates)
+
+
+def last_csv_datetime(path):
+    """
+    Returns the datetime (the first column) of the last complete row of a CSV file written by organize_api_forecasts,
+    or None if it only has a header. Only the end of the file is read.
+    """
+    with open(path, "rb") as f:
+        tail_start, tail = read_csv_tail(f)
+
+    # A last row that was only partly written is ignored (see remove_partial_csv_rows)
+    lines = tail[:tail.rfind(b"\n") + 1].splitlines()
+    if len(lines) < 1 + (tail_start == 0):
+        return None
+
+    return pd.Timestamp(lines[-1].split(b",", 1)[0].decode())
+
+
+def remove_partial_csv_rows(out_dir_path):
+    """
+    Removes the last row of the CSV files organized in out_dir_path by organize_api_forecasts when it was only partly
+    written, by an append that was interrupted, so that the rows of the next append start on a new line.
+    """
+    for file_name in os.listdir(out_dir_path):
+        if ORGANIZED_FILE_PATTERN.match(file_name) is None:
+            continue
+
+        with open(os.path.join(out_dir_path, file_name), "rb+") as f:
+            tail_start, tail = read_csv_tail(f)
+            if not tail.endswith(b"\n"):
+                f.truncate(tail_start + tail.rfind(b"\n") + 1)
+
+
+def read_csv_tail(f):
+    """Reads the last CSV_TAIL_BYTES of a file opened in binary mode and returns their offset and the bytes."""
+    size = f.seek(0, os.SEEK_END)
+    tail_start = max(0, size - CSV_TAIL_BYTES)
+    f.seek(tail_start)
+
+    return tail_start, f.read()
+
+
+def parquet_last_start_date(out_path):
+    """
+    Returns the earliest of the last start dates of the partitions of a Parquet dataset written by
+    organize_api_forecasts, or None if the dataset does not exist. Only the footers of the files written by the last
+    append (or by the full run) of each partition are read. The files of an append that was interrupted while
+    writing them cannot be read and are ignored, they are replaced when the append is run again.
+    """
+    import pyarrow.parquet as pq
+
+    if not os.path.isdir(os.path.join(out_path, "lead_day=0", "lead_hour=0")):
+        return None
+
+    last_start_dates = []
+    for lead_day in os.listdir(out_path):
+        if not lead_day.startswith("lead_day="):
+            continue
+
+        for lead_hour in os.listdir(os.path.join(out_path, lead_day)):
+            partition_path = os.path.join(out_path, lead_day, lead_hour)
+
+            # The files of each write, the appended ones are named after their first start date (see
+            # write_forecasts_parquet) and come after the ones of the full run
+            writes = defaultdict(list)
+            for file_name in os.listdir(partition_path):
+                match = APPENDED_PART_PATTERN.match(file_name)
+                writes["" if match is None else match.group(1)].append(os.path.join(partition_path, file_name))
+
+            last_start_date = None
+            for write in sorted(writes, reverse=True):
+                try:
+                    last_start_date = max(parquet_max_start_date(pq.read_metadata(file)) for file in writes[write])
+                    break
+                except (OSError, ValueError):
+                    continue
+
+            if last_start_date is None:
+                return None
+            last_start_dates.append(last_start_date)
+
+    return min(last_start_dates)
+
+
+def parquet_max_start_date(metadata):
+    """Returns the last start date in a Parquet file from the statistics of its row groups."""
+    column = metadata.schema.names.index("start_date")
+    return max(
+        pd.Timestamp(metadata.row_group(i).column(column).statistics.max) for i in range(metadata.num_row_groups)
+    )
+
+
+def new_api_files(files, last_start_date):
+    """
+    Returns the files (sorted in the order of their start dates) whose start dates come after last_start_date. Only
+    the first date of the files is read, from the last file backwards until a file that was already organized, so the
+    cost depends on the number of new files and not on the length of the history. The files whose first date cannot be
+    read are kept, so that they are reported as malformed when they are parsed.
+    """
+    first_new_file = len(files)
+
+    for i in range(len(files) - 1, -1, -1):
+        start_date = read_api_start_date(files[i])
+        if start_date is not None and start_date <= last_start_date:
+            break
+        first_new_file = i
+
+    return files[first_new_file:]
+
+
+def read_api_start_date(file):
+    """Reads the start date (the date of the first row) of a CSV file from the REST API, or None if it cannot."""
+    try:
+        with open(file, "r") as f:
+            f.readline()  # Header
+            first_date = f.readline().split(",", 1)[0]
+        return parse_api_dates([first_date])[0]
+    except (OSError, ValueError, UnicodeDecodeError):
+        return None
+
+
+def read_api_forecasts(files, daily=True, max_workers=None):
+    """
+    Reads the forecasts of CSV files downloaded from the Streamflow Prediction Tool REST API (see
+    organize_api_forecasts) into float32 arrays with the start dates as the last dimension. The files are parsed in a
+    pool of processes (see read_api_forecast_file), and the files that cannot be read are reported and skipped.
+
+    Parameters
+    ----------
+
+    files: list of str
+        The paths of the CSV files, in the order of their start dates.
+
+    daily: bool
+        If True (default), only the forecasts at midnight are read (15 ensemble and 10 high resolution lead times),
+        else all of them (84 ensemble and 124 high resolution lead times).
+
+    max_workers: int
+        The number of worker processes. By default (or with 1) the files are parsed in this process.
+
+    Returns
+    -------
+    tuple
+        The start dates (pandas.DatetimeIndex), the initialization values (start date), the ensemble forecasts (lead
+        time x ensemble x start date), the (day, hour) of their lead times, the high resolution forecasts (lead time x
+        start date), the (day, hour) of their lead times and a dictionary of the malformed files with the reason why
+        they could not be read.
+    """
+    num_start_dates = len(files)
+    max_workers = max_workers or 1
+
+    if daily:
+        # Assumes 15 day forecasts and 10 days of high resolution
+        forecasts_day_hour_list = [(i + 1, 0) for i in range(15)]
+        high_res_forecast_day_hour_list = [(i + 1, 0) for i in range(10)]
+        num_lead_times, num_high_res_lead_times = 15, 10
+    else:
+        # The lead times are taken from the first file that can be read
+        forecasts_day_hour_list = None
+        high_res_forecast_day_hour_list = None
+        num_lead_times, num_high_res_lead_times = 84, 124
+
+    # The arrays are allocated once for all of the files and each file is written into its slice
+    start_dates = []
+    initialization_array = np.zeros(num_start_dates, dtype=np.float32)
+    all_forecast_array = np.zeros((num_lead_times, 51, num_start_dates), dtype=np.float32)
+    all_high_res_forecast_array = np.zeros((num_high_res_lead_times, num_start_dates), dtype=np.float32)
+    is_read = np.zeros(num_start_dates, dtype=bool)
+    malformed_files = {}
+
+    # The files are parsed in worker processes, and the results are copied into the arrays as they arrive. The workers
+    # are started from a fork server so that they do not inherit the threads of dask or Numba, or spawned on the
+    # platforms without one (Windows). The start method can only be given to the pool from Python 3.7, Python 3.6 uses
+    # its default one.
+    executor = None
+    if max_workers > 1 and num_start_dates > 1:
+        start_method = "forkserver" if "forkserver" in get_all_start_methods() else "spawn"
+        pool_options = {"mp_context": get_context(start_method)} if sys.version_info >= (3, 7) else {}
+        executor = ProcessPoolExecutor(max_workers=max_workers, **pool_options)
+
+    try:
+        if executor is None:
+            results = map(read_api_forecast_file, files, repeat(daily))
+        else:
+            results = executor.map(
+                read_api_forecast_file, files, repeat(daily), chunksize=max(1, num_start_dates // (4 * max_workers))
+            )
+
+        for i, (file, (forecast, error)) in enumerate(zip(files, results)):
+            if error is None:
+                start_date, initial_value, forecasts_array, day_hours, high_res_forecast_array, high_res_day_hours = \
+                    forecast
+
+                if forecasts_array.shape[0] != num_lead_times:
+                    error = "Expected {} ensemble forecasts, found {}".format(num_lead_times, forecasts_array.shape[0])
+                elif high_res_forecast_array.shape[0] != num_high_res_lead_times:
+                    error = "Expected {} high resolution forecasts, found {}".format(
+                        num_high_res_lead_times, high_res_forecast_array.shape[0]
+                    )
+                elif forecasts_day_hour_list is None:
+                    forecasts_day_hour_list = day_hours
+                    high_res_forecast_day_hour_list = high_res_day_hours
+                elif not daily and (day_hours != forecasts_day_hour_list or
+                                    high_res_day_hours != high_res_forecast_day_hour_list):
+                    error = "The lead times are different from the ones of the other files"
+
+            if error is not None:
+                print("Skipping {}: {}".format(file, error))
+                malformed_files[file] = error
+                continue
+
+            start_dates.append(start_date)
+            initialization_array[i] = initial_value
+            all_forecast_array[:, :, i] = forecasts_array
+            all_high_res_forecast_array[:, i] = high_res_forecast_array
+            is_read[i] = True
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if not is_read.any():
+        raise ValueError("None of the {} forecast files could be read.".format(num_start_dates))
+
+    if not is_read.all():
+        initialization_array = initialization_array[is_read]
+        all_forecast_array = all_forecast_array[:, :, is_read]
+        all_high_res_forecast_array = all_high_res_forecast_array[:, is_read]
+
+    return (pd.DatetimeIndex(start_dates), initialization_array, all_forecast_array, forecasts_day_hour_list,
+            all_high_res_forecast_array, high_res_forecast_day_hour_list, malformed_files)
+
+
+def read_api_forecast_file(file, daily=True):
+    """
+    Parses a CSV file downloaded from the Streamflow Prediction Tool REST API, with the dates in the first column, the
+    51 ensemble members and the high resolution forecast in the last column (see read_api_csv). Any error is returned
+    instead of raised, so that one malformed file does not stop the others from being read.
+
+    Returns
+    -------
+    tuple
+        The forecast (None if the file could not be read) and the error message (None if it was read). The forecast is
+        the start date, the initialization value, the ensemble forecasts (lead time x ensemble), the (day, hour) of
+        their lead times, the high resolution forecasts and the (day, hour) of their lead times.
+    """
+    try:
+        dates, flows = read_api_csv(file)
+
+        if flows.shape[1] != 52:
+            raise ValueError("Expected 51 ensemble columns and a high resolution column, found {} columns".format(
+                flows.shape[1]
+            ))
+        if flows.shape[0] < 2:
+            raise ValueError("The file has no forecasts")
+
+        # The rows of each forecast, the rows of the other one are empty at the times that only it has
+        forecast_rows = np.flatnonzero(~np.isnan(flows[:, :-1]).any(axis=1))
+        high_res_rows = np.flatnonzero(~np.isnan(flows[:, -1]))
+        first_date = dates[forecast_rows[0]]
+
+        # Removing the initial value
+        if daily:
+            forecast_rows = forecast_rows[dates[forecast_rows].hour == 0][1:]
+            high_res_rows = high_res_rows[dates[high_res_rows].hour == 0][1:]
+        else:
+            forecast_rows = forecast_rows[1:]
+            high_res_rows = high_res_rows[1:]
+
+        forecast = (
+            dates[0], flows[0, 0], flows[forecast_rows, :-1], lead_times(dates[forecast_rows], first_date),
+            flows[high_res_rows, -1], lead_times(dates[high_res_rows], first_date)
+        )
+    except Exception as e:
+        return None, "{}: {}".format(type(e).__name__, e)
+
+    return forecast, None
+
+
+def read_api_csv(file):
+    """
+    Reads the dates (pandas.DatetimeIndex) and the flows (float32, time x column) of a CSV file downloaded from the
+    Streamflow Prediction Tool REST API. The file is read with the CSV reader of pyarrow if it is installed, which
+    parses the dates and the float32 flows directly into arrays (several times faster than building a DataFrame), and
+    with pandas otherwise or if pyarrow cannot parse the dates.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+    except ImportError:
+        pa = None
+
+    if pa is not None:
+        with open(file, "r", newline="") as f:
+            header = next(csv.reader([f.readline()]), [])
+        if not header:
+            raise ValueError("The file is empty")
+
+        column_types = {name: pa.float32() for name in header[1:]}
+        column_types[header[0]] = pa.timestamp("ns")
+
+        try:
+            # One thread per file, the files are already read in parallel (see read_api_forecasts)
+            table = pa_csv.read_csv(
+                file, read_options=pa_csv.ReadOptions(use_threads=False),
+                convert_options=pa_csv.ConvertOptions(column_types=column_types)
+            )
+            flows = np.empty((table.num_rows, table.num_columns - 1), dtype=np.float32)
+            for i, column in enumerate(table.columns[1:]):
+                flows[:, i] = column.to_numpy()
+
+            return pd.DatetimeIndex(table.column(0).to_numpy()), flows
+        except pa.ArrowInvalid:
+            pass  # E.g. the dates are not in ISO 8601 format or have a time zone
+
+    file_df = pd.read_csv(file, index_col=0, dtype=defaultdict(lambda: np.float32, {0: object}))
+
+    return parse_api_dates(file_df.index), file_df.to_numpy()
+
+
+def parse_api_dates(date_strings):
+    """
+    Parses the dates of an API file, with NumPy's ISO 8601 parser (much faster than pandas for the few hundred dates
+    of a file) or with pandas for the other formats.
+    """
+    try:
+        with warnings.catch_warnings():
+            # NumPy only warns about time zones, which are left to pandas
+            warnings.simplefilter("error", DeprecationWarning)
+            return pd.DatetimeIndex(np.asarray(date_strings, dtype=str).astype("datetime64[ns]"))
+    except (ValueError, DeprecationWarning):
+        return pd.to_datetime(date_strings)
+
+
+def lead_times(dates, first_date):
+    """Returns the (day, hour) tuples of the lead times of the dates of a forecast after its first date."""
+    nanoseconds = dates.asi8 - first_date.value
+    days, remainder = np.divmod(nanoseconds, 86400 * 10 ** 9)
+
+    return list(zip(days.tolist(), (remainder // (3600 * 10 ** 9)).tolist()))
 
 
 if __name__ == "__main__":
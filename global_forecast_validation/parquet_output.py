@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+
+# Member numbers of the long format, the ensemble members keep their ensemble numbers (1-51)
+INITIALIZATION_MEMBER = 0
+HIGH_RES_MEMBER = 52
+
+
+def write_forecasts_parquet(out_path, start_dates, rivids, initialization, ensembles, ensemble_lead_times, high_res,
+                            high_res_lead_times, append=False):
+    """
+    Writes forecasts to a Parquet dataset in long format, with one row per value and the columns rivid, start_date,
+    lead_day, lead_hour, member and flow. The dataset is partitioned by the lead time (e.g.
+    out_path/lead_day=1/lead_hour=0/part-0.parquet) so that one lead time can be read without reading the others.
+    The initialization values are stored with a lead time of 0 days and 0 hours as member 0, the ensemble members as
+    members 1-51 and the high resolution forecast as member 52. Existing partitions of the dataset are replaced, unless
+    append is True.
+
+    Parameters
+    ----------
+
+    out_path: str
+        The path to the directory of the Parquet dataset.
+
+    start_dates: pandas.DatetimeIndex
+        The start dates of the forecasts.
+
+    rivids: array_like or None
+        The rivids of the streams. None if the rivids are not known, in which case the rivid column is empty (null).
+
+    initialization: ndarray
+        The initialization values (start date x stream).
+
+    ensembles: ndarray
+        The ensemble forecasts (start date x stream x lead time x ensemble member).
+
+    ensemble_lead_times: list of tuple
+        The (day, hour) lead times of the ensemble forecasts.
+
+    high_res: ndarray
+        The high resolution forecasts (start date x stream x lead time).
+
+    high_res_lead_times: list of tuple
+        The (day, hour) lead times of the high resolution forecasts.
+
+    append: bool
+        If True, the rows are added to the existing partitions in new files (named after the first start date, e.g.
+        part-2019010400-0.parquet) instead of replacing them. The start dates must not be in the dataset already,
+        except in the files of an earlier append from the same first start date (e.g. one that was interrupted), which
+        are replaced.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tables = [
+        long_format_table(
+            start_dates, rivids, initialization[:, :, np.newaxis, np.newaxis], [(0, 0)], [INITIALIZATION_MEMBER]
+        ),
+        long_format_table(
+            start_dates, rivids, ensembles, ensemble_lead_times, np.arange(1, ensembles.shape[3] + 1)
+        ),
+        long_format_table(
+            start_dates, rivids, high_res[:, :, :, np.newaxis], high_res_lead_times, [HIGH_RES_MEMBER]
+        ),
+    ]
+
+    if append:
+        basename_template = "part-{}-{{i}}.parquet".format(pd.Timestamp(start_dates[0]).strftime("%Y%m%d%H"))
+        existing_data_behavior = "overwrite_or_ignore"
+    else:
+        basename_template = "part-{i}.parquet"
+        existing_data_behavior = "delete_matching"
+
+    pq.write_to_dataset(
+        pa.concat_tables(tables), out_path, partition_cols=["lead_day", "lead_hour"],
+        basename_template=basename_template, existing_data_behavior=existing_data_behavior
+    )
+
+
+def long_format_table(start_dates, rivids, flows, lead_times, members):
+    """
+    Creates a long format pyarrow Table from an array of flows (start date x stream x lead time x member). The rows
+    are ordered by lead time, stream, start date and member so that each partition of the dataset is stored as
+    contiguous time series.
+    """
+    import pyarrow as pa
+
+    # Ordering the axes as lead time x stream x start date x member, then broadcasting the labels of each axis
+    flows = np.ascontiguousarray(np.transpose(flows, (2, 1, 0, 3)), dtype=np.float32)
+    shape = flows.shape
+
+    lead_times = np.asarray(lead_times, dtype=np.int16).reshape(-1, 2)
+    lead_day = np.broadcast_to(lead_times[:, 0, np.newaxis, np.newaxis, np.newaxis], shape).ravel()
+    lead_hour = np.broadcast_to(lead_times[:, 1, np.newaxis, np.newaxis, np.newaxis], shape).ravel()
+
+    start_date = np.broadcast_to(
+        pd.DatetimeIndex(start_dates).values[np.newaxis, np.newaxis, :, np.newaxis], shape
+    ).ravel()
+    member = np.broadcast_to(np.asarray(members, dtype=np.uint8), shape).ravel()
+
+    if rivids is None:
+        rivid = pa.nulls(flows.size, type=pa.int64())
+    else:
+        rivid = np.broadcast_to(np.asarray(rivids, dtype=np.int64)[np.newaxis, :, np.newaxis, np.newaxis], shape)
+        rivid = rivid.ravel()
+
+    return pa.table({
+        "rivid": rivid,
+        "start_date": start_date,
+        "lead_day": lead_day,
+        "lead_hour": lead_hour,
+        "member": member,
+        "flow": flows.ravel(),
+    })
@@ -0,0 +1,234 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# The profile of the run, only set while profiling (see profiling), so that the stages cost nothing otherwise
+ACTIVE_PROFILE = None
+
+
+@contextmanager
+def profiling(report_path, command=None):
+    """
+    Records the stages of the functions that are run inside of the context (see stage) and writes a JSON report to
+    report_path when the context exits, even if it exits with an error.
+
+    The report contains the command, the total wall time, the peak resident memory of the process, the bytes that the
+    process read from storage, the time spent compiling Numba functions, the milestones of the run (see
+    record_milestone, e.g. the time to the first chunk) and, for every stage and chunk, its wall time, the bytes of data
+    that it read, the rivid-days (streams times start dates) that it processed and the resident memory of the process
+    when it ended. The stages are also summed up by name, with their throughput.
+
+    Parameters
+    ----------
+
+    report_path: str
+        The path of the JSON report.
+
+    command: list of str
+        The command that was run (e.g. the arguments of the command line), stored in the report.
+    """
+    global ACTIVE_PROFILE
+
+    from numba.core import event
+
+    profile = {
+        "lock": threading.Lock(),
+        "start": time.perf_counter(),
+        "stages": [],
+        "milestones": {},
+    }
+    io_start = read_io_bytes()
+    error = None
+
+    ACTIVE_PROFILE = profile
+    try:
+        with event.install_recorder("numba:compile") as recorder:
+            yield profile
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        ACTIVE_PROFILE = None
+
+        io_end = read_io_bytes()
+        report = {
+            "command": command,
+            "error": error,
+            "total_seconds": time.perf_counter() - profile["start"],
+            "peak_rss_bytes": peak_rss_bytes(),
+            "io_read_bytes": None if io_start is None or io_end is None else io_end - io_start,
+            "jit_compile_seconds": compile_seconds(recorder.buffer),
+            "milestones": profile["milestones"],
+            "summary": summarize(profile["stages"]),
+            "stages": profile["stages"],
+        }
+
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+
+@contextmanager
+def stage(name, chunk=None, bytes_read=0, rivid_days=0):
+    """
+    Records the wall time of a stage of a run if profiling is enabled (see profiling), and does nothing otherwise. The
+    counters of the stage can also be set from inside of the context through the dictionary that it yields, e.g. once
+    the data is read.
+
+    Parameters
+    ----------
+
+    name: str
+        The name of the stage, e.g. "read_chunk".
+
+    chunk: int
+        The chunk of rivids that the stage belongs to, if any, given by the index of its first rivid.
+
+    bytes_read: int
+        The bytes of the flows read by the stage, once they are decoded.
+
+    rivid_days: int
+        The number of streams times the number of start dates processed by the stage.
+    """
+    counters = {"bytes_read": bytes_read, "rivid_days": rivid_days}
+    profile = ACTIVE_PROFILE
+
+    if profile is None:
+        yield counters
+        return
+
+    start = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        end = time.perf_counter()
+        record = {
+            "name": name,
+            "chunk": None if chunk is None else int(chunk),
+            "thread": threading.current_thread().name,
+            "start_seconds": start - profile["start"],
+            "seconds": end - start,
+            "bytes_read": int(counters["bytes_read"]),
+            "rivid_days": int(counters["rivid_days"]),
+            "rss_bytes": current_rss_bytes(),
+        }
+        with profile["lock"]:
+            profile["stages"].append(record)
+
+
+def record_milestone(name, seconds, process_seconds=None):
+    """
+    Records a milestone of the run in the report if profiling is enabled (see profiling), e.g. the time to the first
+    chunk of results, both since the milestone's own start (e.g. the call of compute_all) and since the process started.
+    """
+    profile = ACTIVE_PROFILE
+
+    if profile is not None:
+        with profile["lock"]:
+            profile["milestones"][name] = {"seconds": seconds, "process_seconds": process_seconds}
+
+
+def summarize(stages):
+    """Sums the time, the bytes read and the rivid-days of the stages with the same name."""
+    summary = {}
+
+    for record in stages:
+        totals = summary.setdefault(record["name"], {"count": 0, "seconds": 0., "bytes_read": 0, "rivid_days": 0})
+        totals["count"] += 1
+        totals["seconds"] += record["seconds"]
+        totals["bytes_read"] += record["bytes_read"]
+        totals["rivid_days"] += record["rivid_days"]
+
+    for totals in summary.values():
+        seconds = totals["seconds"]
+        totals["rivid_days_per_second"] = totals["rivid_days"] / seconds if seconds > 0 else None
+        totals["bytes_read_per_second"] = totals["bytes_read"] / seconds if seconds > 0 else None
+
+    return summary
+
+
+def compile_seconds(buffer):
+    """Sums the time spent compiling Numba functions from the events of a numba:compile recorder."""
+    total = 0.
+    depth = 0
+    start = None
+
+    # The compilation of a function includes the compilation of the functions that it calls
+    for timestamp, compile_event in buffer:
+        if compile_event.is_start:
+            if depth == 0:
+                start = timestamp
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                total += timestamp - start
+
+    return total
+
+
+def current_rss_bytes():
+    """Returns the resident memory of the process in bytes, or None if it cannot be measured on this platform."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def process_seconds():
+    """
+    Returns the seconds since the process started, including the start of the interpreter and the imports, or None if
+    they cannot be measured.
+    """
+    try:
+        import psutil
+        return time.time() - psutil.Process().create_time()
+    except ImportError:
+        return None
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory of the process to its current value (Linux only), so that the peak measured
+    afterwards does not include the memory used earlier. Returns False if it could not be reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes():
+    """Returns the peak resident memory of the process in bytes, or None if it cannot be measured on this platform."""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Bytes on macOS, kilobytes on Linux
+
+
+def read_io_bytes():
+    """The bytes that the process has read from storage (Linux only), or None if they cannot be read."""
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                if line.startswith("read_bytes:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+
+    return None
@@ -0,0 +1,127 @@
+import os
+import re
+import shutil
+
+
+def parse_shard(shard):
+    """
+    Parses a shard given as "i/N" (e.g. "3/16"), where N is the number of shards and i the index of the shard,
+    starting at 0. Returns the tuple (i, N).
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", str(shard))
+    if match is None:
+        raise ValueError("The shard must be given as i/N (e.g. 3/16), not '{}'.".format(shard))
+
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or index >= count:
+        raise ValueError("The shard index must be between 0 and {} for {} shards.".format(count - 1, count))
+
+    return index, count
+
+
+def shard_bounds(num_of_streams, shard):
+    """
+    Returns the start and end indices of the rivids of a shard (see parse_shard). The rivids are split into contiguous
+    slices whose sizes differ by at most one rivid, in the order of the rivids in the files.
+    """
+    index, count = shard
+
+    if count > num_of_streams:
+        raise ValueError("There are more shards ({}) than rivids ({}).".format(count, num_of_streams))
+
+    return index * num_of_streams // count, (index + 1) * num_of_streams // count
+
+
+def shard_path(out_path, shard):
+    """
+    Returns the path of the results of a shard, e.g. Skill_Scores.shard-0003-of-0016.csv for the shard 3/16 of
+    Skill_Scores.csv.
+    """
+    index, count = shard
+    stem, ext = os.path.splitext(out_path)
+
+    return "{}.shard-{:04d}-of-{:04d}{}".format(stem, index, count, ext)
+
+
+def merge_shards(out_path, output_format="csv"):
+    """
+    Merges the results of the shards of a validation (see compute_all) into a single file, in the same order as the
+    results of a validation without shards. All of the shards of out_path must be in the same directory.
+
+    Parameters
+    ----------
+
+    out_path: str
+        The path of the merged results, i.e. the out_path that was given to each shard (e.g. Skill_Scores.csv for the
+        shard files Skill_Scores.shard-0000-of-0016.csv to Skill_Scores.shard-0015-of-0016.csv).
+
+    output_format: str
+        Either "csv" (default) or "parquet", the format of the shard files.
+
+    Returns
+    -------
+    list of str
+        The paths of the shard files that were merged.
+    """
+    if output_format not in ("csv", "parquet"):
+        raise ValueError("The output format must be either 'csv' or 'parquet', not '{}'.".format(output_format))
+
+    paths = find_shards(out_path)
+
+    if output_format == "csv":
+        # The lines are copied without parsing them so that the values are exactly the ones of the shards
+        with open(out_path, "w", newline="") as out_file:
+            for i, path in enumerate(paths):
+                with open(path, "r", newline="") as shard_file:
+                    header = shard_file.readline()
+                    if i == 0:
+                        out_file.write(header)
+                    shutil.copyfileobj(shard_file, out_file)
+
+    else:
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for path in paths:
+                shard_file = pq.ParquetFile(path)
+                if writer is None:
+                    writer = pq.ParquetWriter(out_path, shard_file.schema_arrow)
+                for row_group in range(shard_file.num_row_groups):
+                    writer.write_table(shard_file.read_row_group(row_group))
+        finally:
+            if writer is not None:
+                writer.close()
+
+    return paths
+
+
+def find_shards(out_path):
+    """Finds the shard files of out_path and checks that all of the shards of one run are there."""
+    directory = os.path.dirname(out_path) or "."
+    stem, ext = os.path.splitext(os.path.basename(out_path))
+    pattern = re.compile(re.escape(stem) + r"\.shard-(\d{4,})-of-(\d{4,})" + re.escape(ext))
+
+    shards = {}
+    for file_name in os.listdir(directory):
+        match = pattern.fullmatch(file_name)
+        if match is not None:
+            shards[int(match.group(1)), int(match.group(2))] = os.path.join(directory, file_name)
+
+    if not shards:
+        raise ValueError("There are no shard files of {}.".format(out_path))
+
+    counts = {count for _, count in shards}
+    if len(counts) > 1:
+        raise ValueError("The shard files of {} belong to runs with different numbers of shards: {}.".format(
+            out_path, sorted(counts)
+        ))
+
+    count = counts.pop()
+    missing = [index for index in range(count) if (index, count) not in shards]
+    if missing:
+        raise ValueError("The shards {} of {} are missing.".format(
+            ", ".join("{}/{}".format(index, count) for index in missing), out_path
+        ))
+
+    return [shards[index, count] for index in range(count)]
@@ -1,17 +1,31 @@
 import os
+import json
+import multiprocessing
+import subprocess
 import sys
+import tempfile
 
 # Need to make sure that the package is included in the path
 package_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
 if package_path not in sys.path:
     sys.path.insert(0, package_path)
 
+import numba
 import numpy as np
 import pandas as pd
 import unittest
-from global_forecast_validation.compress_netcdf import compress_netcfd
-from global_forecast_validation.validate_forecasts import compute_all
-from global_forecast_validation.extract_data import extract_by_rivid
+from unittest import mock
+from global_forecast_validation.compress_netcdf import compress_netcfd, compress_netcfd_batch, unpack_flows
+from global_forecast_validation.validate_forecasts import compute_all, numba_calculate_metrics, plan_chunk_size, \
+    RESULT_COLUMNS, HIGH_RES_COLUMNS
+from global_forecast_validation.incremental_validation import update_validation
+from global_forecast_validation.dask_validation import compute_all_dask, dask_scheduler, metrics_block
+from global_forecast_validation.shards import merge_shards, shard_path
+from global_forecast_validation.profiling import profiling
+from global_forecast_validation.extract_data import extract_by_rivid, extract_by_rivids
+from global_forecast_validation.zarr_archive import append_to_zarr_archive
+from global_forecast_validation.organize_forecasts import organize_api_forecasts, organized_last_start_date, \
+    write_organized_csv
 import xarray as xr
 import shutil
 
@@ -71,8 +85,182 @@ class TestCompressNetcdf(unittest.TestCase):
 
         ds.close()
 
+    def test_compress_netcdf_rivid_blocks(self):
+        folder_path = os.path.join(self.test_script_path, 'Test_files/Individual_Ensembles_20190104')
+
+        out_path = os.path.join(self.test_script_path, 'Test_files')
+        compress_netcfd(folder_path, out_path, "Qout_south_america_continental", rivid_block_size=3)
+
+        ds = xr.open_dataset(os.path.join(out_path, "20190104.nc"))
+
+        benchmark_flow_array = np.load(
+            os.path.join(self.test_script_path, r"Test_files/Comparison_Files/benchmark_flow_array.npy")
+        )
+        benchmark_array_high_res = np.load(
+            os.path.join(self.test_script_path, "Test_files/Comparison_Files/benchmark_array_high_res.npy")
+        )
+
+        # Testing
+        self.assertTrue(np.all(np.isclose(ds["Qout"].data, benchmark_flow_array)))
+        self.assertTrue(np.all(np.isclose(ds["Qout_high_res"].data, benchmark_array_high_res)))
+
+        ds.close()
+
+    def test_compress_netcdf_encoding(self):
+        folder_path = os.path.join(self.test_script_path, 'Test_files/Individual_Ensembles_20190104')
+
+        out_path = os.path.join(self.test_script_path, 'Test_files')
+        compress_netcfd(folder_path, out_path, "Qout_south_america_continental", compression="zlib",
+                        chunks={"rivid": 4, "ensemble_number": 17})
+
+        ds = xr.open_dataset(os.path.join(out_path, "20190104.nc"))
+
+        benchmark_flow_array = np.load(
+            os.path.join(self.test_script_path, r"Test_files/Comparison_Files/benchmark_flow_array.npy")
+        )
+
+        # Testing
+        self.assertTrue(ds["Qout"].encoding["zlib"])
+        self.assertTrue(ds["Qout"].encoding["shuffle"])
+        self.assertEqual(tuple(ds["Qout"].encoding["chunksizes"]), (4, 15, 17))
+        self.assertEqual(tuple(ds["Qout_high_res"].encoding["chunksizes"]), (4, 10))
+        self.assertTrue(np.all(np.isclose(ds["Qout"].data, benchmark_flow_array)))
+
+        ds.close()
+
+    def test_compress_netcdf_packed(self):
+        folder_path = os.path.join(self.test_script_path, 'Test_files/Individual_Ensembles_20190104')
+
+        out_path = os.path.join(self.test_script_path, 'Test_files')
+        compress_netcfd(folder_path, out_path, "Qout_south_america_continental", pack="log")
+
+        ds = xr.open_dataset(os.path.join(out_path, "20190104.nc"))
+
+        benchmark_flow_array = np.load(
+            os.path.join(self.test_script_path, r"Test_files/Comparison_Files/benchmark_flow_array.npy")
+        )
+        benchmark_array_high_res = np.load(
+            os.path.join(self.test_script_path, "Test_files/Comparison_Files/benchmark_array_high_res.npy")
+        )
+
+        # Testing (The error of the log packing is below about 0.025% of 1 + flow)
+        self.assertEqual(ds["Qout"].encoding["dtype"], np.int16)
+        np.testing.assert_allclose(unpack_flows(ds["Qout"]), benchmark_flow_array, rtol=3e-4, atol=3e-4)
+        np.testing.assert_allclose(unpack_flows(ds["Qout_high_res"]), benchmark_array_high_res, rtol=3e-4, atol=3e-4)
+
+        ds.close()
+
+    def test_compress_netcdf_packed_linear(self):
+        folder_path = os.path.join(self.test_script_path, 'Test_files/Individual_Ensembles_20190104')
+
+        out_path = os.path.join(self.test_script_path, 'Test_files')
+        compress_netcfd(folder_path, out_path, "Qout_south_america_continental", pack="linear")
+
+        benchmark_flow_array = np.load(
+            os.path.join(self.test_script_path, r"Test_files/Comparison_Files/benchmark_flow_array.npy")
+        )
+
+        # The flows are spread over the whole int16 range, so the error is at most half of (max - min) / 65534
+        with xr.open_dataset(os.path.join(out_path, "20190104.nc")) as ds:
+            self.assertEqual(ds["Qout"].encoding["dtype"], np.int16)
+            self.assertIn("add_offset", ds["Qout"].encoding)
+            max_error = (benchmark_flow_array.max() - benchmark_flow_array.min()) / 65534 / 2
+            np.testing.assert_allclose(unpack_flows(ds["Qout"]), benchmark_flow_array, rtol=0, atol=max_error * 1.01)
+
+    def test_compress_netcdf_batch(self):
+        root_folder = os.path.join(self.test_script_path, 'Test_files')
+        out_path = os.path.join(self.test_script_path, 'Test_files')
+
+        timings = compress_netcfd_batch(root_folder, out_path, "Qout_south_america_continental", processes=1)
+        self.assertIsNotNone(timings["20190104"])
+
+        ds = xr.open_dataset(os.path.join(out_path, "20190104.nc"))
+        benchmark_flow_array = np.load(
+            os.path.join(self.test_script_path, r"Test_files/Comparison_Files/benchmark_flow_array.npy")
+        )
+        self.assertTrue(np.all(np.isclose(ds["Qout"].data, benchmark_flow_array)))
+        ds.close()
+
+        # The date is skipped the second time because it has already been compressed
+        timings = compress_netcfd_batch(root_folder, out_path, "Qout_south_america_continental", processes=1)
+        self.assertIsNone(timings["20190104"])
+
+    def test_compress_netcdf_batch_interrupted(self):
+        root_folder = os.path.join(self.test_script_path, 'Test_files')
+        out_path = os.path.join(self.test_script_path, 'Test_files')
+        out_file = os.path.join(out_path, "20190104.nc")
+        compress_netcfd_batch(root_folder, out_path, "Qout_south_america_continental", processes=1)
+
+        # A run killed while writing leaves a half written file behind, under its temporary name
+        with open(out_file, "rb") as f:
+            half_written = f.read()[:os.path.getsize(out_file) // 2]
+        os.remove(out_file)
+        with open(out_file + ".12345.tmp", "wb") as f:
+            f.write(half_written)
+
+        # It is not picked up as a compressed file and the date is compressed again
+        timings = compress_netcfd_batch(root_folder, out_path, "Qout_south_america_continental", processes=1)
+        self.assertIsNotNone(timings["20190104"])
+        self.assertFalse(os.path.exists(out_file + ".12345.tmp"))
+
+        # A truncated compressed file (e.g. written by an older version) is not skipped either
+        with open(out_file, "wb") as f:
+            f.write(half_written)
+        timings = compress_netcfd_batch(root_folder, out_path, "Qout_south_america_continental", processes=1)
+        self.assertIsNotNone(timings["20190104"])
+
+        with xr.open_dataset(out_file) as ds:
+            benchmark_flow_array = np.load(
+                os.path.join(self.test_script_path, r"Test_files/Comparison_Files/benchmark_flow_array.npy")
+            )
+            np.testing.assert_allclose(ds["Qout"].data, benchmark_flow_array, rtol=1e-6)
+        self.assertEqual(sorted(i for i in os.listdir(out_path) if i.startswith("2019")), ["20190104.nc"])
+
+    def test_compress_netcdf_corrupt_file(self):
+        folder_path = tempfile.mkdtemp()
+        ensembles_path = os.path.join(self.test_script_path, 'Test_files/Individual_Ensembles_20190104')
+        for file in os.listdir(ensembles_path):
+            shutil.copy(os.path.join(ensembles_path, file), folder_path)
+        with open(os.path.join(folder_path, "Qout_south_america_continental_5.nc"), "wb") as f:
+            f.write(b"Not a NetCDF file")
+
+        # The workers that read the files are shut down when one of the files cannot be read
+        try:
+            with self.assertRaises((OSError, ValueError)):
+                compress_netcfd(folder_path, folder_path, "Qout_south_america_continental", max_workers=2)
+            self.assertEqual(multiprocessing.active_children(), [])
+        finally:
+            shutil.rmtree(folder_path)
+
+    def test_compress_netcdf_sorted(self):
+        folder_path = os.path.join(self.test_script_path, 'Test_files/Individual_Ensembles_20190104')
+
+        out_path = os.path.join(self.test_script_path, 'Test_files')
+        compress_netcfd(folder_path, out_path, "Qout_south_america_continental", sort_ensembles=True,
+                        store_permutation=True)
+
+        ds = xr.open_dataset(os.path.join(out_path, "20190104.nc"))
+
+        flow_array = ds["Qout"].data
+        permutation = ds["ensemble_permutation"].data.astype(np.intp) - 1
+
+        benchmark_flow_array = np.load(
+            os.path.join(self.test_script_path, r"Test_files/Comparison_Files/benchmark_flow_array.npy")
+        )
+        restored_flow_array = np.empty_like(flow_array)
+        np.put_along_axis(restored_flow_array, permutation, flow_array, axis=2)
+
+        # Testing
+        self.assertEqual(ds.attrs["ensembles_sorted"], 1)
+        self.assertTrue(np.all(np.diff(flow_array, axis=2) >= 0))
+        self.assertTrue(np.all(np.isclose(restored_flow_array, benchmark_flow_array)))
+
+        ds.close()
+
     def tearDown(self):
-        os.remove(os.path.join(self.test_script_path, "Test_files/20190104.nc"))
+        out_file = os.path.join(self.test_script_path, "Test_files/20190104.nc")
+        if os.path.exists(out_file):
+            os.remove(out_file)
 
 
 class TestValidateForecasts(unittest.TestCase):
@@ -192,11 +380,237 @@ class TestValidateForecasts(unittest.TestCase):
         # Testing (Make sure it's precise to three decimals)
         pd.testing.assert_frame_equal(true_df, test_df, check_less_precise=3)
 
+    def test_compute_all_chunks(self):
+        # Enough memory for three rivids at a time, so that the ten rivids are read in four chunks
+        work_dir = os.path.join(self.test_script_path, "Test_files/Forecast_Validation_Files")
+        chunked_csv_path = os.path.join(self.test_script_path, "Test_files/Forecast_analysis_chunked_test.csv")
+        compute_all(work_dir, out_path=chunked_csv_path, memory_to_allocate_gb=0.0035)
+
+        self.csv_path = os.path.join(self.test_script_path, r"Test_files/Forecast_analysis_test.csv")
+        test_df = pd.read_csv(chunked_csv_path)
+        os.remove(chunked_csv_path)
+
+        pd.testing.assert_frame_equal(pd.read_csv(self.csv_path), test_df)
+
+    def test_compute_all_parquet(self):
+        work_dir = os.path.join(self.test_script_path, "Test_files/Forecast_Validation_Files")
+        parquet_path = os.path.join(self.test_script_path, "Test_files/Forecast_analysis_test.parquet")
+        compute_all(work_dir, out_path=parquet_path, memory_to_allocate_gb=0.0035, output_format="parquet")
+
+        self.csv_path = os.path.join(self.test_script_path, r"Test_files/Forecast_analysis_test.csv")
+        test_df = pd.read_parquet(parquet_path)
+        os.remove(parquet_path)
+
+        pd.testing.assert_frame_equal(pd.read_csv(self.csv_path), test_df, check_dtype=False)
+
+    def test_compute_all_float32(self):
+        work_dir = os.path.join(self.test_script_path, "Test_files/Forecast_Validation_Files")
+        float32_csv_path = os.path.join(self.test_script_path, "Test_files/Forecast_analysis_float32_test.csv")
+        compute_all(work_dir, out_path=float32_csv_path, memory_to_allocate_gb=1.0, precision="float32")
+
+        self.csv_path = os.path.join(self.test_script_path, r"Test_files/Forecast_analysis_test.csv")
+        test_df = pd.read_csv(float32_csv_path)
+        os.remove(float32_csv_path)
+
+        # Within the same tolerance of the float64 benchmark as the float64 results
+        pickle_path = os.path.join(
+            self.test_script_path, r"Test_files/Comparison_Files/benchmark_forecast_validation_df.pkl"
+        )
+        pd.testing.assert_frame_equal(pd.read_pickle(pickle_path), test_df, check_less_precise=3)
+
+    def test_compute_all_float32_chunk_size(self):
+        # With the same memory, the float32 flows take half of the memory so more rivids fit in each chunk
+        work_dir = os.path.join(self.test_script_path, "Test_files/Forecast_Validation_Files")
+        self.csv_path = os.path.join(self.test_script_path, "Test_files/Forecast_analysis_float32_test.csv")
+        chunk_sizes = {}
+        for precision in ("float64", "float32"):
+            with mock.patch("global_forecast_validation.validate_forecasts.plan_chunk_size",
+                            wraps=plan_chunk_size) as planner:
+                compute_all(work_dir, out_path=self.csv_path, memory_to_allocate_gb=0.0035, precision=precision)
+            chunk_sizes[precision] = plan_chunk_size(*planner.call_args[0])[0]
+
+        self.assertGreater(chunk_sizes["float32"], chunk_sizes["float64"])
+
+    def test_compute_all_dask(self):
+        # Blocks of three rivids, so that the ten rivids are validated in four blocks
+        work_dir = os.path.join(self.test_script_path, "Test_files/Forecast_Validation_Files")
+        dask_csv_path = os.path.join(self.test_script_path, "Test_files/Forecast_analysis_dask_test.csv")
+        self.csv_path = os.path.join(self.test_script_path, r"Test_files/Forecast_analysis_test.csv")
+
+        for scheduler in ("threads", "synchronous"):
+            compute_all_dask(work_dir, dask_csv_path, scheduler=scheduler, rivid_chunk_size=3)
+            test_df = pd.read_csv(dask_csv_path)
+            os.remove(dask_csv_path)
+
+            pd.testing.assert_frame_equal(pd.read_csv(self.csv_path), test_df)
+
+    def test_compute_all_shards(self):
+        # The ten rivids are split into slices of three, three and four rivids, which are merged back in order
+        work_dir = os.path.join(self.test_script_path, "Test_files/Forecast_Validation_Files")
+        merged_csv_path = os.path.join(self.test_script_path, "Test_files/Forecast_analysis_merged_test.csv")
+        self.csv_path = os.path.join(self.test_script_path, r"Test_files/Forecast_analysis_test.csv")
+
+        for index in (2, 0, 1):
+            compute_all(work_dir, out_path=merged_csv_path, memory_to_allocate_gb=1.0, shard=(index, 3))
+
+        self.assertEqual(pd.read_csv(shard_path(merged_csv_path, (2, 3))).shape[0], 4 * 15)
+
+        paths = merge_shards(merged_csv_path)
+        test_df = pd.read_csv(merged_csv_path)
+        for path in paths + [merged_csv_path]:
+            os.remove(path)
+
+        pd.testing.assert_frame_equal(pd.read_csv(self.csv_path), test_df)
+
+    def test_compute_all_high_res(self):
+        work_dir = os.path.join(self.test_script_path, "Test_files/Forecast_Validation_Files")
+        high_res_csv_path = os.path.join(self.test_script_path, "Test_files/Forecast_analysis_high_res_test.csv")
+        compute_all(work_dir, out_path=high_res_csv_path, memory_to_allocate_gb=0.0035, high_res=True)
+
+        self.csv_path = os.path.join(self.test_script_path, r"Test_files/Forecast_analysis_test.csv")
+        test_df = pd.read_csv(high_res_csv_path)
+        os.remove(high_res_csv_path)
+
+        # The ensemble metrics are unchanged
+        pd.testing.assert_frame_equal(pd.read_csv(self.csv_path), test_df[RESULT_COLUMNS])
+
+        # The metrics of the high resolution forecast, computed directly for one stream and forecast day
+        files = sorted(os.listdir(work_dir))
+        high_res = []
+        initialization = []
+        for file in files:
+            with xr.open_dataset(os.path.join(work_dir, file)) as ds:
+                high_res.append(ds["Qout_high_res"].values[3, 4])
+                initialization.append(ds["initialization_values"].values[3])
+        sim = np.array(high_res[:-5], dtype=np.float64)
+        obs = np.array(initialization[5:], dtype=np.float64)
+        bench = np.array(initialization[:-5], dtype=np.float64)
+
+        row = test_df[test_df["Forecast Day"] == 5].iloc[3]
+        np.testing.assert_allclose(row["HRES_MAE"], np.mean(np.abs(sim - obs)), rtol=1e-5)
+        np.testing.assert_allclose(row["HRES_RMSE"], np.sqrt(np.mean((sim - obs) ** 2)), rtol=1e-5)
+        np.testing.assert_allclose(row["HRES_MSESS"], 1 - np.mean((sim - obs) ** 2) / np.mean((bench - obs) ** 2),
+                                   rtol=1e-4)
+        np.testing.assert_allclose(row["HRES_Pearson_r"], np.corrcoef(sim, obs)[0, 1], rtol=1e-4)
+        self.assertTrue(test_df.loc[test_df["Forecast Day"] > 10, HIGH_RES_COLUMNS].isna().all().all())
+
+    def test_compute_all_checkpoint(self):
+        work_dir = os.path.join(self.test_script_path, "Test_files/Forecast_Validation_Files")
+        resumed_csv_path = os.path.join(self.test_script_path, "Test_files/Forecast_analysis_resumed_test.csv")
+        checkpoint_dir = os.path.join(self.test_script_path, "Test_files/Forecast_analysis_checkpoint")
+        self.csv_path = os.path.join(self.test_script_path, r"Test_files/Forecast_analysis_test.csv")
+
+        # Interrupting the run on its second chunk, after the first chunk was saved
+        computed_rivids = []
+
+        def interrupted_metrics(*args):
+            if computed_rivids:
+                raise KeyboardInterrupt
+            computed_rivids.extend(args[5])
+            return numba_calculate_metrics(*args)
+
+        with mock.patch("global_forecast_validation.validate_forecasts.numba_calculate_metrics", interrupted_metrics):
+            with self.assertRaises(KeyboardInterrupt):
+                compute_all(work_dir, resumed_csv_path, memory_to_allocate_gb=0.0035, checkpoint_dir=checkpoint_dir)
+        self.assertTrue(os.path.exists(os.path.join(checkpoint_dir, "manifest.json")))
+
+        # The resumed run only computes the remaining rivids
+        resumed_rivids = []
+
+        def counted_metrics(*args):
+            resumed_rivids.extend(args[5])
+            return numba_calculate_metrics(*args)
+
+        with mock.patch("global_forecast_validation.validate_forecasts.numba_calculate_metrics", counted_metrics):
+            compute_all(work_dir, resumed_csv_path, memory_to_allocate_gb=0.0035, checkpoint_dir=checkpoint_dir)
+        test_df = pd.read_csv(resumed_csv_path)
+        os.remove(resumed_csv_path)
+
+        self.assertEqual(len(computed_rivids) + len(resumed_rivids), 10)
+        self.assertFalse(set(computed_rivids) & set(resumed_rivids))
+        self.assertFalse(os.path.exists(checkpoint_dir))
+        pd.testing.assert_frame_equal(pd.read_csv(self.csv_path), test_df)
+
     def tearDown(self):
 
         os.remove(self.csv_path)
 
 
+class TestNumbaCalculateMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(42)
+        self.forecasts = self.rng.gamma(2., 10., size=(40, 6, 15, 51)).astype(np.float32)
+        self.initialization = self.rng.gamma(2., 10., size=(40, 6)).astype(np.float32)
+        self.rivids = np.arange(6)
+
+    def test_presorted(self):
+        unsorted_results = numba_calculate_metrics(self.forecasts, self.initialization, 40, 6, 15, self.rivids)
+        presorted_results = numba_calculate_metrics(
+            np.sort(self.forecasts, axis=3), self.initialization, 40, 6, 15, self.rivids, True
+        )
+
+        np.testing.assert_allclose(unsorted_results, presorted_results, rtol=1e-5)
+
+    def test_dask_kernel_threads(self):
+        # Each of the processes of the processes scheduler runs the kernel with its share of the cores
+        with mock.patch("dask.system.CPU_COUNT", 8):
+            with dask_scheduler("processes") as compute_kwargs:
+                self.assertEqual(compute_kwargs["kernel_threads"], 1)
+            with dask_scheduler("threads") as compute_kwargs:
+                self.assertIsNone(compute_kwargs["kernel_threads"])
+
+        kernel_threads = []
+
+        def counted_metrics(*args):
+            kernel_threads.append(numba.get_num_threads())
+            return np.zeros((15, args[3], 15), dtype=np.float32)
+
+        with mock.patch("global_forecast_validation.dask_validation.numba_calculate_metrics", counted_metrics):
+            metrics_block(self.forecasts, self.initialization, self.rivids, num_threads=1)
+        self.assertEqual(kernel_threads, [1])
+        numba.set_num_threads(numba.config.NUMBA_NUM_THREADS)
+
+
+class TestIncrementalValidation(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.path.dirname(os.path.abspath(__file__))
+        self.source_dir = os.path.join(self.cwd, "Test_files/Forecast_Validation_Files")
+        self.work_dir = os.path.join(self.cwd, "Test_files/Incremental_Validation_Files")
+        self.state_path = os.path.join(self.cwd, "Test_files/Validation_State.nc")
+        self.csv_path = os.path.join(self.cwd, "Test_files/Incremental_analysis_test.csv")
+        if not os.path.exists(self.work_dir):
+            os.mkdir(self.work_dir)
+
+    def test_update_validation(self):
+        files = sorted(os.listdir(self.source_dir))
+
+        # A first validation with most of the files, then daily updates with the rest of them
+        for file in files[:100]:
+            shutil.copy(os.path.join(self.source_dir, file), self.work_dir)
+        update_validation(self.work_dir, self.state_path, 1.0)
+
+        for file in files[100:]:
+            shutil.copy(os.path.join(self.source_dir, file), self.work_dir)
+            new_dates = update_validation(self.work_dir, self.state_path, 1.0)
+            self.assertEqual(new_dates.strftime("%Y%m%d.nc").tolist(), [file])
+
+        update_validation(self.work_dir, self.state_path, 1.0, out_path=self.csv_path)
+
+        pickle_path = os.path.join(self.cwd, r"Test_files/Comparison_Files/benchmark_forecast_validation_df.pkl")
+        true_df = pd.read_pickle(pickle_path)
+        test_df = pd.read_csv(self.csv_path)
+
+        pd.testing.assert_frame_equal(true_df, test_df, check_less_precise=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+        for path in (self.state_path, self.csv_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
 class TestExtractData(unittest.TestCase):
     """
     Tests the functions included in compress_netcdf.py to make sure that they are working correctly with
@@ -235,9 +649,343 @@ class TestExtractData(unittest.TestCase):
             with self.subTest(test=test):
                 pd.testing.assert_frame_equal(truth, test)
 
+    def test_extract_by_rivids(self):
+        work_dir = os.path.join(self.cwd, "Test_files/Forecast_Validation_Files")
+        rivids = [192450, 192451, 192474]
+        extract_by_rivids(rivids=rivids, folder_path=work_dir, outpath=self.out_path, max_workers=2)
+
+        for rivid in rivids:
+            single_path = os.path.join(self.out_path, "single_{}".format(rivid))
+            os.mkdir(single_path)
+            extract_by_rivid(rivid=rivid, folder_path=work_dir, outpath=single_path)
+
+            for file_name in sorted(os.listdir(single_path)):
+                with self.subTest(rivid=rivid, file_name=file_name):
+                    pd.testing.assert_frame_equal(
+                        pd.read_csv(os.path.join(single_path, file_name)),
+                        pd.read_csv(os.path.join(self.out_path, str(rivid), file_name))
+                    )
+
+    def test_extract_by_rivids_parquet(self):
+        work_dir = os.path.join(self.cwd, "Test_files/Forecast_Validation_Files")
+        parquet_path = os.path.join(self.out_path, "parquet")
+        extract_by_rivids(rivids=[192450, 192451], folder_path=work_dir, outpath=parquet_path, output_format="parquet")
+
+        test_df = pd.read_parquet(parquet_path)
+        test_df = test_df[test_df["rivid"] == 192451]
+
+        # Comparing with the CSV files of the rivid (Generated in setUp)
+        forecasts = test_df[(test_df["lead_day"] == 3) & (test_df["member"] >= 1) & (test_df["member"] <= 51)]
+        forecasts = forecasts.pivot(index="start_date", columns="member", values="flow")
+        truth = pd.read_csv(os.path.join(self.out_path, "3_Day_Forecasts.csv"), index_col=0)
+
+        initialization = test_df[test_df["member"] == 0].set_index("start_date")["flow"]
+        init_truth = pd.read_csv(os.path.join(self.out_path, "Initialization_Values.csv"), index_col=0)
+
+        high_res = test_df[(test_df["member"] == 52) & (test_df["lead_day"] == 10)].set_index("start_date")["flow"]
+        high_res_truth = pd.read_csv(os.path.join(self.out_path, "10_Day_Forecasts_High_Res.csv"), index_col=0)
+
+        # Testing
+        self.assertEqual(len(test_df), 120 * (1 + 15 * 51 + 10))
+        self.assertTrue(np.allclose(forecasts.values, truth.values))
+        self.assertTrue(np.allclose(initialization.values, init_truth.values[:, 0]))
+        self.assertTrue(np.allclose(high_res.values, high_res_truth.values[:, 0]))
+
+    def tearDown(self):
+        shutil.rmtree(self.out_path)
+
+
+class TestZarrArchive(unittest.TestCase):
+    """
+    Tests that the validation and the extraction give the same results with a Zarr archive of the forecast files as
+    with the directory of forecast files.
+    """
+
+    def setUp(self):
+        self.cwd = os.path.dirname(os.path.abspath(__file__))
+        self.work_dir = os.path.join(self.cwd, "Test_files/Forecast_Validation_Files")
+        self.store_path = os.path.join(self.cwd, "Test_files/Forecast_Validation_Archive.zarr")
+        self.out_path = os.path.join(self.cwd, "Test_files/Zarr_archive_test")
+        if not os.path.exists(self.out_path):
+            os.mkdir(self.out_path)
+
+        for file in sorted(os.listdir(self.work_dir)):
+            append_to_zarr_archive(os.path.join(self.work_dir, file), self.store_path)
+
+    def test_compute_all(self):
+        csv_path = os.path.join(self.out_path, "Forecast_analysis_test.csv")
+        compute_all(self.store_path, out_path=csv_path, memory_to_allocate_gb=1.0)
+
+        pickle_path = os.path.join(self.cwd, r"Test_files/Comparison_Files/benchmark_forecast_validation_df.pkl")
+        true_df = pd.read_pickle(pickle_path)
+        test_df = pd.read_csv(csv_path)
+
+        pd.testing.assert_frame_equal(true_df, test_df, check_less_precise=3)
+
+    def test_extract_by_rivid(self):
+        archive_path = os.path.join(self.out_path, "archive")
+        folder_path = os.path.join(self.out_path, "folder")
+        os.mkdir(archive_path)
+        os.mkdir(folder_path)
+
+        extract_by_rivid(rivid=192451, folder_path=self.store_path, outpath=archive_path)
+        extract_by_rivid(rivid=192451, folder_path=self.work_dir, outpath=folder_path)
+
+        for file_name in sorted(os.listdir(folder_path)):
+            with self.subTest(file_name=file_name):
+                pd.testing.assert_frame_equal(
+                    pd.read_csv(os.path.join(folder_path, file_name)),
+                    pd.read_csv(os.path.join(archive_path, file_name))
+                )
+
+    def test_append_to_zarr_archive_packing(self):
+        # The log(1 + flow) values of a log packed file would be read as flows in an archive of unpacked flows
+        folder_path = os.path.join(self.cwd, "Test_files/Individual_Ensembles_20190104")
+        compress_netcfd(folder_path, self.out_path, "Qout_south_america_continental", max_workers=1, pack="log")
+        packed_file = os.path.join(self.out_path, "20190104.nc")
+
+        with self.assertRaisesRegex(ValueError, "not packed like"):
+            append_to_zarr_archive(packed_file, self.store_path)
+
+        # Same the other way round
+        packed_store_path = os.path.join(self.out_path, "Packed_Archive.zarr")
+        append_to_zarr_archive(packed_file, packed_store_path)
+        with self.assertRaisesRegex(ValueError, "not packed like"):
+            append_to_zarr_archive(os.path.join(self.work_dir, "20181216.nc"), packed_store_path)
+
+        # The archive keeps the packing of the file it was created from
+        with xr.open_zarr(packed_store_path) as archive, xr.open_dataset(packed_file) as ds:
+            self.assertEqual(archive["Qout"].encoding["dtype"], np.int16)
+            np.testing.assert_array_equal(archive["Qout"].values[0], ds["Qout"].values)
+
     def tearDown(self):
+        shutil.rmtree(self.store_path)
         shutil.rmtree(self.out_path)
 
 
+class TestOrganizeForecasts(unittest.TestCase):
+
+    def setUp(self):
+        self.forecast_dir = tempfile.mkdtemp()
+        self.out_dir = tempfile.mkdtemp()
+
+        # Three days of forecasts in the format of the Streamflow Prediction Tool REST API, with a truncated download
+        self.start_dates = pd.date_range("2019-01-01", periods=3)
+        self.forecasts = [write_api_forecast(
+            os.path.join(self.forecast_dir, date.strftime("%Y%m%d.csv")), date, seed
+        ) for seed, date in enumerate(self.start_dates)]
+
+        with open(os.path.join(self.forecast_dir, "20190102.csv")) as f:
+            lines = f.readlines()
+        with open(os.path.join(self.forecast_dir, "20190102.csv"), "w") as f:
+            f.writelines(lines[:20])
+
+    def test_organize_api_forecasts(self):
+        malformed_files = organize_api_forecasts(self.forecast_dir, self.out_dir, max_workers=2)
+        self.assertEqual(list(malformed_files), [os.path.join(self.forecast_dir, "20190102.csv")])
+
+        # One file per forecast day, the truncated file is left out
+        self.assertEqual(len(os.listdir(self.out_dir)), 15 + 10 + 1)
+        day_3_df = pd.read_csv(os.path.join(self.out_dir, "3_Day_0_Hour_Forecast.csv"), index_col=0)
+        np.testing.assert_array_equal(
+            pd.to_datetime(day_3_df.index), self.start_dates[[0, 2]] + pd.DateOffset(days=3)
+        )
+
+        for row, forecast_df in zip(day_3_df.values, (self.forecasts[0], self.forecasts[2])):
+            expected = forecast_df.loc[forecast_df.index[0] + pd.DateOffset(days=3)].values[:-1]
+            np.testing.assert_allclose(row, expected, rtol=1e-6)
+
+    def test_organize_api_forecasts_spawn(self):
+        # The workers are spawned on the platforms without a fork server, and the files are parsed in this process by
+        # default, with the same results
+        with mock.patch("global_forecast_validation.organize_forecasts.get_all_start_methods", return_value=["spawn"]):
+            organize_api_forecasts(self.forecast_dir, self.out_dir, max_workers=2)
+        spawned_df = pd.read_csv(os.path.join(self.out_dir, "3_Day_0_Hour_Forecast.csv"))
+
+        organize_api_forecasts(self.forecast_dir, self.out_dir)
+        pd.testing.assert_frame_equal(pd.read_csv(os.path.join(self.out_dir, "3_Day_0_Hour_Forecast.csv")), spawned_df)
+
+    def test_organize_api_forecasts_append(self):
+        # Organizing the first day, then appending the next days gives the same files as organizing all of them
+        new_file_path = os.path.join(self.forecast_dir, "20190103.csv")
+        shutil.move(new_file_path, self.out_dir)
+        organize_api_forecasts(self.forecast_dir, self.out_dir, max_workers=1, append=True)
+        shutil.move(os.path.join(self.out_dir, "20190103.csv"), new_file_path)
+
+        malformed_files = organize_api_forecasts(self.forecast_dir, self.out_dir, max_workers=1, append=True)
+        self.assertEqual(list(malformed_files), [os.path.join(self.forecast_dir, "20190102.csv")])
+        self.assertEqual(organize_api_forecasts(self.forecast_dir, self.out_dir, max_workers=1, append=True), {})
+        self.assert_same_as_full_run()
+
+    def test_organize_api_forecasts_append_interrupted(self):
+        new_file_path = os.path.join(self.forecast_dir, "20190103.csv")
+        shutil.move(new_file_path, self.out_dir)
+        organize_api_forecasts(self.forecast_dir, self.out_dir, max_workers=1)
+        shutil.move(os.path.join(self.out_dir, "20190103.csv"), new_file_path)
+
+        # The append is killed while writing the sixth file, after only a part of its row was written
+        written_paths = []
+
+        def interrupted_write(path, out_df, appending=False):
+            if len(written_paths) == 5:
+                with open(path, "a") as f:
+                    f.write("2019-01-0")
+                raise KeyboardInterrupt
+            written_paths.append(path)
+            write_organized_csv(path, out_df, appending)
+
+        with mock.patch("global_forecast_validation.organize_forecasts.write_organized_csv", interrupted_write):
+            with self.assertRaises(KeyboardInterrupt):
+                organize_api_forecasts(self.forecast_dir, self.out_dir, max_workers=1, append=True)
+
+        # Running it again completes the files without writing the rows of the first five files twice
+        organize_api_forecasts(self.forecast_dir, self.out_dir, max_workers=1, append=True)
+        self.assert_same_as_full_run()
+
+    def test_organize_api_forecasts_append_partial_row(self):
+        new_file_path = os.path.join(self.forecast_dir, "20190103.csv")
+        shutil.move(new_file_path, self.out_dir)
+        organize_api_forecasts(self.forecast_dir, self.out_dir, max_workers=1)
+        shutil.move(os.path.join(self.out_dir, "20190103.csv"), new_file_path)
+
+        # An append was killed after it only wrote a part of a row
+        partial_path = os.path.join(self.out_dir, "3_Day_0_Hour_Forecast.csv")
+        with open(partial_path, "a") as f:
+            f.write("2019-01-06 00:00:00,1.5,2.")
+        with open(partial_path) as f:
+            partial_contents = f.read()
+
+        # Finding where to append from only reads the files
+        self.assertEqual(organized_last_start_date(self.out_dir), pd.Timestamp("2019-01-01"))
+        with open(partial_path) as f:
+            self.assertEqual(f.read(), partial_contents)
+
+        # The partial row is removed before the new rows are appended
+        organize_api_forecasts(self.forecast_dir, self.out_dir, max_workers=1, append=True)
+        with open(partial_path) as f:
+            self.assertNotIn("1.5,2.\n", f.read())
+        self.assert_same_as_full_run()
+
+    def test_organize_api_forecasts_append_interrupted_parquet(self):
+        new_file_path = os.path.join(self.forecast_dir, "20190103.csv")
+        shutil.move(new_file_path, self.out_dir)
+        organize_api_forecasts(self.forecast_dir, self.out_dir, output_format="parquet", max_workers=1)
+        shutil.move(os.path.join(self.out_dir, "20190103.csv"), new_file_path)
+        organize_api_forecasts(self.forecast_dir, self.out_dir, output_format="parquet", max_workers=1, append=True)
+
+        # The append is killed before writing the files of some of the lead times, and while writing one of them
+        appended_files = sorted(
+            os.path.join(root, name) for root, _, names in os.walk(self.out_dir) for name in names
+            if name.startswith("part-2019010300")
+        )
+        for file in appended_files[::2]:
+            os.remove(file)
+        with open(appended_files[1], "r+b") as f:
+            f.truncate(100)
+
+        organize_api_forecasts(self.forecast_dir, self.out_dir, output_format="parquet", max_workers=1, append=True)
+        self.assert_same_as_full_run("parquet")
+
+    def assert_same_as_full_run(self, output_format="csv"):
+        """Checks that the organized forecasts are the same as the forecasts organized from scratch."""
+        full_out_dir = tempfile.mkdtemp()
+        try:
+            organize_api_forecasts(self.forecast_dir, full_out_dir, output_format=output_format, max_workers=1)
+
+            if output_format == "parquet":
+                columns = ["lead_day", "lead_hour", "start_date", "member"]
+                pd.testing.assert_frame_equal(
+                    pd.read_parquet(self.out_dir).sort_values(columns).reset_index(drop=True),
+                    pd.read_parquet(full_out_dir).sort_values(columns).reset_index(drop=True)
+                )
+                return
+
+            self.assertEqual(sorted(os.listdir(self.out_dir)), sorted(os.listdir(full_out_dir)))
+            for file_name in os.listdir(full_out_dir):
+                pd.testing.assert_frame_equal(
+                    pd.read_csv(os.path.join(self.out_dir, file_name)),
+                    pd.read_csv(os.path.join(full_out_dir, file_name))
+                )
+        finally:
+            shutil.rmtree(full_out_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.forecast_dir)
+        shutil.rmtree(self.out_dir)
+
+
+def write_api_forecast(path, start_date, seed=0):
+    """
+    Writes a forecast in the CSV format of the Streamflow Prediction Tool REST API: the 51 ensembles (3 hourly, then 6
+    hourly for 15 days) and the high resolution forecast (hourly, 3 hourly, then 6 hourly for 10 days). Returns it.
+    """
+    rng = np.random.RandomState(seed)
+    ensemble_hours = np.concatenate([np.arange(0, 144, 3), np.arange(144, 361, 6)])
+    high_res_hours = np.concatenate([np.arange(0, 90), np.arange(90, 144, 3), np.arange(144, 241, 6)])
+    hours = np.union1d(ensemble_hours, high_res_hours)
+
+    forecast_df = pd.DataFrame(
+        np.nan, index=start_date + pd.to_timedelta(hours, unit="h"),
+        columns=["ensemble_{:02d} (m^3/s)".format(i) for i in range(1, 52)] + ["high_res (m^3/s)"]
+    )
+    forecast_df.iloc[np.isin(hours, ensemble_hours), :-1] = np.round(rng.gamma(2., 50., (ensemble_hours.size, 51)), 3)
+    forecast_df.iloc[np.isin(hours, high_res_hours), -1] = np.round(rng.gamma(2., 50., high_res_hours.size), 3)
+    forecast_df.to_csv(path, index_label="datetime")
+
+    return forecast_df
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.path.dirname(os.path.abspath(__file__))
+        self.work_dir = os.path.join(self.cwd, "Test_files/Forecast_Validation_Files")
+        self.csv_path = os.path.join(self.cwd, "Test_files/Forecast_analysis_profile_test.csv")
+        self.report_path = os.path.join(self.cwd, "Test_files/Forecast_analysis_profile_test.json")
+
+    def test_profile_compute_all(self):
+        # Enough memory for three rivids at a time, so that the ten rivids are read in several chunks
+        with profiling(self.report_path, ["validate"]):
+            compute_all(self.work_dir, out_path=self.csv_path, memory_to_allocate_gb=0.0035)
+
+        with open(self.report_path) as f:
+            report = json.load(f)
+
+        self.assertEqual(report["command"], ["validate"])
+        self.assertIsNone(report["error"])
+        num_of_files = len(os.listdir(self.work_dir))
+        self.assertEqual(report["summary"]["open_file"]["count"], num_of_files)
+
+        # Every rivid is read and validated once, over all of the start dates
+        for name in ("read_chunk", "kernel", "write_results"):
+            self.assertEqual(report["summary"][name]["rivid_days"], 10 * num_of_files)
+        # The flows are read as float64 (see the precision of compute_all)
+        self.assertEqual(report["summary"]["read_chunk"]["bytes_read"], 10 * num_of_files * (15 * 51 + 1) * 8)
+
+        chunks = [record["chunk"] for record in report["stages"] if record["name"] == "kernel"]
+        self.assertEqual(chunks, sorted(chunks))
+        self.assertEqual(chunks[0], 0)
+
+        # The first chunk is validated after the files are opened and before the end of the run
+        first_chunk_seconds = report["milestones"]["first_chunk"]["seconds"]
+        self.assertGreater(first_chunk_seconds, 0)
+        self.assertLess(first_chunk_seconds, report["total_seconds"])
+
+    def tearDown(self):
+        for path in (self.csv_path, self.report_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        # The libraries of the commands are only imported when a command is run
+        code = "import sys, global_forecast_validation.command_line; " \
+               "print(' '.join(m for m in ('numba', 'xarray', 'dask', 'pandas') if m in sys.modules))"
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=package_path, universal_newlines=True)
+        self.assertEqual(output.strip(), "")
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -4,11 +4,51 @@ import numpy as np
 import os
 import numba as nb
 import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import dask.array as da
 from progress.bar import FillingCirclesBar
-
-
-def compute_all(work_dir, out_path, memory_to_allocate_gb, starting_date=None, ending_date=None):
+from global_forecast_validation.compress_netcdf import unpack_flows
+from global_forecast_validation.zarr_archive import is_zarr_archive, open_zarr_archive
+from global_forecast_validation.shards import shard_bounds, shard_path
+from global_forecast_validation.checkpoints import open_checkpoint, save_chunk, load_chunk, remove_checkpoint
+from global_forecast_validation.profiling import stage, record_milestone, process_seconds, current_rss_bytes, \
+    reset_peak_rss, peak_rss_bytes
+
+
+# Sufficient statistics of the metrics of each stream and forecast day (see numba_calculate_statistics)
+STATISTICS = [
+    "count", "crps_sum", "ens_abs_error_sum", "ens_sq_error_sum", "bench_abs_error_sum", "bench_sq_error_sum",
+    "obs_mean", "ens_mean_mean", "bench_mean", "obs_m2", "ens_m2", "bench_m2", "ens_comoment", "bench_comoment"
+]
+NUM_STATISTICS = len(STATISTICS)
+
+# Columns of the results of compute_all
+RESULT_COLUMNS = [
+    'Rivid', 'Forecast Day', 'CRPS', 'CRPS BENCH', 'CRPSS', "MAE", "MAE_BENCH", "MAESS", "MSE", "MSE_BENCH", "MSESS",
+    "RMSE", "RMSE_BENCH", "RMSESS", "Pearson_r", "Pearson_r_BENCH", "Pearson_r_SS"
+]
+
+# Columns of the deterministic metrics of the high resolution forecast (see numba_calculate_high_res_metrics), and
+# the indices of the same metrics in the results of numba_calculate_metrics. The benchmark is the same persistence
+# benchmark as for the ensemble, so its metrics are not repeated
+HIGH_RES_COLUMNS = [
+    "HRES_MAE", "HRES_MAESS", "HRES_MSE", "HRES_MSESS", "HRES_RMSE", "HRES_RMSESS", "HRES_Pearson_r",
+    "HRES_Pearson_r_SS"
+]
+HIGH_RES_METRICS = np.array([3, 5, 6, 8, 9, 11, 12, 14])
+
+# Floating point types of the flows held in the chunks of compute_all and of the arithmetic of the kernels (see
+# numba_calculate_metrics), float64 by default. float32 halves the memory of each rivid, so the chunks are larger
+PRECISIONS = {"float64": np.float64, "float32": np.float32}
+
+# Bytes of the results of one rivid in a chunk: the results array of numba_calculate_metrics (15 days x 15 metrics,
+# float64) and the 15 rows of the DataFrame that is written to the output file, plus a copy of them while writing
+RESULTS_BYTES_PER_RIVID = 15 * 15 * 8 + 2 * 15 * len(RESULT_COLUMNS) * 8
+
+
+def compute_all(work_dir, out_path, memory_to_allocate_gb, starting_date=None, ending_date=None, output_format="csv",
+                shard=None, high_res=False, checkpoint_dir=None, precision="float64"):
     """Computes forecast metrics for all of the streams in a region.
 
     Note that this function assumes that the same naming convention as the `compress_netcdf.py` file produces is used
@@ -26,17 +66,19 @@ def compute_all(work_dir, out_path, memory_to_allocate_gb, starting_date=None, e
 
     work_dir: str
         The directory that contains all of the forecast files that were created with the compress_netcdf function. Make
-        sure that this directory only contains the compressed forecast files.
+        sure that this directory only contains the compressed forecast files. A Zarr archive created with
+        append_to_zarr_archive can also be given instead of the directory.
 
     out_path: str
-        The path where the resulting CSV of results should be stored. Include the file name in this path! For example,
-        if I wanted the file to be stored in the same directory as I ran the script in, I would simply set this
-        parameter to be the name of the file (ie Skill_Scores.csv).
+        The path where the resulting CSV (or Parquet file) of results should be stored. Include the file name in this
+        path! For example, if I wanted the file to be stored in the same directory as I ran the script in, I would
+        simply set this parameter to be the name of the file (ie Skill_Scores.csv).
 
     memory_to_allocate_gb: float
-        Indicates the memory that you would like to be allocated on the computer when running the program. It is highly
-        recommended to be conservative in this number as slightly more memory may be consumed (maybe up to half a gig
-        in very large regions).
+        Indicates the memory that you would like to be allocated on the computer when running the program. The
+        streams are processed in chunks whose size is planned from the data types and the number of start dates (see
+        plan_chunk_size), and corrected with the memory that the process actually used for the first chunks. The
+        memory used before the analysis starts (e.g. the Python interpreter and the loaded libraries) is not included.
 
     starting_date: str
         The starting date of the analysis formatted as YYYY-MM-DD (i.e. January 2, 2019 would be 2019-01-02).
@@ -44,14 +86,262 @@ def compute_all(work_dir, out_path, memory_to_allocate_gb, starting_date=None, e
     ending_date: str
         The ending date of the analysis formatted as YYYY-MM-DD (i.e. January 2, 2019 would be 2019-01-02).
 
+    output_format: str
+        Either "csv" (default) or "parquet". The results of each chunk of streams are appended to the file as soon as
+        they are computed.
+
+    shard: tuple of int
+        If given as (i, N), only the i-th of N contiguous and balanced slices of the rivids is validated (i starting at
+        0), and the results are written next to out_path with the shard in the name (e.g.
+        Skill_Scores.shard-0003-of-0016.csv, see shard_path). The shards can be run as independent jobs and then
+        merged into out_path with merge_shards.
+
+    high_res: bool
+        If True, the high resolution forecast (Qout_high_res) is read in the same chunks as the ensembles and its
+        deterministic metrics and persistence skill scores are added as the columns of HIGH_RES_COLUMNS (MAE, MSE,
+        RMSE and Pearson R). The high resolution forecast only covers 10 days, so these columns are empty (NaN) for
+        forecast days 11 to 15.
+
+    checkpoint_dir: str
+        If given, the results of each chunk of streams are also saved in this directory, with a manifest of the run
+        (the forecast files, the rivids, the chunk size...). If the run is interrupted, running compute_all again with
+        the same arguments writes the saved results to out_path and only computes the remaining chunks. The directory
+        is removed once the run is finished.
+
+    precision: str
+        Either "float64" (default) or "float32", the floating point type that the flows are read as and of the
+        arithmetic of the validation (see PRECISIONS). In float32 each rivid takes about half of the memory, so about
+        twice as many rivids fit in each chunk, and the metrics match the float64 metrics to about five significant
+        digits.
+
     """
+    # The time to the first chunk of results is reported, which includes opening the files and compiling (or loading
+    # from the cache) the Numba kernels
+    run_start = time.perf_counter()
+    first_chunk_seconds = None
+
     # Checking how many rivids can be held in memory
-    array_size_bytes = 3060  # Based on 15 x 51 member array
     memory_to_allocate_bytes = memory_to_allocate_gb * 1e9
+    float_type = precision_type(precision)
+
+    if is_zarr_archive(work_dir):
+        archive = open_zarr_archive(work_dir, starting_date, ending_date)
+        number_of_start_dates = archive["start_date"].size
+
+        if np.any(np.diff(archive["start_date"].values) != np.timedelta64(1, "D")):
+            raise ValueError("The start dates in the archive must be consecutive daily values.")
+
+        big_dask_q_array = read_flows(archive["Qout"], float_type)
+        big_dask_init_array = read_flows(archive["initialization_values"], float_type)
+        big_dask_high_res_array = read_flows(archive["Qout_high_res"], float_type) if high_res else None
+        presorted = bool(archive.attrs.get("ensembles_sorted", 0))
+
+        rivids = archive['rivid'].values
+        start_dates = pd.DatetimeIndex(archive["start_date"].values).strftime("%Y-%m-%d").tolist()
+
+        if shard is not None:
+            shard_start, shard_end = shard_bounds(rivids.size, shard)
+            big_dask_q_array = big_dask_q_array[:, shard_start:shard_end]
+            big_dask_init_array = big_dask_init_array[:, shard_start:shard_end]
+            if high_res:
+                big_dask_high_res_array = big_dask_high_res_array[:, shard_start:shard_end]
+            rivids = rivids[shard_start:shard_end]
+
+        num_of_streams = rivids.size
+
+        # Calculating the size of the chunk of data that can be held in memory
+        chunk_size, bytes_per_rivid, fixed_bytes = plan_chunk_size(
+            memory_to_allocate_bytes, number_of_start_dates, num_of_streams, big_dask_q_array.dtype,
+            big_dask_init_array.dtype, big_dask_high_res_array.dtype if high_res else None
+        )
+
+    else:
+        # Getting the file names
+        files = forecast_files(work_dir, starting_date, ending_date)
+        start_dates = [os.path.basename(file) for file in files]
+
+        number_of_start_dates = len(files)
+
+        # Retrieving the number of streams and their corresponding Rivids, and the data types of the flows
+        tmp_dataset = xr.open_dataset(files[0])
+
+        rivids = tmp_dataset['rivid'].data
+        shard_start, shard_end = (0, rivids.size) if shard is None else shard_bounds(rivids.size, shard)
+        rivids = rivids[shard_start:shard_end]
+        num_of_streams = rivids.size
+        tmp_dataset.close()
+
+        # The flows are read in the floating point type of the precision (see read_flows)
+        q_dtype, init_dtype = np.dtype(float_type), np.dtype(float_type)
+        high_res_dtype = np.dtype(float_type) if high_res else None
+
+        # Calculating the size of the chunk of data that can be held in memory
+        chunk_size, bytes_per_rivid, fixed_bytes = plan_chunk_size(
+            memory_to_allocate_bytes, number_of_start_dates, num_of_streams, q_dtype, init_dtype, high_res_dtype
+        )
+
+        # Creating a large dask array with all of the data in it
+        list_of_dask_q_arrays = []
+        list_of_dask_init_arrays = []
+        list_of_dask_high_res_arrays = []
+        presorted = True  # True if the ensembles are stored sorted in all of the files (see compress_netcdf)
+
+        for file in files:
+            with stage("open_file"):
+                # Chunking after selecting the rivids of the shard so that the chunks start at the first rivid of the
+                # shard
+                ds = xr.open_dataset(file).isel(rivid=slice(shard_start, shard_end)).chunk({"rivid": chunk_size})
+                presorted = presorted and bool(ds.attrs.get("ensembles_sorted", 0))
+
+                tmp_dask_q_array = read_flows(ds["Qout"], float_type)
+                list_of_dask_q_arrays.append(tmp_dask_q_array)
+
+                tmp_dask_init_array = read_flows(ds["initialization_values"], float_type)
+                list_of_dask_init_arrays.append(tmp_dask_init_array)
+
+                if high_res:
+                    list_of_dask_high_res_arrays.append(read_flows(ds["Qout_high_res"], float_type))
+
+                ds.close()
+
+        big_dask_q_array = da.stack(list_of_dask_q_arrays)
+        big_dask_init_array = da.stack(list_of_dask_init_arrays)
+        big_dask_high_res_array = da.stack(list_of_dask_high_res_arrays) if high_res else None
+
+    if shard is not None:
+        out_path = shard_path(out_path, shard)
+
+    # The chunks of rivids that were completed by an interrupted run with the same manifest
+    if checkpoint_dir is not None:
+        manifest = {
+            "work_dir": os.path.abspath(work_dir),
+            "start_dates": start_dates,
+            "num_of_streams": int(num_of_streams),
+            "first_rivid": int(rivids[0]),
+            "last_rivid": int(rivids[-1]),
+            "shard": shard,
+            "high_res": high_res,
+            "chunk_size": int(chunk_size),
+            "precision": precision,
+        }
+        completed_chunks = open_checkpoint(checkpoint_dir, manifest)
+    else:
+        completed_chunks = []
+
+    start_chunk = completed_chunks[-1][1] if completed_chunks else 0
+    if completed_chunks:
+        print("Resuming from the checkpoint in {} with {} of {} rivids completed".format(
+            checkpoint_dir, start_chunk, num_of_streams
+        ))
+
+    # The memory used by the first chunks is measured to correct the chunk size for the rest of the run
+    reset_peak_rss()
+    baseline_rss = current_rss_bytes()
+
+    # Main Loop, the next chunk is read in a background thread while the metrics of the current chunk are computed
+    filling = FillingCirclesBar('Validating Forecasts', max=num_of_streams)  # Progress bar
+    with ThreadPoolExecutor(max_workers=1) as reader, results_writer(out_path, output_format) as write_results:
+        for completed_start_chunk, completed_end_chunk, path in completed_chunks:
+            with stage("restore_checkpoint", completed_start_chunk):
+                results_array, high_res_results_array = load_chunk(path)
+                write_results(results_frame(
+                    results_array, rivids[completed_start_chunk:completed_end_chunk], high_res_results_array
+                ))
+            filling.next(completed_end_chunk - completed_start_chunk)
+
+        next_start_chunk = min(start_chunk + chunk_size, num_of_streams)
+        if start_chunk < num_of_streams:
+            next_chunk = reader.submit(
+                read_chunk, big_dask_q_array, big_dask_init_array, start_chunk, next_start_chunk,
+                big_dask_high_res_array
+            )
+        else:
+            next_chunk = None
+        chunk_number = 0
+
+        while next_chunk is not None:
+
+            big_forecast_data_array, big_init_data_array, big_high_res_data_array = next_chunk.result()
+            end_chunk = start_chunk + big_forecast_data_array.shape[1]
+
+            # The peak memory use is known once the first chunk has been computed while the second one was read
+            peak_rss = peak_rss_bytes() if chunk_number == 1 else None
+            if baseline_rss is not None and peak_rss is not None:
+                measured_bytes_per_rivid = (peak_rss - baseline_rss) / chunk_size
+                chunk_size = adapt_chunk_size(
+                    chunk_size, bytes_per_rivid, measured_bytes_per_rivid, memory_to_allocate_bytes - fixed_bytes
+                )
+
+            if next_start_chunk < num_of_streams:
+                next_end_chunk = min(next_start_chunk + chunk_size, num_of_streams)
+                next_chunk = reader.submit(
+                    read_chunk, big_dask_q_array, big_dask_init_array, next_start_chunk, next_end_chunk,
+                    big_dask_high_res_array
+                )
+                next_start_chunk = next_end_chunk
+            else:
+                next_chunk = None
+
+            rivids_chunk = rivids[start_chunk:end_chunk]
+            rivid_days = rivids_chunk.size * number_of_start_dates
+
+            # Main calculations, performed with Numba and the LLVM compiler infrastructure
+            with stage("kernel", start_chunk, rivid_days=rivid_days):
+                results_array = numba_calculate_metrics(
+                    big_forecast_data_array, big_init_data_array, number_of_start_dates,
+                    big_forecast_data_array.shape[1], 15, rivids_chunk, presorted, precision
+                )
+
+            if high_res:
+                with stage("high_res_kernel", start_chunk, rivid_days=rivid_days):
+                    high_res_results_array = numba_calculate_high_res_metrics(
+                        big_high_res_data_array, big_init_data_array, number_of_start_dates,
+                        big_high_res_data_array.shape[1], big_high_res_data_array.shape[2], precision
+                    )
+            else:
+                high_res_results_array = None
+
+            with stage("assemble_results", start_chunk, rivid_days=rivid_days):
+                results_df = results_frame(results_array, rivids_chunk, high_res_results_array)
+
+            with stage("write_results", start_chunk, rivid_days=rivid_days):
+                write_results(results_df)
+
+            if checkpoint_dir is not None:
+                with stage("save_checkpoint", start_chunk):
+                    save_chunk(checkpoint_dir, start_chunk, end_chunk, results_array, high_res_results_array)
+
+            if chunk_number == 0:
+                first_chunk_seconds = time.perf_counter() - run_start
+                first_chunk_process_seconds = process_seconds()
+                record_milestone("first_chunk", first_chunk_seconds, first_chunk_process_seconds)
+
+            filling.next(end_chunk - start_chunk)  # Next progress bar
+
+            start_chunk = end_chunk
+            chunk_number += 1
+
+    filling.finish()
+
+    if first_chunk_seconds is not None:
+        if first_chunk_process_seconds is None:
+            print("The first chunk was validated in {:.2f} s".format(first_chunk_seconds))
+        else:
+            print("The first chunk was validated in {:.2f} s ({:.2f} s after the process started)".format(
+                first_chunk_seconds, first_chunk_process_seconds
+            ))
 
-    # Getting the file names
+    if checkpoint_dir is not None:
+        remove_checkpoint(checkpoint_dir)
+
+    print("Finished")
+
+
+def forecast_files(work_dir, starting_date=None, ending_date=None):
+    """Lists the compressed forecast files in work_dir (all of them or the ones between the start and end dates)."""
     if (starting_date is None) and (ending_date is None):
-        files = [os.path.join(work_dir, i) for i in os.listdir(work_dir)]
+        # Leaving out the temporary files of compress_netcfd
+        files = [os.path.join(work_dir, i) for i in os.listdir(work_dir) if i.endswith(".nc")]
         files.sort()
     elif starting_date and ending_date:
         dates_range = pd.date_range(starting_date, ending_date)
@@ -60,88 +350,188 @@ def compute_all(work_dir, out_path, memory_to_allocate_gb, starting_date=None, e
     else:
         raise RuntimeError("Either both the starting and ending date must be specified or neither.")
 
-    # Calculating the size of the chunk of data that can be held in memory
-    chunk_size = int(np.floor(memory_to_allocate_bytes / ((array_size_bytes * len(files)) + len(files))))
-
-    # Creating a large dask array with all of the data in it
-    list_of_dask_q_arrays = []
-    list_of_dask_init_arrays = []
+    return files
 
-    for file in files:
-        ds = xr.open_dataset(file, chunks={"rivid": chunk_size})
 
-        tmp_dask_q_array = ds["Qout"].data
-        list_of_dask_q_arrays.append(tmp_dask_q_array)
+def plan_chunk_size(memory_to_allocate_bytes, number_of_start_dates, num_of_streams, q_dtype, init_dtype,
+                    high_res_dtype=None):
+    """
+    Calculates the number of rivids in each chunk of compute_all from the memory used by the data of one rivid. The
+    estimate accounts for the chunk being computed, the next chunk being read (which dask first reads file by file
+    and then copies into one array), the results of the chunk and, for the whole run, the scratch arrays of the kernel.
 
-        tmp_dask_init_array = ds["initialization_values"].data
-        list_of_dask_init_arrays.append(tmp_dask_init_array)
+    Parameters
+    ----------
 
-        ds.close()
+    memory_to_allocate_bytes: float
+        The memory that can be used, in bytes.
 
-    big_dask_q_array = da.stack(list_of_dask_q_arrays)
-    big_dask_init_array = da.stack(list_of_dask_init_arrays)
+    number_of_start_dates: int
+        The number of start dates in the analysis.
 
-    # Retrieving the number of streams and their corresponding Rivids
-    tmp_dataset = xr.open_dataset(files[0])
+    num_of_streams: int
+        The number of streams in the analysis.
 
-    num_of_streams = tmp_dataset['rivid'].size
-    rivids = tmp_dataset['rivid'].data
+    q_dtype: numpy.dtype
+        The data type of the forecasts once they are read.
 
-    tmp_dataset.close()
+    init_dtype: numpy.dtype
+        The data type of the initialization values once they are read.
 
-    # Calculating the amount of iterations necessary to loop through all of the rivid chunks
-    num_chunk_iterations = int(np.ceil(num_of_streams / chunk_size))
-    start_chunk = 0
-    end_chunk = chunk_size
-    list_of_tuples_with_metrics = []
+    high_res_dtype: numpy.dtype
+        The data type of the high resolution forecasts once they are read, if they are validated too.
 
-    # Main Loop
-    filling = FillingCirclesBar('Validating Forecasts', max=num_chunk_iterations)  # Progress bar
-    for chunk_number in range(num_chunk_iterations):
+    Returns
+    -------
+    tuple
+        The number of rivids in each chunk, the estimated bytes used for each rivid in a chunk and the bytes used
+        independently of the chunk size.
+    """
+    rivid_bytes = number_of_start_dates * (15 * 51 * np.dtype(q_dtype).itemsize + np.dtype(init_dtype).itemsize)
+    bytes_per_rivid = 3 * rivid_bytes + RESULTS_BYTES_PER_RIVID
 
-        big_forecast_data_array = np.asarray(big_dask_q_array[:, start_chunk:end_chunk, :, :])
-        big_init_data_array = np.asarray(big_dask_init_array[:, start_chunk:end_chunk])
+    if high_res_dtype is not None:
+        high_res_bytes = number_of_start_dates * 10 * np.dtype(high_res_dtype).itemsize
+        bytes_per_rivid += 3 * high_res_bytes + 10 * len(HIGH_RES_COLUMNS) * 4 + 2 * 15 * len(HIGH_RES_COLUMNS) * 8
 
-        rivids_chunk = rivids[start_chunk:end_chunk]
+    fixed_bytes = nb.get_num_threads() * 51 * 8
 
-        # Main calculations, performed with Numba and the LLVM compiler infrastructure
-        results_array = numba_calculate_metrics(
-            big_forecast_data_array, big_init_data_array, len(files), big_forecast_data_array.shape[1], 15, rivids_chunk
+    if memory_to_allocate_bytes - fixed_bytes < bytes_per_rivid:
+        raise ValueError(
+            "At least {:.3g} GB of memory are needed for this analysis.".format((fixed_bytes + bytes_per_rivid) / 1e9)
         )
 
-        for rivid in range(results_array.shape[1]):
-            for forecast_day in range(results_array.shape[0]):
-                tmp_array = results_array[forecast_day, rivid, :]
-                tuple_to_append = (
-                    rivids_chunk[rivid], forecast_day + 1, tmp_array[0], tmp_array[1], tmp_array[2], tmp_array[3],
-                    tmp_array[4], tmp_array[5], tmp_array[6], tmp_array[7], tmp_array[8], tmp_array[9], tmp_array[10],
-                    tmp_array[11], tmp_array[12], tmp_array[13], tmp_array[14]
-                )
-                list_of_tuples_with_metrics.append(tuple_to_append)
+    chunk_size = int((memory_to_allocate_bytes - fixed_bytes) // bytes_per_rivid)
 
-        start_chunk += chunk_size
-        end_chunk += chunk_size
+    return min(chunk_size, num_of_streams), bytes_per_rivid, fixed_bytes
 
-        filling.next()  # Next progress bar
 
-    filling.finish()
+def read_flows(data_array, float_type):
+    """
+    Returns the flows of a DataArray opened from a compressed forecast file (see unpack_flows) in float_type, the
+    working type of the chunks of compute_all. The files store float32 (or 16 bit packed) flows, so the conversion to
+    float64 is exact.
+    """
+    flows = unpack_flows(data_array)
+    if flows.dtype != float_type:
+        flows = flows.astype(float_type)
 
-    print("Writing results to file")
-    # Creating a dataframe with the results of the analysis
-    final_df = pd.DataFrame(
-        list_of_tuples_with_metrics,
-        columns=[
-            'Rivid', 'Forecast Day', 'CRPS', 'CRPS BENCH', 'CRPSS', "MAE", "MAE_BENCH", "MAESS", "MSE", "MSE_BENCH",
-            "MSESS", "RMSE", "RMSE_BENCH", "RMSESS", "Pearson_r", "Pearson_r_BENCH", "Pearson_r_SS"
-        ])
+    return flows
 
-    final_df.to_csv(out_path, index=False)
-    print("Finished")
+
+def precision_type(precision):
+    """Returns the floating point type of a precision of the kernels (see PRECISIONS)."""
+    if precision not in PRECISIONS:
+        raise ValueError("The precision must be one of {}, not '{}'.".format(", ".join(PRECISIONS), precision))
+
+    return PRECISIONS[precision]
+
+
+def adapt_chunk_size(chunk_size, bytes_per_rivid, measured_bytes_per_rivid, available_bytes):
+    """
+    Corrects the chunk size with the memory that was measured for each rivid of the first chunks. The chunk size is
+    reduced if the measurement is larger than the estimate of plan_chunk_size. It grows at most to twice its size,
+    and by no more than half of the estimate, if the measurement is smaller.
+    """
+    if measured_bytes_per_rivid <= 0:
+        return chunk_size
+
+    new_chunk_size = int(available_bytes // max(measured_bytes_per_rivid, bytes_per_rivid / 2))
+    new_chunk_size = max(1, min(new_chunk_size, 2 * chunk_size))
+
+    if new_chunk_size != chunk_size:
+        print("Changing the chunk size from {} to {} rivids after measuring the memory used ({:.0f} bytes per "
+              "rivid)".format(chunk_size, new_chunk_size, measured_bytes_per_rivid))
+
+    return new_chunk_size
+
+
+def results_frame(results_array, rivids_chunk, high_res_results_array=None):
+    """
+    Arranges the results array of numba_calculate_metrics (forecast day x stream x metric) into a DataFrame with a row
+    for each stream and forecast day and the columns of RESULT_COLUMNS. If given, the results of
+    numba_calculate_high_res_metrics are added as the columns of HIGH_RES_COLUMNS, with NaN for the forecast days that
+    the high resolution forecast does not cover.
+    """
+    num_forecast_days, num_streams, num_metrics = results_array.shape
+
+    metrics = np.transpose(results_array, (1, 0, 2)).reshape(num_streams * num_forecast_days, num_metrics)
+    results_df = pd.DataFrame(metrics, columns=RESULT_COLUMNS[2:])
+    results_df.insert(0, "Forecast Day", np.tile(np.arange(1, num_forecast_days + 1), num_streams))
+    results_df.insert(0, "Rivid", np.repeat(rivids_chunk, num_forecast_days))
+
+    if high_res_results_array is not None:
+        high_res_metrics = np.full((num_forecast_days, num_streams, len(HIGH_RES_COLUMNS)), np.nan, dtype=np.float32)
+        high_res_metrics[:high_res_results_array.shape[0]] = high_res_results_array
+        high_res_metrics = np.transpose(high_res_metrics, (1, 0, 2)).reshape(num_streams * num_forecast_days, -1)
+        for i, column in enumerate(HIGH_RES_COLUMNS):
+            results_df[column] = high_res_metrics[:, i]
+
+    return results_df
+
+
+@contextmanager
+def results_writer(out_path, output_format="csv"):
+    """
+    Creates the output file of compute_all and yields a function that appends a DataFrame of results (see
+    results_frame) to it, either as CSV or as a row group of a Parquet file.
+    """
+    if output_format not in ("csv", "parquet"):
+        raise ValueError("The output format must be either 'csv' or 'parquet', not '{}'.".format(output_format))
+
+    if output_format == "csv":
+        with open(out_path, "w", newline="") as f:
+            header = [True]
+
+            def write_csv(results_df):
+                results_df.to_csv(f, index=False, header=header[0])
+                header[0] = False
+
+            yield write_csv
+
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = [None]
+
+        def write_parquet(results_df):
+            table = pa.Table.from_pandas(results_df, preserve_index=False)
+            if writer[0] is None:
+                writer[0] = pq.ParquetWriter(out_path, table.schema)
+            writer[0].write_table(table)
+
+        try:
+            yield write_parquet
+        finally:
+            if writer[0] is not None:
+                writer[0].close()
+
+
+def read_chunk(big_dask_q_array, big_dask_init_array, start_chunk, end_chunk, big_dask_high_res_array=None):
+    """
+    Reads the forecasts, initialization values and (if given, otherwise None) high resolution forecasts of a chunk of
+    rivids into memory.
+    """
+    with stage("read_chunk", start_chunk) as counters:
+        big_forecast_data_array = np.asarray(big_dask_q_array[:, start_chunk:end_chunk, :, :])
+        big_init_data_array = np.asarray(big_dask_init_array[:, start_chunk:end_chunk])
+
+        if big_dask_high_res_array is None:
+            big_high_res_data_array = None
+        else:
+            big_high_res_data_array = np.asarray(big_dask_high_res_array[:, start_chunk:end_chunk, :])
+
+        counters["bytes_read"] = big_forecast_data_array.nbytes + big_init_data_array.nbytes
+        if big_high_res_data_array is not None:
+            counters["bytes_read"] += big_high_res_data_array.nbytes
+        counters["rivid_days"] = big_forecast_data_array.shape[0] * big_forecast_data_array.shape[1]
+
+    return big_forecast_data_array, big_init_data_array, big_high_res_data_array
 
 
-@nb.njit(parallel=True)
 def numba_calculate_metrics(forecast_array, initialization_array, number_of_start_dates, number_of_streams,
-                            num_forecast_days, rivid_array):
+                            num_forecast_days, rivid_array, presorted=False, precision="float64"):
     """
     Parameters
     ----------
@@ -164,6 +554,15 @@ def numba_calculate_metrics(forecast_array, initialization_array, number_of_star
     rivid_array:
         A 1d array containing the rivids for the streams to be analyzed
 
+    presorted:
+        If True, the ensemble members in the forecast array are already sorted in ascending order (see the
+        sort_ensembles option of compress_netcfd) and the sort in the CRPS calculation is skipped.
+
+    precision:
+        Either "float64" (default) or "float32", the floating point type of the arithmetic (see PRECISIONS). In
+        float32 the sums over the start dates are compensated, and the results match the float64 results to about
+        five significant digits.
+
     Returns
     -------
     ndarray
@@ -174,226 +573,419 @@ def numba_calculate_metrics(forecast_array, initialization_array, number_of_star
         3) Metrics: CRPS, CRPS_BENCH, CRPSS, MAE, MAE_BENCH, MAESS, MSE, MSE_BENCH, MSESS, RMSE, RMSE_BENCH, RMSESS,
                     Pearson_r, Pearson_r_BENCH, Pearson_r_SS
 
-    """
+    Notes
+    -----
+    All of the metrics for a (stream, forecast day) pair are computed in a single sweep over the start dates. Each
+    forecast row is read once and sorted once into a scratch buffer that belongs to the thread, so there is no heap
+    allocation inside of the loops.
 
-    return_array = np.ones((num_forecast_days, number_of_streams, 15), dtype=np.float32)
+    """
+    return calculate_metrics_kernel(
+        forecast_array, initialization_array, number_of_start_dates, number_of_streams, num_forecast_days, rivid_array,
+        presorted, nb.get_num_threads(), precision_type(precision)
+    )
 
-    for stream in nb.prange(number_of_streams):
-        for forecast_day in range(num_forecast_days):
-            initialization_vals = initialization_array[(forecast_day + 1):, stream]
-            forecasts = forecast_array[:(number_of_start_dates - (forecast_day + 1)), stream, forecast_day, :]
-            benchmark_forecasts = initialization_array[:(number_of_start_dates - (forecast_day + 1)), stream]
-
-            # Calculating the CRPSS
-            crps = ens_crps(initialization_vals, forecasts)
-            crps_bench = mae(initialization_vals, benchmark_forecasts)
-            if crps_bench == 0:
-                crpss = np.inf
-                print("Warning: Division by zero on: ", rivid_array[stream])
-            else:
-                crpss = 1 - crps / crps_bench
 
-            # Calculating MAE_SS
-            mae_val = ens_mae(initialization_vals, forecasts)
-            if crps_bench == 0:
-                maess = np.inf
-            else:
-                maess = 1 - mae_val / crps_bench
+# The kernels are cached on disk (cache=True, in __pycache__ or in NUMBA_CACHE_DIR) so that they are only compiled by
+# the first run with each data type. Numba cannot cache a function that calls nb.get_num_threads(), so the number of
+# threads is given to the kernels by the functions that call them
+@nb.njit(parallel=True, nogil=True, cache=True)
+def calculate_metrics_kernel(forecast_array, initialization_array, number_of_start_dates, number_of_streams,
+                             num_forecast_days, rivid_array, presorted, num_threads, float_type):
+    """
+    The compiled kernel of numba_calculate_metrics, which splits the streams between num_threads threads and computes
+    in float_type.
+    """
+    return_array = np.empty((num_forecast_days, number_of_streams, 15), dtype=np.float32)
+
+    # One scratch row per thread, the streams are split into one contiguous block per thread
+    scratch = np.empty((num_threads, forecast_array.shape[3]), dtype=float_type)
+    statistics_scratch = np.empty((num_threads, NUM_STATISTICS), dtype=np.float64)
+    streams_per_thread = (number_of_streams + num_threads - 1) // num_threads
+
+    for thread in nb.prange(num_threads):
+        sorted_members = scratch[thread, :]
+        statistics = statistics_scratch[thread, :]
+        first_stream = thread * streams_per_thread
+        last_stream = min(first_stream + streams_per_thread, number_of_streams)
+
+        for stream in range(first_stream, last_stream):
+            for forecast_day in range(num_forecast_days):
+                fused_statistics(
+                    forecast_array, initialization_array, number_of_start_dates, stream, forecast_day,
+                    sorted_members, statistics, presorted, 0
+                )
+                metrics_from_statistics(statistics, return_array[forecast_day, stream, :])
 
-            # Calculating the MSE_SS
-            mse_val = ens_mse(initialization_vals, forecasts)
-            mse_bench = mse(initialization_vals, benchmark_forecasts)
-            if mse_bench == 0:
-                msess = np.inf
-            else:
-                msess = 1 - mse_val / mse_bench
+                if return_array[forecast_day, stream, 1] == 0:
+                    print("Warning: Division by zero on: ", rivid_array[stream])
 
-            # Calculating the RMSE_SS
-            rmse_val = ens_rmse(initialization_vals, forecasts)
-            rmse_bench = rmse(initialization_vals, benchmark_forecasts)
-            if rmse_bench == 0:
-                rmsess = np.inf
-            else:
-                rmsess = 1 - rmse_val / rmse_bench
+    return return_array
 
-            # Calculating the Pearson_r_SS
-            pearson_r_val = ens_pearson_r(initialization_vals, forecasts)
-            pearson_r_bench = pearson_r(initialization_vals, benchmark_forecasts)
-            if pearson_r_bench == 0:
-                pearson_r_ss = np.inf
-            else:
-                pearson_r_ss = pearson_r_ss = 1 - (pearson_r_val - 1) / (pearson_r_bench - 1)
-
-            # Adding metrics to the return array
-            return_array[forecast_day, stream, 0] = crps
-            return_array[forecast_day, stream, 1] = crps_bench
-            return_array[forecast_day, stream, 2] = crpss
-            return_array[forecast_day, stream, 3] = mae_val
-            return_array[forecast_day, stream, 4] = crps_bench  # Same as the mae_bench
-            return_array[forecast_day, stream, 5] = maess
-            return_array[forecast_day, stream, 6] = mse_val
-            return_array[forecast_day, stream, 7] = mse_bench
-            return_array[forecast_day, stream, 8] = msess
-            return_array[forecast_day, stream, 9] = rmse_val
-            return_array[forecast_day, stream, 10] = rmse_bench
-            return_array[forecast_day, stream, 11] = rmsess
-            return_array[forecast_day, stream, 12] = pearson_r_val
-            return_array[forecast_day, stream, 13] = pearson_r_bench
-            return_array[forecast_day, stream, 14] = pearson_r_ss
 
-    return return_array
+def numba_calculate_high_res_metrics(high_res_array, initialization_array, number_of_start_dates, number_of_streams,
+                                     num_forecast_days, precision="float64"):
+    """
+    Computes the deterministic metrics and persistence skill scores of the high resolution forecast.
 
+    Parameters
+    ----------
 
-@nb.njit()
-def ens_crps(obs, fcst_ens, adj=np.nan):
+    high_res_array: 3D ndarray
+        A 3 dimensional NumPy array with the following dimensions: 1) Start Dates, 2) Unique stream ID, 3) Forecast
+        Days (1-10)
 
-    rows = obs.size
-    cols = fcst_ens.shape[1]
+    initialization_array, number_of_start_dates, number_of_streams:
+        The same as for numba_calculate_metrics.
 
-    col_len_array = np.ones(rows) * cols
-    sad_ens_half = np.zeros(rows)
-    sad_obs = np.zeros(rows)
-    crps = np.zeros(rows)
+    num_forecast_days:
+        The number of forecast days of the high resolution forecast
 
-    crps = numba_crps(
-        fcst_ens, obs, rows, cols, col_len_array, sad_ens_half, sad_obs, crps, np.float64(adj)
-    )
+    precision:
+        The same as for numba_calculate_metrics.
 
-    # Calc mean crps as simple mean across crps[i]
-    crps_mean = np.mean(crps)
-
-    return crps_mean
-
-
-@nb.njit()
-def numba_crps(ens, obs, rows, cols, col_len_array, sad_ens_half, sad_obs, crps, adj):
-    for i in range(rows):
-        the_obs = obs[i]
-        the_ens = ens[i, :]
-        the_ens = np.sort(the_ens)
-        sum_xj = 0.
-        sum_jxj = 0.
-
-        j = 0
-        while j < cols:
-            sad_obs[i] += np.abs(the_ens[j] - the_obs)
-            sum_xj += the_ens[j]
-            sum_jxj += (j + 1) * the_ens[j]
-            j += 1
-
-        sad_ens_half[i] = 2.0 * sum_jxj - (col_len_array[i] + 1) * sum_xj
-
-    if np.isnan(adj):
-        for i in range(rows):
-            crps[i] = sad_obs[i] / col_len_array[i] - sad_ens_half[i] / \
-                      (col_len_array[i] * col_len_array[i])
-    elif adj > 1:
-        for i in range(rows):
-            crps[i] = sad_obs[i] / col_len_array[i] - sad_ens_half[i] / \
-                      (col_len_array[i] * (col_len_array[i] - 1)) * (1 - 1 / adj)
-    elif adj == 1:
-        for i in range(rows):
-            crps[i] = sad_obs[i] / col_len_array[i]
-    else:
-        for i in range(rows):
-            crps[i] = np.nan
+    Returns
+    -------
+    ndarray
+        An ndarray with the dimensions forecast day, stream and metric (see HIGH_RES_COLUMNS).
 
-    return crps
+    Notes
+    -----
+    The high resolution forecast is treated as an ensemble with one member, whose statistics (see fused_statistics) are
+    those of a deterministic forecast (its CRPS is its absolute error), so that the metrics are the same as the
+    ensemble mean metrics of numba_calculate_metrics.
+    """
+    return calculate_high_res_metrics_kernel(
+        high_res_array, initialization_array, number_of_start_dates, number_of_streams, num_forecast_days,
+        nb.get_num_threads(), precision_type(precision)
+    )
 
 
-@nb.njit()
-def mean_axis_1(forecasts):
-    nrows = forecasts.shape[0]
-    ncols = forecasts.shape[1]
+@nb.njit(parallel=True, nogil=True, cache=True)
+def calculate_high_res_metrics_kernel(high_res_array, initialization_array, number_of_start_dates, number_of_streams,
+                                      num_forecast_days, num_threads, float_type):
+    """
+    The compiled kernel of numba_calculate_high_res_metrics, which splits the streams between num_threads threads and
+    computes in float_type.
+    """
+    return_array = np.empty((num_forecast_days, number_of_streams, HIGH_RES_METRICS.size), dtype=np.float32)
+    one_member_array = high_res_array.reshape(high_res_array.shape + (1,))
+
+    scratch = np.empty((num_threads, 1), dtype=float_type)
+    statistics_scratch = np.empty((num_threads, NUM_STATISTICS), dtype=np.float64)
+    metrics_scratch = np.empty((num_threads, 15), dtype=np.float32)
+    streams_per_thread = (number_of_streams + num_threads - 1) // num_threads
+
+    for thread in nb.prange(num_threads):
+        first_stream = thread * streams_per_thread
+        last_stream = min(first_stream + streams_per_thread, number_of_streams)
+
+        for stream in range(first_stream, last_stream):
+            for forecast_day in range(num_forecast_days):
+                fused_statistics(
+                    one_member_array, initialization_array, number_of_start_dates, stream, forecast_day,
+                    scratch[thread, :], statistics_scratch[thread, :], True, 0
+                )
+                metrics_from_statistics(statistics_scratch[thread, :], metrics_scratch[thread, :])
 
-    return_vector = np.empty((nrows,))
+                for i in range(HIGH_RES_METRICS.size):
+                    return_array[forecast_day, stream, i] = metrics_scratch[thread, HIGH_RES_METRICS[i]]
 
-    for i in range(nrows):
-        mean_tmp = 0
+    return return_array
 
-        for j in range(ncols):
-            mean_tmp += forecasts[i, j]
 
-        mean_tmp /= ncols
-        return_vector[i] = mean_tmp
+def numba_calculate_statistics(forecast_array, initialization_array, number_of_start_dates, number_of_streams,
+                               num_forecast_days, presorted=False, first_obs_index=0):
+    """
+    Computes the sufficient statistics of the metrics of numba_calculate_metrics, from which the metrics can be derived
+    (see metrics_from_statistics) and which can be merged with the statistics of other start dates (see
+    merge_statistics).
 
-    return return_vector
+    Parameters
+    ----------
 
+    forecast_array, initialization_array, number_of_start_dates, number_of_streams, num_forecast_days, presorted:
+        The same as for numba_calculate_metrics.
 
-@nb.njit()
-def mae(obs, sim):
-    return np.mean(np.abs(sim - obs))
+    first_obs_index: int
+        Only the forecasts verified by the initialization values of this start date (index) and the following ones
+        are included, so that the statistics of the earlier start dates are not counted twice when they are merged.
 
+    Returns
+    -------
+    ndarray
+        An ndarray (float64) with the dimensions forecast day, stream and statistic (see STATISTICS).
+    """
+    return calculate_statistics_kernel(
+        forecast_array, initialization_array, number_of_start_dates, number_of_streams, num_forecast_days, presorted,
+        first_obs_index, nb.get_num_threads()
+    )
 
-@nb.njit()
-def ens_mae(obs, forecasts):
 
-    fcst_ens_mean = mean_axis_1(forecasts)
-    error = fcst_ens_mean - obs
+@nb.njit(parallel=True, nogil=True, cache=True)
+def calculate_statistics_kernel(forecast_array, initialization_array, number_of_start_dates, number_of_streams,
+                                num_forecast_days, presorted, first_obs_index, num_threads):
+    """The compiled kernel of numba_calculate_statistics, which splits the streams between num_threads threads."""
+    statistics_array = np.empty((num_forecast_days, number_of_streams, NUM_STATISTICS), dtype=np.float64)
 
-    return np.mean(np.abs(error))
+    scratch = np.empty((num_threads, forecast_array.shape[3]), dtype=np.float64)
+    streams_per_thread = (number_of_streams + num_threads - 1) // num_threads
 
+    for thread in nb.prange(num_threads):
+        sorted_members = scratch[thread, :]
+        first_stream = thread * streams_per_thread
+        last_stream = min(first_stream + streams_per_thread, number_of_streams)
 
-@nb.njit()
-def mse(obs, sim):
-    return np.mean(((sim - obs)**2))
+        for stream in range(first_stream, last_stream):
+            for forecast_day in range(num_forecast_days):
+                fused_statistics(
+                    forecast_array, initialization_array, number_of_start_dates, stream, forecast_day,
+                    sorted_members, statistics_array[forecast_day, stream, :], presorted, first_obs_index
+                )
 
+    return statistics_array
 
-@nb.njit()
-def ens_mse(obs, forecasts):
 
-    fcst_ens_mean = mean_axis_1(forecasts)
-    error = fcst_ens_mean - obs
+@nb.njit(cache=True)
+def fused_statistics(forecast_array, initialization_array, number_of_start_dates, stream, forecast_day,
+                     sorted_members, statistics, presorted, first_obs_index):
+    """Computes the sufficient statistics of one stream and forecast day in a single pass over the start dates.
 
-    return np.mean(error ** 2)
+    The ensemble members of each start date are copied into ``sorted_members`` and sorted in place (unless they are
+    already ``presorted``), the CRPS, the ensemble mean errors and the co-moments needed for the Pearson correlation
+    (using Welford's updates) are then accumulated for both the forecasts and the persistence benchmark. Only the
+    pairs whose observation (initialization value) has an index of at least ``first_obs_index`` are included.
 
+    The arithmetic is done in the floating point type of ``sorted_members`` (see PRECISIONS). In float32 the sums over
+    the start dates are compensated (see kahan_add) so that they stay accurate over long periods, float64 does not need
+    it.
+    """
+    float_type = sorted_members.dtype.type
+    compensated = sorted_members.itemsize < 8  # A constant of the compiled function, so the unused branch is removed
+    zero = float_type(0)
+    num_pairs = number_of_start_dates - (forecast_day + 1)
+    num_members = sorted_members.size
+
+    crps_sum, crps_c = zero, zero
+    ens_abs_error_sum, ens_abs_error_c = zero, zero
+    ens_sq_error_sum, ens_sq_error_c = zero, zero
+    bench_abs_error_sum, bench_abs_error_c = zero, zero
+    bench_sq_error_sum, bench_sq_error_c = zero, zero
+
+    obs_mean = zero
+    ens_mean_mean = zero
+    bench_mean = zero
+    obs_m2, obs_m2_c = zero, zero
+    ens_m2, ens_m2_c = zero, zero
+    bench_m2, bench_m2_c = zero, zero
+    ens_comoment, ens_comoment_c = zero, zero
+    bench_comoment, bench_comoment_c = zero, zero
+
+    count = 0
+    for i in range(max(0, first_obs_index - (forecast_day + 1)), num_pairs):
+        obs = float_type(initialization_array[i + forecast_day + 1, stream])
+        bench = float_type(initialization_array[i, stream])
+
+        for j in range(num_members):
+            sorted_members[j] = forecast_array[i, stream, forecast_day, j]
+        if not presorted:
+            sorted_members.sort()
+
+        # CRPS of the ensemble (sorted form, with the exact integer weights 2j - m + 1 of the spread term) and the
+        # ensemble mean
+        sad_obs = zero
+        sum_xj = zero
+        sad_ens_half = zero
+        for j in range(num_members):
+            sad_obs += np.abs(sorted_members[j] - obs)
+            sum_xj += sorted_members[j]
+            sad_ens_half += float_type(2 * j + 1 - num_members) * sorted_members[j]
+        crps = sad_obs / float_type(num_members) - sad_ens_half / float_type(num_members * num_members)
+        crps_sum, crps_c = kahan_add(crps_sum, crps_c, crps, compensated)
+
+        ens_mean = sum_xj / float_type(num_members)
+
+        # Errors
+        ens_error = ens_mean - obs
+        bench_error = bench - obs
+        ens_abs_error_sum, ens_abs_error_c = kahan_add(
+            ens_abs_error_sum, ens_abs_error_c, np.abs(ens_error), compensated
+        )
+        ens_sq_error_sum, ens_sq_error_c = kahan_add(
+            ens_sq_error_sum, ens_sq_error_c, ens_error * ens_error, compensated
+        )
+        bench_abs_error_sum, bench_abs_error_c = kahan_add(
+            bench_abs_error_sum, bench_abs_error_c, np.abs(bench_error), compensated
+        )
+        bench_sq_error_sum, bench_sq_error_c = kahan_add(
+            bench_sq_error_sum, bench_sq_error_c, bench_error * bench_error, compensated
+        )
 
-@nb.njit()
-def rmse(obs, sim):
+        # Co-moments for the correlation
+        count += 1
+        obs_delta = obs - obs_mean
+        obs_mean += obs_delta / float_type(count)
+        ens_delta = ens_mean - ens_mean_mean
+        ens_mean_mean += ens_delta / float_type(count)
+        bench_delta = bench - bench_mean
+        bench_mean += bench_delta / float_type(count)
+
+        obs_m2, obs_m2_c = kahan_add(obs_m2, obs_m2_c, obs_delta * (obs - obs_mean), compensated)
+        ens_m2, ens_m2_c = kahan_add(ens_m2, ens_m2_c, ens_delta * (ens_mean - ens_mean_mean), compensated)
+        bench_m2, bench_m2_c = kahan_add(bench_m2, bench_m2_c, bench_delta * (bench - bench_mean), compensated)
+        ens_comoment, ens_comoment_c = kahan_add(
+            ens_comoment, ens_comoment_c, obs_delta * (ens_mean - ens_mean_mean), compensated
+        )
+        bench_comoment, bench_comoment_c = kahan_add(
+            bench_comoment, bench_comoment_c, obs_delta * (bench - bench_mean), compensated
+        )
 
-    return np.sqrt(np.mean((sim - obs)**2))
+    statistics[0] = count
+    statistics[1] = crps_sum
+    statistics[2] = ens_abs_error_sum
+    statistics[3] = ens_sq_error_sum
+    statistics[4] = bench_abs_error_sum
+    statistics[5] = bench_sq_error_sum
+    statistics[6] = obs_mean
+    statistics[7] = ens_mean_mean
+    statistics[8] = bench_mean
+    statistics[9] = obs_m2
+    statistics[10] = ens_m2
+    statistics[11] = bench_m2
+    statistics[12] = ens_comoment
+    statistics[13] = bench_comoment
+
+
+@nb.njit(cache=True)
+def kahan_add(total, compensation, value, compensated=True):
+    """
+    Adds a value to a sum with Kahan's compensated summation. Returns the new sum and the new compensation (the
+    low-order part that was lost from the sum, starting at zero). If compensated is False, the value is simply added.
+    """
+    if not compensated:
+        return total + value, compensation
 
+    corrected_value = value - compensation
+    new_total = total + corrected_value
+    return new_total, (new_total - total) - corrected_value
 
-@nb.njit()
-def ens_rmse(obs, forecasts):
 
-    fcst_ens_mean = mean_axis_1(forecasts)
-    error = fcst_ens_mean - obs
+@nb.njit(cache=True)
+def metrics_from_statistics(statistics, out):
+    """Derives the 15 metrics of numba_calculate_metrics from the sufficient statistics of fused_statistics."""
+    num_pairs = statistics[0]
 
-    return np.sqrt(np.mean(error ** 2))
+    if num_pairs <= 0:
+        out[:] = np.nan
+        return
 
+    crps = statistics[1] / num_pairs
+    crps_bench = statistics[4] / num_pairs  # Same as the mae_bench
+    mae_val = statistics[2] / num_pairs
+    mse_val = statistics[3] / num_pairs
+    mse_bench = statistics[5] / num_pairs
+    rmse_val = np.sqrt(mse_val)
+    rmse_bench = np.sqrt(mse_bench)
 
-@nb.njit()
-def pearson_r(obs, sim):
-    sim_mean = np.mean(sim)
-    obs_mean = np.mean(obs)
+    obs_m2 = statistics[9]
+    ens_m2 = statistics[10]
+    bench_m2 = statistics[11]
 
-    top = np.sum((obs - obs_mean) * (sim - sim_mean))
-    bot1 = np.sqrt(np.sum((obs - obs_mean) ** 2))
-    bot2 = np.sqrt(np.sum((sim - sim_mean) ** 2))
+    if obs_m2 * ens_m2 != 0:
+        pearson_r_val = statistics[12] / (np.sqrt(obs_m2) * np.sqrt(ens_m2))
+    else:
+        pearson_r_val = np.nan
 
-    if (bot1 * bot2) != 0:
-        return top / (bot1 * bot2)
+    if obs_m2 * bench_m2 != 0:
+        pearson_r_bench = statistics[13] / (np.sqrt(obs_m2) * np.sqrt(bench_m2))
+    else:
+        pearson_r_bench = np.nan
+
+    out[0] = crps
+    out[1] = crps_bench
+    out[2] = skill_score(crps, crps_bench, 0.)
+    out[3] = mae_val
+    out[4] = crps_bench
+    out[5] = skill_score(mae_val, crps_bench, 0.)
+    out[6] = mse_val
+    out[7] = mse_bench
+    out[8] = skill_score(mse_val, mse_bench, 0.)
+    out[9] = rmse_val
+    out[10] = rmse_bench
+    out[11] = skill_score(rmse_val, rmse_bench, 0.)
+    out[12] = pearson_r_val
+    out[13] = pearson_r_bench
+    if pearson_r_bench == 0:
+        out[14] = np.inf
     else:
-        return np.nan
+        out[14] = skill_score(pearson_r_val, pearson_r_bench, 1.)
 
 
-@nb.njit()
-def ens_pearson_r(obs, forecasts):
+@nb.njit(parallel=True, cache=True)
+def numba_metrics_from_statistics(statistics_array):
+    """
+    Derives the metrics of numba_calculate_metrics (forecast day x stream x metric) from an array of sufficient
+    statistics (forecast day x stream x statistic).
+    """
+    num_forecast_days, number_of_streams, _ = statistics_array.shape
+    return_array = np.empty((num_forecast_days, number_of_streams, 15), dtype=np.float32)
 
-    fcst_ens_mean = mean_axis_1(forecasts)
+    for stream in nb.prange(number_of_streams):
+        for forecast_day in range(num_forecast_days):
+            metrics_from_statistics(statistics_array[forecast_day, stream, :], return_array[forecast_day, stream, :])
 
-    sim_mean = np.mean(fcst_ens_mean)
-    obs_mean = np.mean(obs)
+    return return_array
 
-    top = np.sum((obs - obs_mean) * (fcst_ens_mean - sim_mean))
-    bot1 = np.sqrt(np.sum((obs - obs_mean) ** 2))
-    bot2 = np.sqrt(np.sum((fcst_ens_mean - sim_mean) ** 2))
 
-    if (bot1 * bot2) != 0:
-        return top / (bot1 * bot2)
-    else:
-        return np.nan
+@nb.njit(parallel=True, cache=True)
+def merge_statistics(statistics_array, new_statistics_array):
+    """
+    Merges the sufficient statistics of new start dates into an array of statistics (in place), combining the means
+    and co-moments of the two sets of pairs with the pairwise formulas of Chan et al.
+    """
+    num_forecast_days, number_of_streams, _ = statistics_array.shape
+
+    for stream in nb.prange(number_of_streams):
+        for forecast_day in range(num_forecast_days):
+            a = statistics_array[forecast_day, stream, :]
+            b = new_statistics_array[forecast_day, stream, :]
+
+            count_a = a[0]
+            count_b = b[0]
+            count = count_a + count_b
+            if count_b == 0:
+                continue
+            if count_a == 0:
+                a[:] = b
+                continue
+
+            # Sums
+            for k in range(1, 6):
+                a[k] += b[k]
+
+            # Means, second moments and co-moments
+            obs_delta = b[6] - a[6]
+            ens_delta = b[7] - a[7]
+            bench_delta = b[8] - a[8]
+            weight = count_a * count_b / count
+
+            a[9] += b[9] + obs_delta * obs_delta * weight
+            a[10] += b[10] + ens_delta * ens_delta * weight
+            a[11] += b[11] + bench_delta * bench_delta * weight
+            a[12] += b[12] + obs_delta * ens_delta * weight
+            a[13] += b[13] + obs_delta * bench_delta * weight
+
+            a[6] += obs_delta * count_b / count
+            a[7] += ens_delta * count_b / count
+            a[8] += bench_delta * count_b / count
+            a[0] = count
+
+
+@nb.njit(cache=True)
+def skill_score(score, bench_score, perfect_score):
+    if bench_score == perfect_score:
+        return np.inf
+    return (score - bench_score) / (perfect_score - bench_score)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+import xarray as xr
+import numpy as np
+import os
+
+# Chunk sizes of the Zarr archive, a few weeks of start dates for a block of rivids so that both the lead time reads of
+# compute_all and the time series reads of extract_by_rivid touch a small number of chunks
+ZARR_CHUNKS = {"start_date": 16, "rivid": 128, "lead_day": 15, "ensemble_number": 51, "lead_day_high_res": 10}
+
+# The variables of the flows, that must be packed the same way as in the archive for a file to be appended to it
+PACKED_VARIABLES = ("Qout", "Qout_high_res", "initialization_values")
+
+
+def append_to_zarr_archive(file, store_path, chunks=None):
+    """
+    Appends a forecast file created with compress_netcfd to a Zarr archive as a new slice along the start_date
+    dimension. The archive is created if it does not exist yet. The archive contains the same variables as the
+    compressed files, but the dates of the forecasts are replaced by the lead days (1-15 for Qout and 1-10 for
+    Qout_high_res) and the initialization values become a data variable with the start_date dimension. The metadata
+    of the archive is consolidated so that it opens quickly.
+
+    The file must have the same rivids, ensemble order and packing as the archive. The appended flows are stored with
+    the scale factor and offset of the archive, so files packed with pack="linear" (which are scaled to their own
+    range of flows) can only be appended to an archive created from a file with the same range, while the files packed
+    with pack="log" share the same scale factor and offset.
+
+    Parameters
+    ----------
+
+    file: str
+        The path to the forecast file created with compress_netcfd (YYYYMMDD.nc).
+
+    store_path: str
+        The path to the Zarr archive (e.g. South_Asia.zarr).
+
+    chunks: dict
+        The chunk sizes of the archive along each dimension, only used when the archive is created. Defaults to
+        ZARR_CHUNKS.
+    """
+    with xr.open_dataset(file) as ds:
+        ds = ds.reset_coords("initialization_values")
+        ds = ds.rename({"date": "lead_day", "date_high_res": "lead_day_high_res"})
+        ds = ds.assign_coords(
+            lead_day=np.arange(1, ds["lead_day"].size + 1, dtype=np.uint8),
+            lead_day_high_res=np.arange(1, ds["lead_day_high_res"].size + 1, dtype=np.uint8)
+        )
+        ds = ds.expand_dims("start_date")
+
+        # Keeping the packing of the flows (see compress_netcfd), but not the NetCDF storage options
+        for variable in ds.variables.values():
+            variable.encoding = {
+                key: value for key, value in variable.encoding.items()
+                if key in ("dtype", "scale_factor", "add_offset", "_FillValue")
+            }
+
+        if not is_zarr_archive(store_path):
+            if chunks is None:
+                chunks = ZARR_CHUNKS
+
+            # The encoding given to to_zarr replaces the encoding of the variables, so the packing is added back to it
+            encoding = {
+                name: dict(
+                    variable.encoding,
+                    chunks=tuple(min(chunks.get(dim, size), size) for dim, size in variable.sizes.items())
+                )
+                for name, variable in ds.data_vars.items()
+            }
+            ds.to_zarr(store_path, mode="w", encoding=encoding, consolidated=True)
+
+        else:
+            with xr.open_zarr(store_path, consolidated=True) as archive:
+                if not np.array_equal(archive["rivid"].values, ds["rivid"].values):
+                    raise ValueError("The rivids in {} do not match the rivids in the archive.".format(file))
+
+                if ds.attrs.get("ensembles_sorted", 0) != archive.attrs.get("ensembles_sorted", 0):
+                    raise ValueError("The ensembles in {} are not sorted like the ones in the archive.".format(file))
+
+                for name in PACKED_VARIABLES:
+                    if packing(ds[name]) != packing(archive[name]):
+                        raise ValueError(
+                            "The {} flows in {} are not packed like the ones in the archive.".format(name, file)
+                        )
+
+                if ds["start_date"].values[0] <= archive["start_date"].values[-1]:
+                    raise ValueError(
+                        "The start date of {} must be after the last start date in the archive.".format(file)
+                    )
+
+            ds.drop_vars(["lat", "lon", "z"]).to_zarr(store_path, append_dim="start_date", consolidated=True)
+
+
+def packing(variable):
+    """
+    Returns how the flows of a variable were packed (see the pack option of compress_netcfd), as the transform applied
+    to the flows and the scale factor and offset of the integers they are stored as (None if they are not packed).
+    """
+    scale_factor, add_offset = (variable.encoding.get(key) for key in ("scale_factor", "add_offset"))
+    return (
+        variable.attrs.get("transform"),
+        None if scale_factor is None else float(scale_factor),
+        None if add_offset is None else float(add_offset)
+    )
+
+
+def is_zarr_archive(path):
+    """Checks if a path is a Zarr archive (as opposed to a directory of compressed forecast files)."""
+    return os.path.isfile(os.path.join(path, ".zgroup")) or os.path.isfile(os.path.join(path, ".zmetadata"))
+
+
+def open_zarr_archive(store_path, starting_date=None, ending_date=None):
+    """
+    Opens a Zarr archive created with append_to_zarr_archive.
+
+    Parameters
+    ----------
+
+    store_path: str
+        The path to the Zarr archive.
+
+    starting_date: str
+        The first start date to select formatted as YYYY-MM-DD. By default the archive is not subset.
+
+    ending_date: str
+        The last start date to select formatted as YYYY-MM-DD. By default the archive is not subset.
+
+    Returns
+    -------
+    xarray.Dataset
+        The archive, backed by dask arrays.
+    """
+    ds = xr.open_zarr(store_path, consolidated=True)
+
+    if (starting_date is None) != (ending_date is None):
+        raise RuntimeError("Either both the starting and ending date must be specified or neither.")
+
+    if starting_date is not None:
+        ds = ds.sel(start_date=slice(starting_date, ending_date))
+
+    return ds
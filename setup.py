@@ -29,6 +29,10 @@ setup(
         'netcdf4',
         "progress",
     ],
+    extras_require={
+        'zarr': ['zarr'],
+        'parquet': ['pyarrow'],
+    },
     entry_points={
         'console_scripts': ['gb_fcst_val=global_forecast_validation.command_line:main', ],
     },